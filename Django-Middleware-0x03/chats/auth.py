@@ -1,4 +1,9 @@
 """Authentication views for the messaging application."""
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views import View
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
@@ -6,6 +11,7 @@ from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import get_user_model
 from .serializers import UserSerializer
+from .passwords import PasswordVerifierSaturated, password_verifier
 
 User = get_user_model()
 
@@ -44,47 +50,98 @@ def register_user(request):
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-@api_view(['POST'])
-@permission_classes([AllowAny])
-def login_user(request):
+def parse_credentials(request):
+    """Return (username, password) from a JSON or form-encoded body."""
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+    else:
+        data = request.POST
+    return data.get('username'), data.get('password')
+
+
+def login_response(user):
+    """Build the successful login payload, including new JWT tokens."""
+    refresh = RefreshToken.for_user(user)
+    return {
+        'user': UserSerializer(user).data,
+        'refresh': str(refresh),
+        'access': str(refresh.access_token),
+        'message': 'Login successful'
+    }
+
+
+class LoginUserView(View):
     """
     Login user with username and password, return JWT tokens.
     
+    This is a native async view: the password hash is verified on a bounded
+    worker pool so a burst of logins cannot starve other requests, and the
+    endpoint returns 429 when the pool is full.
+    
     Expected request body:
     {
         "username": "string",
         "password": "string"
     }
     """
-    username = request.data.get('username')
-    password = request.data.get('password')
     
-    if not username or not password:
-        return Response({
-            'error': 'Please provide both username and password'
-        }, status=status.HTTP_400_BAD_REQUEST)
+    http_method_names = ['post']
     
-    try:
-        user = User.objects.get(username=username)
-    except User.DoesNotExist:
-        return Response({
-            'error': 'Invalid credentials'
-        }, status=status.HTTP_401_UNAUTHORIZED)
+    @classmethod
+    def as_view(cls, **initkwargs):
+        """Return the view exempt from CSRF checks, like the other auth endpoints."""
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        return view
     
-    if not user.check_password(password):
-        return Response({
-            'error': 'Invalid credentials'
-        }, status=status.HTTP_401_UNAUTHORIZED)
-    
-    # Generate JWT tokens
-    refresh = RefreshToken.for_user(user)
-    
-    return Response({
-        'user': UserSerializer(user).data,
-        'refresh': str(refresh),
-        'access': str(refresh.access_token),
-        'message': 'Login successful'
-    }, status=status.HTTP_200_OK)
+    async def post(self, request):
+        """Verify the credentials and issue tokens."""
+        username, password = parse_credentials(request)
+        
+        if not username or not password:
+            return JsonResponse({
+                'error': 'Please provide both username and password'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            user = await User.objects.aget(username=username)
+        except User.DoesNotExist:
+            return JsonResponse({
+                'error': 'Invalid credentials'
+            }, status=status.HTTP_401_UNAUTHORIZED)
+        
+        async def save_upgraded_hash(encoded):
+            # Outdated hasher or iteration count, as ModelBackend would upgrade
+            user.password = encoded
+            await User.objects.filter(pk=user.pk).aupdate(password=encoded)
+        
+        try:
+            password_ok = await password_verifier.averify(
+                password, user.password, update_hash=save_upgraded_hash
+            )
+        except PasswordVerifierSaturated:
+            response = JsonResponse({
+                'error': 'Too many login attempts in progress, please retry shortly'
+            }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+            response['Retry-After'] = '1'
+            return response
+        
+        if not password_ok or not user.is_active:
+            return JsonResponse({
+                'error': 'Invalid credentials'
+            }, status=status.HTTP_401_UNAUTHORIZED)
+        
+        # Issuing tokens writes to the token blacklist tables
+        payload = await sync_to_async(login_response)(user)
+        return JsonResponse(payload, status=status.HTTP_200_OK)
+
+
+login_user = LoginUserView.as_view()
 
 
 @api_view(['POST'])
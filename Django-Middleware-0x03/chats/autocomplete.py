@@ -0,0 +1,192 @@
+"""In-memory prefix index used by the user autocomplete endpoint."""
+import logging
+import threading
+from bisect import bisect_left, insort
+from time import monotonic
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(value):
+    """Normalize a name or search term for prefix matching."""
+    return ' '.join((value or '').split()).casefold()
+
+
+class UserAutocompleteIndex:
+    """
+    Sorted index of normalized user names supporting prefix lookups.
+
+    Every user is indexed under their username, full name and last name.
+    Email addresses are deliberately not indexed, so the endpoint cannot be
+    used to discover other users' addresses. Entries are kept in a sorted
+    list of (key, user_id) tuples, so a prefix lookup is a binary search
+    followed by a short forward scan.
+
+    The index is built lazily on first use, kept current by the User
+    post_save/post_delete signals and rebuilt every REFRESH_INTERVAL seconds
+    to pick up changes made by other worker processes. Those rebuilds run on
+    a background thread, one at a time, while searches keep using the
+    previous index.
+    """
+
+    # Seconds before the index is rebuilt from the database
+    REFRESH_INTERVAL = 300
+
+    # Default and maximum number of results returned by search()
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 50
+
+    def __init__(self):
+        """Initialize an empty, unbuilt index."""
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._entries = []
+        self._keys = {}
+        self._users = {}
+        self._built_at = None
+
+    @staticmethod
+    def keys_for(username, first_name, last_name):
+        """Return the normalized keys a user is indexed under."""
+        full_name = normalize(f'{first_name} {last_name}')
+        keys = {normalize(username), full_name, normalize(last_name)}
+        keys.discard('')
+        return sorted(keys)
+
+    @staticmethod
+    def summary(user_id, username, first_name, last_name):
+        """Return the public fields returned for a matching user."""
+        return {
+            'user_id': user_id,
+            'username': username,
+            'first_name': first_name,
+            'last_name': last_name,
+        }
+
+    def build(self):
+        """Rebuild the index from the database."""
+        from .models import User
+
+        entries = []
+        keys = {}
+        users = {}
+        rows = User.objects.filter(is_active=True).values_list(
+            'user_id', 'username', 'first_name', 'last_name'
+        ).iterator(chunk_size=5000)
+        for user_id, username, first_name, last_name in rows:
+            user_keys = self.keys_for(username, first_name, last_name)
+            keys[user_id] = user_keys
+            users[user_id] = self.summary(user_id, username, first_name, last_name)
+            entries.extend((key, user_id) for key in user_keys)
+        entries.sort()
+
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self._users = users
+            self._built_at = monotonic()
+
+    def is_stale(self):
+        """Return True if the index has never been built or is too old."""
+        return (
+            self._built_at is None
+            or monotonic() - self._built_at > self.REFRESH_INTERVAL
+        )
+
+    def ensure_built(self):
+        """Build the index on first use; concurrent callers wait for one build."""
+        with self._build_lock:
+            if self._built_at is None:
+                self.build()
+
+    def refresh_in_background(self):
+        """Start rebuilding the index on a background thread, unless a build is running."""
+        if not self._build_lock.acquire(blocking=False):
+            return
+        try:
+            threading.Thread(
+                target=self._refresh, name='user-autocomplete-refresh', daemon=True
+            ).start()
+        except Exception:
+            self._build_lock.release()
+            raise
+
+    def _refresh(self):
+        """Rebuild the index, then release the build lock taken by refresh_in_background()."""
+        try:
+            self.build()
+        except Exception:
+            # The old index stays in use; the next search tries again
+            logger.exception('Rebuilding the user autocomplete index failed')
+        finally:
+            self._build_lock.release()
+            close_old_connections()
+
+    def _remove_locked(self, user_id):
+        """Remove a user's entries; the caller must hold the lock."""
+        for key in self._keys.pop(user_id, []):
+            position = bisect_left(self._entries, (key, user_id))
+            if position < len(self._entries) and self._entries[position] == (key, user_id):
+                del self._entries[position]
+        self._users.pop(user_id, None)
+
+    def update_user(self, user):
+        """Add or re-index a single user after it has been saved."""
+        if self._built_at is None:
+            return
+        with self._lock:
+            self._remove_locked(user.user_id)
+            if not user.is_active:
+                return
+            user_keys = self.keys_for(user.username, user.first_name, user.last_name)
+            self._keys[user.user_id] = user_keys
+            self._users[user.user_id] = self.summary(
+                user.user_id, user.username, user.first_name, user.last_name
+            )
+            for key in user_keys:
+                insort(self._entries, (key, user.user_id))
+
+    def remove_user(self, user_id):
+        """Drop a user from the index after it has been deleted."""
+        if self._built_at is None:
+            return
+        with self._lock:
+            self._remove_locked(user_id)
+
+    def search(self, term, limit=DEFAULT_LIMIT):
+        """Return up to ``limit`` users with a key starting with ``term``."""
+        prefix = normalize(term)
+        if not prefix:
+            return []
+        if self._built_at is None:
+            self.ensure_built()
+        elif self.is_stale():
+            self.refresh_in_background()
+
+        limit = max(1, min(limit, self.MAX_LIMIT))
+        results = []
+        seen = set()
+        with self._lock:
+            position = bisect_left(self._entries, (prefix,))
+            while position < len(self._entries) and len(results) < limit:
+                key, user_id = self._entries[position]
+                if not key.startswith(prefix):
+                    break
+                if user_id not in seen:
+                    seen.add(user_id)
+                    results.append(self._users[user_id])
+                position += 1
+        return results
+
+    def clear(self):
+        """Discard the index so it is rebuilt on next use."""
+        with self._lock:
+            self._entries = []
+            self._keys = {}
+            self._users = {}
+            self._built_at = None
+
+
+user_index = UserAutocompleteIndex()
@@ -0,0 +1,137 @@
+"""
+Background thread that consumes a queue in micro-batches.
+
+Shared by the message write queue (chats.ingest) and the request log writer
+(chats.request_log). Items are handed to ``write_batch`` in FIFO order, in
+batches of up to ``batch_size`` items collected for at most
+``flush_interval`` seconds. shutdown() stops the thread after writing
+everything queued before it was called.
+"""
+import logging
+import queue
+import threading
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Sentinel placed on the queue to stop the worker thread
+_STOP = object()
+
+
+class BatchingWorker:
+    """
+    Base class for a queue drained by one background thread in batches.
+
+    Subclasses implement write_batch(), and may override finish() to release
+    resources once the thread stops. The thread is started lazily and
+    restarted if it has died, so items are never queued with nobody to
+    consume them. An exception from write_batch() is logged and passed to
+    batch_failed(); the thread carries on with the next batch.
+    """
+
+    thread_name = 'chats-batching-worker'
+
+    def __init__(self, batch_size=500, flush_interval=0.005, queue_size=0):
+        """Initialize the worker; the thread starts on first use."""
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def closed(self):
+        """Return True once shutdown() has been called."""
+        return self._closed
+
+    def is_running(self):
+        """Return True if the worker thread is alive."""
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def start(self):
+        """Start the worker thread if it is not running; return False once shut down."""
+        if self.is_running():
+            return True
+        with self._lock:
+            if self._closed:
+                return False
+            if not self.is_running():
+                self._thread = threading.Thread(
+                    target=self._run, name=self.thread_name, daemon=True
+                )
+                self._thread.start()
+        return True
+
+    def shutdown(self, timeout=None):
+        """Stop accepting items and wait until queued ones are written."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            # Blocks only if the queue is full, i.e. until the worker catches up
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def write_batch(self, batch):
+        """Write a batch of items; implemented by subclasses."""
+        raise NotImplementedError
+
+    def batch_failed(self, batch, exc):
+        """Handle a batch whose write_batch() raised ``exc``."""
+
+    def finish(self):
+        """Release resources after the last batch; runs on the worker thread."""
+
+    def _write(self, batch):
+        """Write a batch, keeping the thread alive whatever it raises."""
+        try:
+            self.write_batch(batch)
+        except Exception as exc:
+            logger.exception('%s failed to write a batch of %d items', self.thread_name, len(batch))
+            self.batch_failed(batch, exc)
+
+    def _collect(self, first):
+        """Gather a batch starting with ``first`` until it is full or the interval passes."""
+        batch = [first]
+        stop = False
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stop = True
+                break
+            batch.append(item)
+        return batch, stop
+
+    def _run(self):
+        """Worker loop: collect batches and write them until stopped."""
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                batch, stop = self._collect(item)
+                self._write(batch)
+                if stop:
+                    break
+            # Drain anything submitted before shutdown was requested
+            leftover = []
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _STOP:
+                    leftover.append(item)
+            for start in range(0, len(leftover), self.batch_size):
+                self._write(leftover[start:start + self.batch_size])
+        finally:
+            self.finish()
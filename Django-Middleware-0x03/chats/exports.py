@@ -0,0 +1,81 @@
+"""Streaming transcript export helpers for the messaging application."""
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+# Number of rows fetched per round trip by the server-side cursor
+EXPORT_CHUNK_SIZE = 2000
+
+# (queryset lookup, exported column name) pairs, in output order
+EXPORT_COLUMNS = [
+    ('message_id', 'message_id'),
+    ('conversation_id', 'conversation_id'),
+    ('sender_id', 'sender_id'),
+    ('sender__username', 'sender_username'),
+    ('message_body', 'message_body'),
+    ('sent_at', 'sent_at'),
+]
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+class Echo:
+    """File-like object whose write() returns the value instead of storing it."""
+
+    def write(self, value):
+        """Return the written value so csv.writer can be used as a generator."""
+        return value
+
+
+def export_rows(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Iterate over message rows as tuples without caching the queryset.
+
+    Uses a server-side cursor where the database supports it, so memory
+    stays constant regardless of the number of messages.
+    """
+    lookups = [lookup for lookup, _ in EXPORT_COLUMNS]
+    return queryset.values_list(*lookups).iterator(chunk_size=chunk_size)
+
+
+def iter_ndjson(rows):
+    """Yield one JSON document per line for each row."""
+    columns = [column for _, column in EXPORT_COLUMNS]
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def iter_csv(rows):
+    """Yield a CSV header line followed by one line per row."""
+    writer = csv.writer(Echo())
+    yield writer.writerow([column for _, column in EXPORT_COLUMNS])
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def streaming_export_response(queryset, export_format, filename):
+    """
+    Build a StreamingHttpResponse that writes the queryset as NDJSON or CSV.
+
+    The database is only queried once the response starts streaming, so the
+    first byte goes out as soon as the first chunk has been fetched.
+    """
+    rows = export_rows(queryset)
+    if export_format == 'csv':
+        content = iter_csv(rows)
+    else:
+        content = iter_ndjson(rows)
+
+    response = StreamingHttpResponse(
+        content,
+        content_type=EXPORT_FORMATS[export_format]
+    )
+    response['Content-Disposition'] = (
+        f'attachment; filename="{filename}.{export_format}"'
+    )
+    return response
@@ -0,0 +1,296 @@
+"""
+Fan-out-on-write maintenance of the per-user InboxEntry table.
+
+Optional, and off unless the CHATS_INBOX_ENABLED setting is set. Every
+message write then updates the inbox rows of all conversation members with
+one set-based UPDATE per conversation, edits and deletes refresh the rows
+from the conversation's latest remaining message, and membership changes
+create or delete rows. rebuild_inbox and check_inbox (management commands) use
+plan_conversations() to repair or report drift; run rebuild_inbox after
+enabling the inbox on existing data.
+
+The fan-out runs after the message commits, on a background thread that
+coalesces the messages of busy conversations into one UPDATE per batch, so
+requests never wait for it. With CHATS_INBOX_ASYNC set to False it runs
+inline in the writing transaction instead. Messages still queued when a
+process dies are not fanned out; rebuild_inbox repairs their previews.
+"""
+import atexit
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, connection, models, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Value, When
+
+from .batching import BatchingWorker
+from .models import Conversation, InboxEntry, Message
+
+PREVIEW_LENGTH = 100
+
+
+def is_enabled():
+    """Return True if inbox fan-out is turned on in settings."""
+    return getattr(settings, 'CHATS_INBOX_ENABLED', False)
+
+
+def is_async():
+    """Return True if the fan-out runs on the background thread."""
+    return getattr(settings, 'CHATS_INBOX_ASYNC', True)
+
+
+def make_preview(body):
+    """Return the inbox preview text for a message body."""
+    body = ' '.join((body or '').split())
+    if len(body) <= PREVIEW_LENGTH:
+        return body
+    return body[:PREVIEW_LENGTH - 3] + '...'
+
+
+def record_messages(messages):
+    """
+    Fan newly written messages out to their conversations' inbox rows.
+
+    Issues one UPDATE per conversation in the batch. Every member's unread
+    count grows by the number of messages they did not send, and the last
+    message fields only move forward in time.
+    """
+    if not is_enabled() or not messages:
+        return
+
+    by_conversation = defaultdict(list)
+    for message in messages:
+        by_conversation[message.conversation_id].append(message)
+
+    for conversation_id, batch in by_conversation.items():
+        latest = max(batch, key=lambda message: message.sent_at)
+        total = len(batch)
+        sent_by = Counter(message.sender_id for message in batch)
+
+        unread = Case(
+            *[
+                When(user_id=sender_id, then=F('unread_count') + (total - count))
+                for sender_id, count in sent_by.items()
+            ],
+            default=F('unread_count') + total,
+            output_field=models.PositiveIntegerField()
+        )
+        is_newer = Q(last_message_at__isnull=True) | Q(last_message_at__lte=latest.sent_at)
+
+        def newer(field, value, output_field):
+            return Case(
+                When(is_newer, then=Value(value)),
+                default=F(field),
+                output_field=output_field
+            )
+
+        InboxEntry.objects.filter(conversation_id=conversation_id).update(
+            unread_count=unread,
+            last_message_at=newer('last_message_at', latest.sent_at, models.DateTimeField()),
+            last_message_preview=newer(
+                'last_message_preview', make_preview(latest.message_body), models.CharField()
+            ),
+            last_sender_id=newer('last_sender_id', latest.sender_id, models.UUIDField()),
+        )
+
+
+class InboxFanout(BatchingWorker):
+    """Background thread fanning committed messages out to inbox rows in batches."""
+
+    thread_name = 'chats-inbox-fanout'
+
+    def __init__(self, batch_size=500, flush_interval=0.05):
+        """Initialize the fan-out; the thread starts on first submit."""
+        super().__init__(batch_size=batch_size, flush_interval=flush_interval)
+
+    def submit(self, messages):
+        """Queue committed messages, or fan them out inline once shut down."""
+        if not self.start():
+            record_messages(messages)
+            return
+        for message in messages:
+            self._queue.put(message)
+
+    def write_batch(self, batch):
+        """Fan a batch out with one UPDATE per conversation."""
+        close_old_connections()
+        with transaction.atomic():
+            record_messages(batch)
+
+    def finish(self):
+        """Close the thread's database connection."""
+        connection.close()
+
+
+_inbox_fanout = None
+_fanout_lock = threading.Lock()
+
+
+def get_inbox_fanout():
+    """Return the process-wide inbox fan-out, creating it on first use."""
+    global _inbox_fanout
+    with _fanout_lock:
+        if _inbox_fanout is None:
+            _inbox_fanout = InboxFanout()
+            atexit.register(_inbox_fanout.shutdown)
+        return _inbox_fanout
+
+
+def fan_out_on_commit(messages):
+    """Fan new messages out once the current transaction commits, or inline if not async."""
+    if not is_enabled() or not messages:
+        return
+    if not is_async():
+        record_messages(messages)
+        return
+    transaction.on_commit(lambda: get_inbox_fanout().submit(messages))
+
+
+def refresh_conversation(conversation_id):
+    """
+    Reset a conversation's inbox rows to its latest remaining message.
+
+    Used after a message is edited or deleted, which the forward-only
+    fan-out cannot express. Unread counts are kept, since read state is not
+    derivable from messages.
+    """
+    latest = Message.objects.filter(
+        conversation_id=conversation_id
+    ).order_by('-sent_at').first()
+    InboxEntry.objects.filter(conversation_id=conversation_id).update(
+        last_message_at=latest.sent_at if latest else None,
+        last_message_preview=make_preview(latest.message_body) if latest else '',
+        last_sender_id=latest.sender_id if latest else None,
+    )
+
+
+def refresh_on_commit(conversation_id):
+    """Refresh a conversation's inbox rows once the current transaction commits."""
+    if not is_enabled():
+        return
+    if not is_async():
+        refresh_conversation(conversation_id)
+        return
+    transaction.on_commit(lambda: refresh_conversation(conversation_id))
+
+
+def add_members(conversation_id, user_ids):
+    """Create inbox rows for users who joined a conversation."""
+    if not is_enabled() or not user_ids:
+        return
+    latest = Message.objects.filter(
+        conversation_id=conversation_id
+    ).order_by('-sent_at').first()
+    InboxEntry.objects.bulk_create(
+        [
+            InboxEntry(
+                user_id=user_id,
+                conversation_id=conversation_id,
+                last_message_at=latest.sent_at if latest else None,
+                last_message_preview=make_preview(latest.message_body) if latest else '',
+                last_sender_id=latest.sender_id if latest else None,
+            )
+            for user_id in user_ids
+        ],
+        ignore_conflicts=True
+    )
+
+
+def remove_members(conversation_id, user_ids):
+    """Delete inbox rows for users who left a conversation."""
+    if not is_enabled() or not user_ids:
+        return
+    InboxEntry.objects.filter(
+        conversation_id=conversation_id,
+        user_id__in=user_ids
+    ).delete()
+
+
+def mark_read(user, conversation_id):
+    """Reset a user's unread count for a conversation."""
+    if not is_enabled():
+        return
+    InboxEntry.objects.filter(
+        user_id=user.pk,
+        conversation_id=conversation_id,
+        unread_count__gt=0
+    ).update(unread_count=0)
+
+
+def plan_conversations(conversation_ids):
+    """
+    Compare stored inbox rows for the given conversations with source data.
+
+    Returns (to_create, to_update, to_delete): unsaved rows for missing
+    memberships, existing rows whose last message fields are wrong (already
+    corrected in memory), and ids of rows without a membership. Unread counts
+    are kept, since read state is not derivable from messages.
+    """
+    latest = Message.objects.filter(conversation_id=OuterRef('pk')).order_by('-sent_at')
+    summaries = {
+        row['pk']: row
+        for row in Conversation.objects.filter(pk__in=conversation_ids).annotate(
+            latest_at=Subquery(latest.values('sent_at')[:1]),
+            latest_body=Subquery(latest.values('message_body')[:1]),
+            latest_sender=Subquery(
+                latest.values('sender_id')[:1], output_field=models.UUIDField()
+            ),
+        ).values('pk', 'latest_at', 'latest_body', 'latest_sender')
+    }
+    members = set(
+        Conversation.participants.through.objects.filter(
+            conversation_id__in=conversation_ids
+        ).values_list('conversation_id', 'user_id')
+    )
+    existing = {
+        (entry.conversation_id, entry.user_id): entry
+        for entry in InboxEntry.objects.filter(conversation_id__in=conversation_ids)
+    }
+
+    to_create = []
+    to_update = []
+    for conversation_id, user_id in members:
+        summary = summaries[conversation_id]
+        expected = {
+            'last_message_at': summary['latest_at'],
+            'last_message_preview': make_preview(summary['latest_body']),
+            'last_sender_id': summary['latest_sender'],
+        }
+        entry = existing.get((conversation_id, user_id))
+        if entry is None:
+            to_create.append(InboxEntry(
+                user_id=user_id, conversation_id=conversation_id, **expected
+            ))
+        elif any(getattr(entry, field) != value for field, value in expected.items()):
+            for field, value in expected.items():
+                setattr(entry, field, value)
+            to_update.append(entry)
+
+    to_delete = [entry.pk for key, entry in existing.items() if key not in members]
+    return to_create, to_update, to_delete
+
+
+def rebuild_conversations(conversation_ids):
+    """Repair the inbox rows of the given conversations; returns change counts."""
+    with transaction.atomic():
+        to_create, to_update, to_delete = plan_conversations(conversation_ids)
+        InboxEntry.objects.bulk_create(to_create, ignore_conflicts=True)
+        InboxEntry.objects.bulk_update(
+            to_update,
+            ['last_message_at', 'last_message_preview', 'last_sender_id']
+        )
+        InboxEntry.objects.filter(pk__in=to_delete).delete()
+    return len(to_create), len(to_update), len(to_delete)
+
+
+def iter_conversation_batches(batch_size):
+    """Yield lists of conversation ids in primary key order."""
+    batch = []
+    ids = Conversation.objects.order_by('pk').values_list('pk', flat=True)
+    for conversation_id in ids.iterator(chunk_size=batch_size):
+        batch.append(conversation_id)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
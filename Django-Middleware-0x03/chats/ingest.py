@@ -0,0 +1,128 @@
+"""
+Write-coalescing ingestion queue for chat messages.
+
+When CHATS_MESSAGE_WRITE_COALESCING is enabled, accepted messages are handed
+to a single background writer instead of being committed one transaction per
+request. The writer flushes micro-batches with bulk_create every
+CHATS_MESSAGE_WRITE_FLUSH_INTERVAL seconds or CHATS_MESSAGE_WRITE_BATCH_SIZE
+messages, whichever comes first, and each request waits on its own future.
+
+A request that gives up waiting after CHATS_MESSAGE_WRITE_TIMEOUT seconds
+gets a TimeoutError, although its message may still be committed later.
+add_message answers 503 with the message id as an idempotency key, so the
+client can retry without creating a duplicate.
+"""
+import atexit
+import logging
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+
+from .batching import BatchingWorker
+from .inbox import record_messages
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteQueue(BatchingWorker):
+    """
+    In-process queue that commits messages in batches.
+
+    A single writer thread consumes the queue in FIFO order, so messages are
+    inserted, and their sent_at timestamps assigned, in submission order.
+    shutdown() drains everything already submitted before returning.
+    """
+
+    thread_name = 'chats-message-writer'
+
+    def __init__(self, batch_size=500, flush_interval=0.005):
+        """Initialize the queue; the writer thread starts on first submit."""
+        super().__init__(batch_size=batch_size, flush_interval=flush_interval)
+
+    def submit(self, message):
+        """Queue an unsaved Message and return a Future resolving to it."""
+        if not self.start():
+            raise RuntimeError('Message write queue has been shut down')
+        future = Future()
+        self._queue.put((message, future))
+        return future
+
+    def finish(self):
+        """Close the writer thread's database connection."""
+        connection.close()
+
+    def write_batch(self, batch):
+        """
+        Insert a batch in one transaction, falling back to per-row inserts on error.
+
+        Other errors fail the whole batch through batch_failed(), so no
+        request is left waiting and the writer thread keeps running.
+        """
+        messages = [message for message, _ in batch]
+        try:
+            close_old_connections()
+            with transaction.atomic():
+                Message.objects.bulk_create(messages)
+                # bulk_create sends no post_save signals
+                record_messages(messages)
+        except DatabaseError:
+            logger.warning('Batch insert of %d messages failed; retrying individually', len(batch))
+            for message, future in batch:
+                try:
+                    with transaction.atomic():
+                        message.save(force_insert=True)
+                except Exception as exc:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(message)
+            return
+
+        for message, future in batch:
+            future.set_result(message)
+
+    def batch_failed(self, batch, exc):
+        """Fail the futures of a batch that raised something other than a DatabaseError."""
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exc)
+
+
+_message_write_queue = None
+_queue_lock = threading.Lock()
+
+
+def is_enabled():
+    """Return True if write coalescing is turned on in settings."""
+    return getattr(settings, 'CHATS_MESSAGE_WRITE_COALESCING', False)
+
+
+def get_message_write_queue():
+    """Return the process-wide message write queue, creating it on first use."""
+    global _message_write_queue
+    with _queue_lock:
+        if _message_write_queue is None:
+            _message_write_queue = MessageWriteQueue(
+                batch_size=getattr(settings, 'CHATS_MESSAGE_WRITE_BATCH_SIZE', 500),
+                flush_interval=getattr(settings, 'CHATS_MESSAGE_WRITE_FLUSH_INTERVAL', 0.005),
+            )
+            atexit.register(_message_write_queue.shutdown)
+        return _message_write_queue
+
+
+def save_message(message):
+    """
+    Persist a new message, coalescing the write when enabled.
+
+    Blocks until the message has been committed and returns it, so callers
+    see the same contract as Message.save(). Raises TimeoutError if a
+    coalesced write is not confirmed within CHATS_MESSAGE_WRITE_TIMEOUT
+    seconds; the message may still be committed afterwards.
+    """
+    if not is_enabled():
+        message.save()
+        return message
+    timeout = getattr(settings, 'CHATS_MESSAGE_WRITE_TIMEOUT', 5)
+    return get_message_write_queue().submit(message).result(timeout)
@@ -0,0 +1,146 @@
+"""
+Management command measuring API latency during a burst of logins.
+
+Runs the ASGI handler in-process with Django's AsyncClient. While a storm of
+concurrent logins hits /api/auth/login/, a probe repeatedly requests the API
+root and records its latency. The storm is run twice:
+
+- inline: password checks run on the shared sync thread, as a sync login
+  view does under ASGI
+- offloaded: password checks run on the bounded password worker pool
+
+The custom chats middleware is left out so the time-of-day and role checks
+do not reject the benchmark requests.
+
+Usage:
+    python manage.py benchmark_login_storm --logins 300 --concurrency 50
+"""
+import asyncio
+import statistics
+import time
+import uuid
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import check_password
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, override_settings
+
+from chats.models import User
+from chats.passwords import password_verifier
+
+BENCHMARK_MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+]
+
+LOGIN_PATH = '/api/auth/login/'
+PROBE_PATH = '/'
+
+
+class InlineVerifier:
+    """Stand-in verifier that hashes on the shared sync thread."""
+
+    async def averify(self, raw_password, encoded, update_hash=None):
+        """Run check_password the way a sync view would under ASGI."""
+        return await sync_to_async(check_password)(raw_password, encoded)
+
+
+class Command(BaseCommand):
+    """Compare API latency during a login storm with and without offloading."""
+
+    help = 'Measure API latency under a login storm'
+
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument(
+            '--logins', type=int, default=200,
+            help='Number of login requests in the storm (default: 200)'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=50,
+            help='Concurrent login requests (default: 50)'
+        )
+
+    def handle(self, *args, **options):
+        """Create a throwaway user, run each scenario and report latencies."""
+        password = uuid.uuid4().hex
+        user = User(
+            username=f'login-storm-{uuid.uuid4().hex[:12]}',
+            email=f'{uuid.uuid4().hex}@benchmark.invalid',
+            first_name='Login',
+            last_name='Storm'
+        )
+        user.set_password(password)
+        user.save()
+        payload = {'username': user.username, 'password': password}
+
+        try:
+            with override_settings(
+                MIDDLEWARE=BENCHMARK_MIDDLEWARE, ALLOWED_HOSTS=['testserver']
+            ):
+                baseline = asyncio.run(self.measure(payload, 0, 1))
+                self.report('no storm', baseline)
+
+                with mock.patch('chats.auth.password_verifier', InlineVerifier()):
+                    inline = asyncio.run(
+                        self.measure(payload, options['logins'], options['concurrency'])
+                    )
+                self.report('inline', inline)
+
+                offloaded = asyncio.run(
+                    self.measure(payload, options['logins'], options['concurrency'])
+                )
+                self.report('offloaded', offloaded)
+                self.stdout.write(f'password pool: {password_verifier.stats()}')
+        finally:
+            user.delete()
+
+    async def measure(self, payload, logins, concurrency):
+        """Run the storm and the probe together; return the results."""
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(concurrency)
+        statuses = []
+        latencies = []
+        done = asyncio.Event()
+
+        async def login():
+            async with semaphore:
+                response = await client.post(
+                    LOGIN_PATH, payload, content_type='application/json'
+                )
+                statuses.append(response.status_code)
+
+        async def probe():
+            # Always take a few samples, even without a storm
+            while not done.is_set() or len(latencies) < 20:
+                started = time.perf_counter()
+                await client.get(PROBE_PATH)
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(0.005)
+
+        started = time.perf_counter()
+        probe_task = asyncio.create_task(probe())
+        await asyncio.gather(*(login() for _ in range(logins)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await probe_task
+        return {
+            'latencies': latencies,
+            'statuses': statuses,
+            'elapsed': elapsed,
+        }
+
+    def report(self, label, result):
+        """Print probe latency percentiles and login outcomes."""
+        cuts = statistics.quantiles(result['latencies'], n=100)
+        statuses = result['statuses']
+        self.stdout.write(
+            f'{label:>10}: probe p50={cuts[49] * 1000:.1f}ms '
+            f'p95={cuts[94] * 1000:.1f}ms p99={cuts[98] * 1000:.1f}ms '
+            f'| logins={len(statuses)} ok={statuses.count(200)} '
+            f'429={statuses.count(429)} in {result["elapsed"]:.2f}s'
+        )
@@ -0,0 +1,166 @@
+"""
+Management command measuring request latency through the custom middleware.
+
+Runs Django's ASGI handler in-process with AsyncClient, the way uvicorn
+drives it, and sends concurrent requests to an async view through the five
+chats middleware classes. Two stacks are compared:
+
+- sync-only: the same classes marked async_capable = False, so Django wraps
+  each one with sync_to_async as it did before they had async paths
+- native: the classes as shipped, running their __acall__ paths
+
+The time-of-day check is pinned to noon, the rate limit is raised out of the
+way and request logs go to a temporary file, so only the middleware overhead
+is measured.
+
+Usage:
+    python manage.py benchmark_middleware_stack --requests 2000 --concurrency 200
+"""
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.test import AsyncClient, override_settings
+from django.urls import path
+
+from chats import middleware
+from chats.ratelimit import LocalRateLimitBackend, RateLimiter
+from chats.request_log import RequestLogWriter
+
+# Under /api/ so every path policy check applies
+BENCHMARK_PATH = '/api/bench/'
+
+
+async def benchmark_view(request):
+    """Answer immediately, so the measured time is the middleware's."""
+    return HttpResponse()
+
+
+urlpatterns = [
+    path(BENCHMARK_PATH.lstrip('/'), benchmark_view),
+]
+
+
+class SyncOnlyRequestLoggingMiddleware(middleware.RequestLoggingMiddleware):
+    """RequestLoggingMiddleware forced onto the sync path."""
+
+    async_capable = False
+
+
+class SyncOnlyRestrictAccessByTimeMiddleware(middleware.RestrictAccessByTimeMiddleware):
+    """RestrictAccessByTimeMiddleware forced onto the sync path."""
+
+    async_capable = False
+
+
+class SyncOnlyOffensiveLanguageMiddleware(middleware.OffensiveLanguageMiddleware):
+    """OffensiveLanguageMiddleware forced onto the sync path."""
+
+    async_capable = False
+
+
+class SyncOnlyRolepermissionMiddleware(middleware.RolepermissionMiddleware):
+    """RolepermissionMiddleware forced onto the sync path."""
+
+    async_capable = False
+
+
+class SyncOnlyRequestMetricsMiddleware(middleware.RequestMetricsMiddleware):
+    """RequestMetricsMiddleware forced onto the sync path."""
+
+    async_capable = False
+
+
+MIDDLEWARE_NAMES = [
+    'RequestLoggingMiddleware',
+    'RestrictAccessByTimeMiddleware',
+    'OffensiveLanguageMiddleware',
+    'RolepermissionMiddleware',
+    'RequestMetricsMiddleware',
+]
+
+STACKS = {
+    'sync-only': [f'{__name__}.SyncOnly{name}' for name in MIDDLEWARE_NAMES],
+    'native': [f'chats.middleware.{name}' for name in MIDDLEWARE_NAMES],
+}
+
+
+class Command(BaseCommand):
+    """Compare latency through sync-only and async-native middleware."""
+
+    help = 'Measure request latency through the chats middleware under ASGI'
+
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument(
+            '--requests', type=int, default=2000,
+            help='Requests per stack (default: 2000)'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=200,
+            help='Concurrent requests (default: 200)'
+        )
+
+    def handle(self, *args, **options):
+        """Run each stack and report latencies."""
+        with tempfile.TemporaryDirectory() as directory:
+            writer = RequestLogWriter(path=os.path.join(directory, 'requests.log'))
+            limiter = RateLimiter(LocalRateLimitBackend(), limit=10 ** 9)
+            fake_datetime = mock.Mock(wraps=datetime)
+            fake_datetime.now.return_value = datetime(2026, 1, 1, 12, 0)
+
+            with mock.patch('chats.middleware.get_request_log_writer', return_value=writer), \
+                    mock.patch('chats.middleware.rate_limiter', limiter), \
+                    mock.patch('chats.middleware.datetime', fake_datetime):
+                for label, stack in STACKS.items():
+                    with override_settings(
+                        MIDDLEWARE=stack, ROOT_URLCONF=__name__, ALLOWED_HOSTS=['testserver']
+                    ):
+                        result = asyncio.run(
+                            self.measure(options['requests'], options['concurrency'])
+                        )
+                    self.report(label, result)
+            writer.shutdown()
+
+    async def measure(self, requests, concurrency):
+        """Send ``requests`` requests, ``concurrency`` at a time; return the results."""
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        statuses = []
+
+        async def send(index):
+            async with semaphore:
+                started = time.perf_counter()
+                if index % 4:
+                    response = await client.get(BENCHMARK_PATH)
+                else:
+                    response = await client.post(BENCHMARK_PATH)
+                latencies.append(time.perf_counter() - started)
+                statuses.append(response.status_code)
+
+        # Warm up the handler and its middleware chain
+        await client.get(BENCHMARK_PATH)
+        started = time.perf_counter()
+        await asyncio.gather(*(send(index) for index in range(requests)))
+        return {
+            'latencies': latencies,
+            'statuses': statuses,
+            'elapsed': time.perf_counter() - started,
+        }
+
+    def report(self, label, result):
+        """Print latency percentiles and throughput."""
+        cuts = statistics.quantiles(result['latencies'], n=100)
+        statuses = result['statuses']
+        self.stdout.write(
+            f'{label:>10}: p50={cuts[49] * 1000:.1f}ms p95={cuts[94] * 1000:.1f}ms '
+            f'p99={cuts[98] * 1000:.1f}ms | {len(statuses) / result["elapsed"]:.0f} req/s '
+            f'ok={statuses.count(200)}/{len(statuses)}'
+        )
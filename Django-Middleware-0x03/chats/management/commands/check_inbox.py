@@ -0,0 +1,49 @@
+"""
+Management command to check the per-user inbox table for drift.
+
+Compares InboxEntry rows with conversations, participants and messages
+without changing anything, and exits with an error if they disagree.
+
+Usage:
+    python manage.py check_inbox
+    python manage.py check_inbox --fix
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from chats.inbox import iter_conversation_batches, plan_conversations, rebuild_conversations
+
+
+class Command(BaseCommand):
+    """Report missing, stale and orphaned InboxEntry rows."""
+
+    help = 'Check the per-user inbox table against conversations and messages'
+
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Conversations checked per query batch (default: 500)'
+        )
+        parser.add_argument(
+            '--fix', action='store_true',
+            help='Rebuild conversations with inconsistent rows'
+        )
+
+    def handle(self, *args, **options):
+        """Check every conversation and summarize the differences."""
+        missing = stale = orphaned = 0
+        for batch in iter_conversation_batches(options['batch_size']):
+            to_create, to_update, to_delete = plan_conversations(batch)
+            missing += len(to_create)
+            stale += len(to_update)
+            orphaned += len(to_delete)
+            if options['fix'] and (to_create or to_update or to_delete):
+                rebuild_conversations(batch)
+
+        summary = f'{missing} missing, {stale} stale, {orphaned} orphaned inbox rows'
+        if not (missing or stale or orphaned):
+            self.stdout.write(self.style.SUCCESS('Inbox is consistent'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'Fixed {summary}'))
+        else:
+            raise CommandError(f'Inbox is inconsistent: {summary}')
@@ -0,0 +1,274 @@
+"""
+Management command to bulk import chat history into chats.Message.
+
+Reads an NDJSON or CSV file (the same columns produced by the transcript
+export), resolves senders and conversations through an in-memory id map and
+inserts rows with bulk_create inside chunked transactions. Rows whose
+message_id already exists are ignored and reported separately from the rows
+actually imported, so a re-run of the same file is safe.
+
+Usage:
+    python manage.py import_messages history.ndjson
+    python manage.py import_messages history.csv --id-map legacy_ids.json
+    python manage.py import_messages history.ndjson --checkpoint import.ckpt
+"""
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from chats.management.readers import detect_format, read_records
+from chats.models import User, Conversation, Message
+from chats.inbox import is_enabled as inbox_enabled, rebuild_conversations
+from chats.recent import recent_messages
+
+
+@contextmanager
+def explicit_sent_at():
+    """
+    Let bulk_create keep the sent_at values set on each message.
+
+    bulk_create would overwrite the imported timestamps with the current time
+    because of auto_now_add, so the flag is switched off for the duration of
+    the block and restored afterwards.
+    """
+    field = Message._meta.get_field('sent_at')
+    auto_now_add = field.auto_now_add
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = auto_now_add
+
+
+def insert_messages(messages, batch_size):
+    """
+    INSERT messages with their own sent_at, ignoring ids that already exist.
+
+    Returns the number of rows inserted. Messages whose id is already stored
+    are left out of the INSERT; ignore_conflicts covers ids inserted by a
+    concurrent import in the meantime.
+    """
+    inserted = 0
+    with explicit_sent_at():
+        for start in range(0, len(messages), batch_size):
+            batch = messages[start:start + batch_size]
+            existing = set(Message.objects.filter(
+                message_id__in=[message.message_id for message in batch]
+            ).values_list('message_id', flat=True))
+            new = [message for message in batch if message.message_id not in existing]
+            Message.objects.bulk_create(new, ignore_conflicts=True)
+            inserted += len(new)
+    return inserted
+
+
+class Command(BaseCommand):
+    """Bulk import messages from an NDJSON or CSV file."""
+
+    help = 'Bulk import messages from an NDJSON or CSV file'
+
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument('path', help='Path to the NDJSON or CSV file')
+        parser.add_argument(
+            '--file-format',
+            choices=['ndjson', 'csv'],
+            help='Input format (defaults to the file extension)'
+        )
+        parser.add_argument(
+            '--id-map',
+            help='JSON file mapping legacy ids: {"users": {...}, "conversations": {...}}'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Rows per bulk_create INSERT statement (default: 5000)'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=50000,
+            help='Rows committed per transaction (default: 50000)'
+        )
+        parser.add_argument(
+            '--offset', type=int,
+            help='Number of input rows to skip before importing'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='File used to record and resume the committed row offset'
+        )
+
+    def handle(self, *args, **options):
+        """Run the import."""
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'File not found: {path}')
+
+        file_format = options['file_format'] or detect_format(path)
+        offset = options['offset']
+        checkpoint = options['checkpoint']
+        if offset is None:
+            offset = self.read_checkpoint(checkpoint)
+
+        user_ids, conversation_ids = self.build_id_maps(options['id_map'])
+
+        imported = duplicates = skipped = errors = 0
+        started = time.monotonic()
+
+        with open(path, newline='', encoding='utf-8') as handle:
+            rows = islice(read_records(handle, file_format), offset, None)
+            while True:
+                chunk = list(islice(rows, options['chunk_size']))
+                if not chunk:
+                    break
+
+                messages = []
+                for number, row in enumerate(chunk, start=offset + 1):
+                    try:
+                        message = self.build_message(row, user_ids, conversation_ids)
+                    except ValueError as exc:
+                        errors += 1
+                        self.stderr.write(f'Row {number}: {exc}')
+                        continue
+                    if message is None:
+                        skipped += 1
+                    else:
+                        messages.append(message)
+
+                with transaction.atomic():
+                    inserted = insert_messages(messages, options['batch_size'])
+
+                # bulk_create sends no signals; refresh derived data explicitly
+                touched = {message.conversation_id for message in messages}
+                for conversation_id in touched:
+                    recent_messages.invalidate(conversation_id)
+                if inbox_enabled() and touched:
+                    rebuild_conversations(touched)
+
+                offset += len(chunk)
+                imported += inserted
+                duplicates += len(messages) - inserted
+                self.write_checkpoint(checkpoint, offset)
+                self.report(imported, duplicates, skipped, errors, offset, started)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported} messages, {duplicates} already present, '
+            f'skipped {skipped}, {errors} malformed '
+            f'({self.rate(imported, started):.0f} rows/s)'
+        ))
+
+    def build_id_maps(self, id_map_path):
+        """
+        Load sender and conversation lookups into memory.
+
+        Existing primary keys and usernames resolve to themselves; entries from
+        the optional id map translate legacy ids to existing primary keys.
+        """
+        user_ids = {}
+        for user_id, username in User.objects.values_list('user_id', 'username').iterator():
+            user_ids[str(user_id)] = user_id
+            user_ids[username] = user_id
+
+        conversation_ids = {
+            str(conversation_id): conversation_id
+            for conversation_id in Conversation.objects.values_list(
+                'conversation_id', flat=True
+            ).iterator()
+        }
+
+        if id_map_path:
+            with open(id_map_path, encoding='utf-8') as handle:
+                id_map = json.load(handle)
+            for legacy_id, user_id in id_map.get('users', {}).items():
+                user_ids[str(legacy_id)] = uuid.UUID(str(user_id))
+            for legacy_id, conversation_id in id_map.get('conversations', {}).items():
+                conversation_ids[str(legacy_id)] = uuid.UUID(str(conversation_id))
+
+        return user_ids, conversation_ids
+
+    def build_message(self, row, user_ids, conversation_ids):
+        """
+        Return an unsaved Message for the row, or None if it cannot be resolved.
+
+        Raises:
+            ValueError: If the row is malformed
+        """
+        if row is None:
+            raise ValueError('not a JSON object')
+        for field in ('message_body', 'sent_at'):
+            if row.get(field) is not None and not isinstance(row[field], str):
+                raise ValueError(f'{field} must be a string')
+
+        sender_id = user_ids.get(str(row.get('sender_id') or row.get('sender_username')))
+        conversation_id = conversation_ids.get(str(row.get('conversation_id')))
+        body = row.get('message_body') or ''
+        if sender_id is None or conversation_id is None or not body.strip():
+            return None
+
+        message = Message(
+            sender_id=sender_id,
+            conversation_id=conversation_id,
+            message_body=body,
+            sent_at=self.parse_sent_at(row.get('sent_at'))
+        )
+        if row.get('message_id'):
+            try:
+                message.message_id = uuid.UUID(str(row['message_id']))
+            except ValueError:
+                raise ValueError(f"invalid message_id {row['message_id']!r}") from None
+        return message
+
+    def parse_sent_at(self, value):
+        """
+        Return the row's timestamp as an aware datetime, or now if it has none.
+
+        Naive timestamps are taken to be in the default time zone.
+
+        Raises:
+            ValueError: If the timestamp cannot be parsed
+        """
+        if not value:
+            return timezone.now()
+        try:
+            sent_at = parse_datetime(value)
+        except ValueError:
+            sent_at = None
+        if sent_at is None:
+            raise ValueError(f'invalid sent_at {value!r}')
+        if timezone.is_naive(sent_at):
+            sent_at = timezone.make_aware(sent_at)
+        return sent_at
+
+    def read_checkpoint(self, checkpoint):
+        """Return the committed offset stored in the checkpoint file, or 0."""
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint, encoding='utf-8') as handle:
+                return int(handle.read().strip() or 0)
+        return 0
+
+    def write_checkpoint(self, checkpoint, offset):
+        """Atomically record the offset of the last committed row."""
+        if not checkpoint:
+            return
+        temporary = f'{checkpoint}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as handle:
+            handle.write(str(offset))
+        os.replace(temporary, checkpoint)
+
+    def rate(self, count, started):
+        """Return rows per second since the import started."""
+        elapsed = time.monotonic() - started
+        return count / elapsed if elapsed else 0.0
+
+    def report(self, imported, duplicates, skipped, errors, offset, started):
+        """Print progress after each committed chunk."""
+        self.stdout.write(
+            f'offset={offset} imported={imported} duplicates={duplicates} '
+            f'skipped={skipped} errors={errors} '
+            f'rate={self.rate(imported, started):.0f} rows/s'
+        )
@@ -0,0 +1,169 @@
+"""
+Management command to bulk provision users from an HR export.
+
+Reads an NDJSON or CSV file with username, email, first_name, last_name,
+password and optional role/phone_number columns. Passwords are hashed in a
+process pool, since each hash costs tens of milliseconds of CPU, and users
+are inserted with bulk_create in chunked transactions. Rows whose username
+or email already exists are ignored and reported separately, and rows with
+missing or non-string fields are skipped as malformed.
+
+Usage:
+    python manage.py provision_users employees.csv
+    python manage.py provision_users employees.ndjson --workers 8
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from chats.management.readers import detect_format, read_records
+from chats.models import User
+
+# Columns copied from each record onto the User
+USER_FIELDS = ['username', 'email', 'first_name', 'last_name', 'phone_number', 'role']
+
+# Columns every record must carry as a non-blank string
+REQUIRED_FIELDS = ['username', 'email', 'first_name', 'last_name']
+
+
+def _init_worker():
+    """Make Django settings available in spawned worker processes."""
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def hash_passwords(passwords):
+    """Hash a list of raw passwords; runs inside a worker process."""
+    return [make_password(password or None) for password in passwords]
+
+
+class Command(BaseCommand):
+    """Bulk create users, hashing passwords in parallel."""
+
+    help = 'Bulk provision users from an NDJSON or CSV file'
+
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument('path', help='Path to the NDJSON or CSV file')
+        parser.add_argument(
+            '--file-format',
+            choices=['ndjson', 'csv'],
+            help='Input format (defaults to the file extension)'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Password hashing processes (default: CPU count)'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Users hashed and committed per transaction (default: 2000)'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Rows per bulk_create INSERT statement (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        """Run the provisioning."""
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'File not found: {path}')
+        file_format = options['file_format'] or detect_format(path)
+        workers = max(1, options['workers'])
+
+        created = ignored = skipped = 0
+        started = time.monotonic()
+
+        with open(path, newline='', encoding='utf-8') as handle, \
+                ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            records = read_records(handle, file_format)
+            while True:
+                chunk = list(islice(records, options['chunk_size']))
+                if not chunk:
+                    break
+
+                valid = [record for record in chunk if self.is_valid(record)]
+                skipped += len(chunk) - len(valid)
+
+                # Split the chunk so every worker gets a share of the hashing
+                size = max(1, -(-len(valid) // workers))
+                slices = [
+                    [record.get('password') for record in valid[start:start + size]]
+                    for start in range(0, len(valid), size)
+                ]
+                hashes = [value for part in pool.map(hash_passwords, slices) for value in part]
+
+                users = [
+                    self.build_user(record, password)
+                    for record, password in zip(valid, hashes)
+                ]
+                with transaction.atomic():
+                    User.objects.bulk_create(
+                        users, batch_size=options['batch_size'], ignore_conflicts=True
+                    )
+                    inserted = self.count_inserted(users)
+
+                created += inserted
+                ignored += len(users) - inserted
+                self.stdout.write(
+                    f'provisioned={created} ignored={ignored} skipped={skipped} '
+                    f'rate={self.rate(created, started):.0f} users/s'
+                )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Provisioned {created} users, ignored {ignored} with an existing '
+            f'username or email, skipped {skipped} malformed '
+            f'({self.rate(created, started):.0f} users/s)'
+        ))
+
+    def is_valid(self, record):
+        """Return True if the record has the fields a User requires, all as strings."""
+        if record is None:
+            return False
+        if not all(
+            isinstance(record.get(field), str) and record[field].strip()
+            for field in REQUIRED_FIELDS
+        ):
+            return False
+        return all(
+            record.get(field) is None or isinstance(record[field], str)
+            for field in USER_FIELDS + ['password']
+        )
+
+    def count_inserted(self, users):
+        """
+        Return how many of the users bulk_create actually inserted.
+
+        ignore_conflicts does not report skipped rows, but every built user
+        carries a freshly salted password hash, so the inserted ones are
+        those whose username now maps to that hash.
+        """
+        if not users:
+            return 0
+        return User.objects.filter(
+            username__in=[user.username for user in users],
+            password__in=[user.password for user in users]
+        ).count()
+
+    def build_user(self, record, password):
+        """Return an unsaved User with an already hashed password."""
+        values = {
+            field: record[field].strip()
+            for field in USER_FIELDS
+            if (record.get(field) or '').strip()
+        }
+        if values.get('role') not in dict(User.ROLE_CHOICES):
+            values.pop('role', None)
+        return User(password=password, **values)
+
+    def rate(self, count, started):
+        """Return users per second since provisioning started."""
+        elapsed = time.monotonic() - started
+        return count / elapsed if elapsed else 0.0
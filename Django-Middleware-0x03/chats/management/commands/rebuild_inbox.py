@@ -0,0 +1,38 @@
+"""
+Management command to rebuild the per-user inbox table.
+
+Recomputes every InboxEntry from conversations, participants and messages in
+batches of conversations, creating missing rows, fixing last message fields
+and deleting rows without a membership. Unread counts are preserved.
+
+Usage:
+    python manage.py rebuild_inbox
+    python manage.py rebuild_inbox --batch-size 200
+"""
+from django.core.management.base import BaseCommand
+
+from chats.inbox import iter_conversation_batches, rebuild_conversations
+
+
+class Command(BaseCommand):
+    """Rebuild InboxEntry rows from source data."""
+
+    help = 'Rebuild the per-user inbox table from conversations and messages'
+
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Conversations rebuilt per transaction (default: 500)'
+        )
+
+    def handle(self, *args, **options):
+        """Rebuild all conversations batch by batch."""
+        totals = [0, 0, 0]
+        for batch in iter_conversation_batches(options['batch_size']):
+            counts = rebuild_conversations(batch)
+            totals = [total + count for total, count in zip(totals, counts)]
+        created, updated, deleted = totals
+        self.stdout.write(self.style.SUCCESS(
+            f'Inbox rebuilt: {created} created, {updated} updated, {deleted} deleted'
+        ))
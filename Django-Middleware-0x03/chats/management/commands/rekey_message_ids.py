@@ -0,0 +1,62 @@
+"""
+Management command to migrate existing uuid4 message ids to UUIDv7.
+
+New rows already get time-ordered ids from chats.models.uuid7. This command
+rewrites the primary key of older messages to a UUIDv7 derived from their
+sent_at timestamp, so the whole table is ordered by primary key and keyset
+pagination can rely on message_id alone. Nothing references Message by
+foreign key, so the primary key can be updated in place.
+
+Usage:
+    python manage.py rekey_message_ids --dry-run
+    python manage.py rekey_message_ids --batch-size 1000
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chats.models import Message, uuid7
+
+
+class Command(BaseCommand):
+    """Rewrite non-UUIDv7 message ids to time-ordered UUIDv7 ids."""
+
+    help = 'Rewrite existing uuid4 message ids to UUIDv7 derived from sent_at'
+
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Rows updated per transaction (default: 1000)'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report how many messages would be re-keyed'
+        )
+
+    def handle(self, *args, **options):
+        """Run the re-keying in batches."""
+        pending = []
+        rekeyed = 0
+        rows = Message.objects.order_by().values_list('message_id', 'sent_at')
+        for message_id, sent_at in rows.iterator(chunk_size=5000):
+            if message_id.version == 7:
+                continue
+            pending.append((message_id, sent_at))
+            if len(pending) >= options['batch_size']:
+                rekeyed += self.rekey(pending, options['dry_run'])
+                pending = []
+        rekeyed += self.rekey(pending, options['dry_run'])
+
+        verb = 'Would re-key' if options['dry_run'] else 'Re-keyed'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {rekeyed} messages'))
+
+    def rekey(self, batch, dry_run):
+        """Update one batch of primary keys in a single transaction."""
+        if dry_run or not batch:
+            return len(batch)
+        with transaction.atomic():
+            for message_id, sent_at in batch:
+                new_id = uuid7(int(sent_at.timestamp() * 1000))
+                Message.objects.filter(message_id=message_id).update(message_id=new_id)
+        self.stdout.write(f'Re-keyed {len(batch)} messages')
+        return len(batch)
@@ -0,0 +1,269 @@
+"""
+Management command replaying request logs against a running instance.
+
+Reads the JSON lines written by RequestLoggingMiddleware, or the older
+"<timestamp> - User: <name> - Path: <path>" lines, and sends the same
+requests to --base-url. By default requests keep their original inter-arrival
+timing; --speedup compresses it (0 sends as fast as --concurrency allows).
+
+Request bodies are not logged, so only GET, HEAD and OPTIONS requests are
+replayed unless --methods says otherwise; other methods are sent with an
+empty JSON body. With --auth logged-users, requests logged for a known user
+carry a freshly minted access token for that user.
+
+The middleware logs query parameters outside its allowlist with their values
+redacted; those parameters are left out of the replayed URL, so the views
+see their defaults instead of the placeholder.
+
+Latency and throughput are reported per path, with id segments folded into
+{id} so e.g. every conversation's message list is counted together.
+
+Usage:
+    python manage.py replay_requests requests.*.log requests.*.log.1
+    python manage.py replay_requests requests.log --speedup 10 --concurrency 200
+    python manage.py replay_requests requests.log --auth logged-users
+"""
+import json
+import re
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qsl, urlencode
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chats.models import User
+from chats.request_log import REDACTED
+
+LEGACY_LINE = re.compile(
+    r'^(?P<time>\d{4}-\d{2}-\d{2}[ T][\d:.]+) - User: (?P<user>.*?) - Path: (?P<path>\S+)\s*$'
+)
+
+ID_SEGMENT = re.compile(
+    r'^(?:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)$',
+    re.IGNORECASE
+)
+
+
+def replayable_query(query):
+    """Return the logged query string without its redacted parameters."""
+    return urlencode([
+        (name, value)
+        for name, value in parse_qsl(query, keep_blank_values=True)
+        if value != REDACTED
+    ])
+
+
+def parse_line(line):
+    """Return a request record from one log line, or None if it is not one."""
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith('{'):
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return None
+        if 'path' not in data or 'time' not in data:
+            # Dropped-record notices and other events
+            return None
+        return {
+            'time': datetime.fromisoformat(data['time']).timestamp(),
+            'user': data.get('user', 'Anonymous'),
+            'method': data.get('method', 'GET'),
+            'path': data['path'],
+            'query': replayable_query(data.get('query', '')),
+        }
+    match = LEGACY_LINE.match(line)
+    if match is None:
+        return None
+    return {
+        'time': datetime.fromisoformat(match['time']).timestamp(),
+        'user': match['user'],
+        'method': 'GET',
+        'path': match['path'],
+        'query': '',
+    }
+
+
+def read_log(paths):
+    """Return the request records of all ``paths`` in time order."""
+    records = []
+    for path in paths:
+        try:
+            with open(path, encoding='utf-8') as handle:
+                records.extend(filter(None, map(parse_line, handle)))
+        except OSError as exc:
+            raise CommandError(f'Cannot read {path}: {exc}')
+    records.sort(key=lambda record: record['time'])
+    return records
+
+
+def path_template(path):
+    """Replace id-like path segments with {id}."""
+    return '/'.join(
+        '{id}' if ID_SEGMENT.match(segment) else segment
+        for segment in path.split('/')
+    )
+
+
+class Command(BaseCommand):
+    """Replay logged requests and report latency per path."""
+
+    help = 'Replay request logs against a running instance'
+
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument('paths', nargs='+', help='Request log files')
+        parser.add_argument(
+            '--base-url', default='http://127.0.0.1:8000',
+            help='Instance to send requests to (default: http://127.0.0.1:8000)'
+        )
+        parser.add_argument(
+            '--speedup', type=float, default=1.0,
+            help='Divide the original gaps by this factor; 0 sends without delay (default: 1)'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=50,
+            help='Maximum requests in flight (default: 50)'
+        )
+        parser.add_argument(
+            '--methods', default='GET,HEAD,OPTIONS',
+            help='Comma-separated methods to replay (default: GET,HEAD,OPTIONS)'
+        )
+        parser.add_argument(
+            '--auth', choices=['none', 'logged-users'], default='none',
+            help='Send requests as the logged users with minted access tokens'
+        )
+        parser.add_argument(
+            '--limit', type=int,
+            help='Replay at most this many requests'
+        )
+        parser.add_argument(
+            '--timeout', type=float, default=10,
+            help='Per-request timeout in seconds (default: 10)'
+        )
+
+    def handle(self, *args, **options):
+        """Load the logs, replay them and print the report."""
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        methods = {method.strip().upper() for method in options['methods'].split(',')}
+        records = [record for record in read_log(options['paths']) if record['method'] in methods]
+        if options['limit'] is not None:
+            records = records[:options['limit']]
+        if not records:
+            raise CommandError('No requests to replay')
+
+        self.base_url = options['base_url'].rstrip('/')
+        self.timeout = options['timeout']
+        self.headers = self.build_auth_headers(records, options['auth'])
+
+        results, elapsed, max_lag = self.replay(
+            records, options['speedup'], options['concurrency']
+        )
+        self.report(results, elapsed, max_lag)
+
+    def build_auth_headers(self, records, mode):
+        """Return {username: headers} for the logged users, if requested."""
+        if mode != 'logged-users':
+            return {}
+        usernames = {record['user'] for record in records} - {'Anonymous'}
+        return {
+            user.username: {'Authorization': f'Bearer {AccessToken.for_user(user)}'}
+            for user in User.objects.filter(username__in=usernames)
+        }
+
+    def replay(self, records, speedup, concurrency):
+        """Send the records on schedule; return (results, elapsed, max lag)."""
+        results = []
+        results_lock = threading.Lock()
+        slots = threading.BoundedSemaphore(concurrency)
+        first = records[0]['time']
+        max_lag = 0.0
+
+        def send(record):
+            try:
+                status, latency = self.send(record)
+                with results_lock:
+                    results.append((path_template(record['path']), status, latency))
+            finally:
+                slots.release()
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for record in records:
+                if speedup > 0:
+                    due = started + (record['time'] - first) / speedup
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                slots.acquire()
+                if speedup > 0:
+                    # How far behind the original schedule the replay has fallen
+                    max_lag = max(max_lag, time.monotonic() - due)
+                executor.submit(send, record)
+        return results, time.monotonic() - started, max_lag
+
+    def send(self, record):
+        """Send one request; return (status, latency in seconds)."""
+        url = self.base_url + record['path']
+        if record['query']:
+            url += '?' + record['query']
+        headers = dict(self.headers.get(record['user'], {}))
+        data = None
+        if record['method'] not in ('GET', 'HEAD', 'OPTIONS'):
+            data = b'{}'
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(url, data=data, headers=headers, method=record['method'])
+
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as exc:
+            exc.read()
+            status = exc.code
+        except (urllib.error.URLError, OSError):
+            status = 'error'
+        return status, time.perf_counter() - started
+
+    def report(self, results, elapsed, max_lag):
+        """Print throughput and latency percentiles per path and overall."""
+        by_path = defaultdict(list)
+        for path, status, latency in results:
+            by_path[path].append((status, latency))
+
+        self.stdout.write(
+            f'{"path":<45} {"count":>6} {"req/s":>8} {"p50ms":>8} {"p95ms":>8} '
+            f'{"p99ms":>8}  statuses'
+        )
+        for path in sorted(by_path, key=lambda path: -len(by_path[path])):
+            self.write_row(path, by_path[path], elapsed)
+        self.write_row('TOTAL', [(status, latency) for _, status, latency in results], elapsed)
+        self.stdout.write(
+            f'Replayed {len(results)} requests in {elapsed:.2f}s; '
+            f'max lag behind schedule {max_lag * 1000:.0f}ms'
+        )
+
+    def write_row(self, label, rows, elapsed):
+        """Print one report line."""
+        latencies = sorted(latency for _, latency in rows)
+        if len(latencies) > 1:
+            cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+            p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+        else:
+            p50 = p95 = p99 = latencies[0]
+        statuses = Counter(str(status) for status, _ in rows)
+        summary = ' '.join(f'{status}={count}' for status, count in sorted(statuses.items()))
+        self.stdout.write(
+            f'{label:<45} {len(rows):>6} {len(rows) / elapsed:>8.1f} '
+            f'{p50 * 1000:>8.1f} {p95 * 1000:>8.1f} {p99 * 1000:>8.1f}  {summary}'
+        )
@@ -0,0 +1,35 @@
+"""Streaming NDJSON/CSV record readers shared by the bulk management commands."""
+import csv
+import json
+import os
+
+from django.core.management.base import CommandError
+
+
+def detect_format(path):
+    """Guess the input format from the file extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.ndjson', '.jsonl'):
+        return 'ndjson'
+    raise CommandError('Cannot detect the file format; pass --file-format')
+
+
+def read_records(handle, file_format):
+    """
+    Yield each input record as a dict without reading the whole file.
+
+    NDJSON lines that are not a JSON object yield None, so callers can count
+    them as bad rows and carry on with the rest of the file.
+    """
+    if file_format == 'csv':
+        yield from csv.DictReader(handle)
+        return
+    for line in handle:
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield record if isinstance(record, dict) else None
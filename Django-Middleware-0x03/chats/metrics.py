@@ -0,0 +1,337 @@
+"""
+In-process latency histograms and a text-format metrics endpoint.
+
+The custom middleware classes are wrapped with timed_middleware(), which
+records the time each one spends on a request excluding the middleware and
+view below it. RequestMetricsMiddleware records the time spent resolving and
+running each view. Both feed fixed-bucket histograms in the process-wide
+``metrics`` registry, and other modules register collectors that report
+their own counters (recent-message cache, password pool, request log).
+
+With several worker processes, set CHATS_METRICS['DIRECTORY']: every worker
+then writes a snapshot there at most every PERSIST_INTERVAL seconds, and the
+endpoint merges the snapshots of all workers. Histograms are summed, and
+collector values are reported per live worker with a ``pid`` label.
+
+    CHATS_METRICS = {
+        'DIRECTORY': None,
+        'PERSIST_INTERVAL': 5,
+        'ALLOWED_IPS': ['127.0.0.1', '::1'],
+    }
+"""
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import monotonic, perf_counter
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; a final +Inf bucket is implied
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """Thread-safe histogram with fixed bucket bounds."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Initialize empty buckets, plus one for values above the last bound."""
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        """Record one value."""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """Return per-bucket counts, the sum and the total count."""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        return {'counts': counts, 'sum': total, 'count': sum(counts)}
+
+
+class MetricsRegistry:
+    """Named histograms with labels, plus collector callbacks."""
+
+    def __init__(self, directory=None, persist_interval=5):
+        """Initialize an empty registry, persisting snapshots to ``directory`` if set."""
+        self.directory = directory
+        self.persist_interval = persist_interval
+        self._lock = threading.Lock()
+        self._help = {}
+        # name -> {sorted label items: Histogram}
+        self._histograms = {}
+        self._collectors = {}
+        self._persisted_at = monotonic()
+
+    def describe(self, name, help_text):
+        """Set the HELP text of a metric family."""
+        self._help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        """Record ``value`` in the histogram for ``name`` and ``labels``."""
+        key = tuple(sorted(labels.items()))
+        family = self._histograms.get(name)
+        histogram = family.get(key) if family is not None else None
+        if histogram is None:
+            with self._lock:
+                family = self._histograms.setdefault(name, {})
+                histogram = family.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    def register_collector(self, name, collect):
+        """Report the numeric values of the dict returned by ``collect()`` as gauges."""
+        self._collectors[name] = collect
+
+    def snapshot(self):
+        """Return this process's histograms and collector values."""
+        with self._lock:
+            families = {name: dict(family) for name, family in self._histograms.items()}
+        histograms = {
+            name: [
+                [[list(item) for item in key], histogram.snapshot()]
+                for key, histogram in family.items()
+            ]
+            for name, family in families.items()
+        }
+        collectors = {}
+        for name, collect in list(self._collectors.items()):
+            try:
+                values = collect()
+            except Exception:
+                logger.exception('Metrics collector %s failed', name)
+                continue
+            collectors[name] = {
+                key: value for key, value in values.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)
+            }
+        return {'pid': os.getpid(), 'histograms': histograms, 'collectors': collectors}
+
+    def persist(self):
+        """Write this process's snapshot to the metrics directory."""
+        if not self.directory:
+            return
+        self._persisted_at = monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'worker-{os.getpid()}.json')
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as handle:
+            json.dump(self.snapshot(), handle)
+        os.replace(temporary, path)
+
+    def maybe_persist(self):
+        """Persist if PERSIST_INTERVAL seconds have passed since the last write."""
+        if self.directory and monotonic() - self._persisted_at >= self.persist_interval:
+            try:
+                self.persist()
+            except OSError:
+                logger.exception('Could not persist metrics snapshot')
+
+    def gather(self):
+        """Return the snapshots of every worker, this process's being current."""
+        own = self.snapshot()
+        if not self.directory:
+            return [own]
+        snapshots = [own]
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if not name.startswith('worker-') or not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as handle:
+                    snapshot = json.load(handle)
+            except (OSError, ValueError):
+                continue
+            if snapshot['pid'] != own['pid']:
+                snapshots.append(snapshot)
+        return snapshots
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        snapshots = self.gather()
+        lines = []
+
+        merged = {}
+        for snapshot in snapshots:
+            for name, series in snapshot['histograms'].items():
+                family = merged.setdefault(name, {})
+                for key, data in series:
+                    key = tuple(tuple(item) for item in key)
+                    total = family.setdefault(
+                        key, {'counts': [0] * len(data['counts']), 'sum': 0.0, 'count': 0}
+                    )
+                    total['counts'] = [a + b for a, b in zip(total['counts'], data['counts'])]
+                    total['sum'] += data['sum']
+                    total['count'] += data['count']
+
+        for name in sorted(merged):
+            if name in self._help:
+                lines.append(f'# HELP {name} {self._help[name]}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, data in sorted(merged[name].items()):
+                cumulative = 0
+                bounds = [repr(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+                for bound, count in zip(bounds, data['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(key + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(key)} {data["sum"]!r}')
+                lines.append(f'{name}_count{format_labels(key)} {data["count"]}')
+
+        live = [snapshot for snapshot in snapshots if pid_is_alive(snapshot['pid'])]
+        gauges = {}
+        for snapshot in live:
+            for collector, values in snapshot['collectors'].items():
+                for field, value in values.items():
+                    gauges.setdefault(f'{collector}_{field}', []).append((snapshot['pid'], value))
+        for name in sorted(gauges):
+            lines.append(f'# TYPE {name} gauge')
+            for pid, value in sorted(gauges[name]):
+                lines.append(f'{name}{format_labels((("pid", str(pid)),))} {value!r}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(items):
+    """Format label pairs as {name="value",...}."""
+    if not items:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in items
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def pid_is_alive(pid):
+    """Return True if a process with ``pid`` exists."""
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists but belongs to another user
+        return True
+    return True
+
+
+def build_metrics_registry():
+    """Create the registry described by the CHATS_METRICS setting."""
+    config = getattr(settings, 'CHATS_METRICS', {})
+    registry = MetricsRegistry(
+        directory=config.get('DIRECTORY'),
+        persist_interval=config.get('PERSIST_INTERVAL', 5),
+    )
+    registry.describe(
+        'chats_middleware_seconds',
+        'Time spent in each custom middleware, excluding the layers below it.'
+    )
+    registry.describe(
+        'chats_view_seconds',
+        'Time spent resolving and running each view.'
+    )
+    if registry.directory:
+        atexit.register(registry.maybe_persist)
+    return registry
+
+
+metrics = build_metrics_registry()
+
+# Time spent below the middleware currently handling the request
+_downstream = ContextVar('chats_middleware_downstream')
+
+
+def timed_middleware(middleware_class):
+    """
+    Class decorator recording a middleware's own time per request.
+
+    The time spent in get_response, i.e. in the middleware and view below,
+    is subtracted, so a short-circuited request is charged entirely to the
+    middleware that answered it. Works for both the sync and async paths.
+    """
+    name = middleware_class.__name__
+    original_init = middleware_class.__init__
+    original_call = middleware_class.__call__
+
+    @functools.wraps(original_init)
+    def __init__(self, get_response):
+        if iscoroutinefunction(get_response):
+            async def timed_get_response(request):
+                started = perf_counter()
+                try:
+                    return await get_response(request)
+                finally:
+                    _downstream.get()[0] += perf_counter() - started
+        else:
+            def timed_get_response(request):
+                started = perf_counter()
+                try:
+                    return get_response(request)
+                finally:
+                    _downstream.get()[0] += perf_counter() - started
+        original_init(self, timed_get_response)
+
+    def observe(started, downstream):
+        metrics.observe(
+            'chats_middleware_seconds',
+            perf_counter() - started - downstream[0],
+            middleware=name
+        )
+
+    async def timed_acall(self, request):
+        downstream = [0.0]
+        token = _downstream.set(downstream)
+        started = perf_counter()
+        try:
+            return await original_call(self, request)
+        finally:
+            _downstream.reset(token)
+            observe(started, downstream)
+
+    @functools.wraps(original_call)
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return timed_acall(self, request)
+        downstream = [0.0]
+        token = _downstream.set(downstream)
+        started = perf_counter()
+        try:
+            return original_call(self, request)
+        finally:
+            _downstream.reset(token)
+            observe(started, downstream)
+
+    middleware_class.__init__ = __init__
+    middleware_class.__call__ = __call__
+    return middleware_class
+
+
+def metrics_view(request):
+    """Serve all metrics as text, to clients listed in ALLOWED_IPS."""
+    allowed = getattr(settings, 'CHATS_METRICS', {}).get('ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if allowed is not None and request.META.get('REMOTE_ADDR') not in allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type=CONTENT_TYPE)
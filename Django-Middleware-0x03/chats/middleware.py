@@ -4,80 +4,153 @@ Custom middleware for the Django Messaging App.
 This module contains middleware classes for:
 1. Logging user requests
 2. Restricting access by time
-3. Rate limiting messages by IP
+3. Rate limiting messages by user or IP
 4. Enforcing role-based permissions
+5. Recording view latency metrics
+
+Which checks apply to a path is configured in CHATS_PATH_POLICIES (see
+chats.policies); paths without a policy pass straight through.
+
+Every class is both sync- and async-capable. Under ASGI, Django calls the
+async path (__acall__) directly instead of adapting each middleware with
+sync_to_async, so a request only leaves the event loop when it needs the
+database, e.g. to load request.user.
 """
 
 import logging
 from datetime import datetime, time
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
 from django.http import JsonResponse
 from django.utils.deprecation import MiddlewareMixin
-from collections import defaultdict
-from time import time as current_time
+from django.utils.functional import SimpleLazyObject, empty
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from time import perf_counter, time as current_time
+
+from .metrics import metrics, timed_middleware
+from .policies import get_policy
+from .ratelimit import rate_limiter
+from .request_log import get_logged_query_params, get_request_log_writer, redact_query
 
 # Configure logger
 logger = logging.getLogger(__name__)
 
 
+async def aget_user(request):
+    """
+    Return request.user from async code.
+    
+    AuthenticationMiddleware sets a lazy user that queries the session and
+    user tables when first touched; that happens on a worker thread here, and
+    only if the user has not been loaded yet.
+    """
+    user = getattr(request, 'user', None)
+    if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+        await sync_to_async(user._setup)()
+    return user
+
+
+@timed_middleware
 class RequestLoggingMiddleware(MiddlewareMixin):
     """
     Middleware to log each user's requests to a file.
     
-    Logs the following information:
+    Logs one JSON record per request with the following information:
     - Timestamp
     - User (username or 'Anonymous')
-    - Request path
+    - Request method, path and query string, with the values of parameters
+      outside CHATS_REQUEST_LOG['QUERY_PARAMS'] redacted
+    - Response status and latency in milliseconds
+    
+    Records are written by the background writer in chats.request_log, so
+    the request thread never touches the file. If the writer falls behind,
+    records are dropped and counted rather than delaying requests.
     """
     
     def __init__(self, get_response):
         """Initialize the middleware."""
-        self.get_response = get_response
-        
-        # Configure file logger
-        file_handler = logging.FileHandler('requests.log')
-        file_handler.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(message)s')
-        file_handler.setFormatter(formatter)
-        
-        # Get or create logger
-        self.logger = logging.getLogger('request_logger')
-        self.logger.setLevel(logging.INFO)
-        
-        # Clear existing handlers and add file handler
-        self.logger.handlers = []
-        self.logger.addHandler(file_handler)
+        super().__init__(get_response)
+        self.writer = get_request_log_writer()
+        self.query_params = get_logged_query_params()
     
     def __call__(self, request):
         """Process the request and log information."""
-        # Get user information
-        user = request.user.username if request.user.is_authenticated else 'Anonymous'
-        
-        # Log request information
-        log_message = f"{datetime.now()} - User: {user} - Path: {request.path}"
-        self.logger.info(log_message)
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not get_policy(request).log:
+            return self.get_response(request)
+        timestamp = current_time()
+        started = perf_counter()
         
         # Process the request
         response = self.get_response(request)
         
+        # Read the user afterwards so view-level (JWT) authentication is seen
+        self.log(request, response, getattr(request, 'user', None), timestamp, started)
+        
+        return response
+    
+    async def __acall__(self, request):
+        """Async version of __call__."""
+        if not get_policy(request).log:
+            return await self.get_response(request)
+        timestamp = current_time()
+        started = perf_counter()
+        
+        response = await self.get_response(request)
+        
+        self.log(request, response, await aget_user(request), timestamp, started)
+        
         return response
+    
+    def log(self, request, response, user, timestamp, started):
+        """Queue the log record for a finished request."""
+        self.writer.emit({
+            'timestamp': timestamp,
+            'user': user.username if user is not None and user.is_authenticated else 'Anonymous',
+            'method': request.method,
+            'path': request.path,
+            'query': redact_query(request.META.get('QUERY_STRING', ''), self.query_params),
+            'status': response.status_code,
+            'duration_ms': round((perf_counter() - started) * 1000, 3),
+        })
 
 
+@timed_middleware
 class RestrictAccessByTimeMiddleware(MiddlewareMixin):
     """
     Middleware to restrict access to the messaging app during certain hours.
     
     Access is denied outside the hours of 9 AM to 6 PM.
     Returns 403 Forbidden error if accessed outside allowed hours.
+    Only applies to paths whose policy sets restrict_hours.
     """
     
     def __init__(self, get_response):
         """Initialize the middleware."""
-        self.get_response = get_response
+        super().__init__(get_response)
         self.start_time = time(9, 0)  # 9:00 AM
         self.end_time = time(18, 0)   # 6:00 PM (6 PM)
     
     def __call__(self, request):
         """Check if current time is within allowed hours."""
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        
+        # Process the request if within allowed hours
+        return self.check_access(request) or self.get_response(request)
+    
+    async def __acall__(self, request):
+        """Async version of __call__."""
+        return self.check_access(request) or await self.get_response(request)
+    
+    def check_access(self, request):
+        """Return a 403 response outside the allowed hours, else None."""
+        if not get_policy(request).restrict_hours:
+            return None
+        
         # Get current time
         current_hour = datetime.now().time()
         
@@ -89,64 +162,98 @@ class RestrictAccessByTimeMiddleware(MiddlewareMixin):
                 'current_time': datetime.now().strftime('%H:%M:%S'),
                 'allowed_hours': '09:00 AM - 06:00 PM'
             }, status=403)
-        
-        # Process the request if within allowed hours
-        response = self.get_response(request)
-        
-        return response
+        return None
 
 
+@timed_middleware
 class OffensiveLanguageMiddleware(MiddlewareMixin):
     """
     Middleware to limit the number of chat messages a user can send within a time window.
     
-    Implements rate limiting based on IP address:
-    - Maximum 5 messages per minute per IP address
-    - Tracks POST requests to message endpoints
-    - Returns 429 Too Many Requests if limit exceeded
+    Implements sliding-window rate limiting (see chats.ratelimit):
+    - Maximum 5 messages per minute by default (CHATS_RATE_LIMIT setting)
+    - Limits are keyed by user when the request is authenticated, else by IP
+    - Tracks POST requests to paths whose policy sets rate_limit
+    - Returns 429 Too Many Requests with Retry-After if limit exceeded
     """
     
-    # Class-level storage for request tracking
-    # Format: {ip_address: [(timestamp1, request_count), (timestamp2, request_count), ...]}
-    request_tracking = defaultdict(list)
-    
-    # Rate limit configuration
-    MAX_REQUESTS = 5  # Maximum number of requests
-    TIME_WINDOW = 60  # Time window in seconds (1 minute)
-    
     def __init__(self, get_response):
         """Initialize the middleware."""
-        self.get_response = get_response
+        super().__init__(get_response)
+        self.limiter = rate_limiter
+        self.key_mode = getattr(settings, 'CHATS_RATE_LIMIT', {}).get('KEY', 'user_or_ip')
     
     def __call__(self, request):
-        """Track and limit POST requests from each IP address."""
+        """Track and limit POST requests from each user or IP address."""
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        
         # Only track POST requests (messages)
-        if request.method == 'POST':
-            # Get client IP address
-            ip_address = self.get_client_ip(request)
-            
-            # Get current timestamp
-            now = current_time()
-            
-            # Clean up old entries outside the time window
-            self.cleanup_old_entries(ip_address, now)
-            
-            # Check if user has exceeded the rate limit
-            if self.is_rate_limited(ip_address, now):
-                return JsonResponse({
-                    'error': 'Rate limit exceeded',
-                    'message': f'You can only send {self.MAX_REQUESTS} messages per minute. Please try again later.',
-                    'retry_after': '60 seconds'
-                }, status=429)
-            
-            # Add current request to tracking
-            self.request_tracking[ip_address].append(now)
+        if request.method == 'POST' and get_policy(request).rate_limit:
+            key = self.get_rate_limit_key(request, getattr(request, 'user', None))
+            allowed, retry_after = self.limiter.hit(key)
+            if not allowed:
+                return self.rate_limited_response(retry_after)
         
         # Process the request
         response = self.get_response(request)
         
         return response
     
+    async def __acall__(self, request):
+        """Async version of __call__."""
+        if request.method == 'POST' and get_policy(request).rate_limit:
+            key = self.get_rate_limit_key(request, await aget_user(request))
+            allowed, retry_after = await self.limiter.ahit(key)
+            if not allowed:
+                return self.rate_limited_response(retry_after)
+        
+        return await self.get_response(request)
+    
+    def rate_limited_response(self, retry_after):
+        """Return the 429 response for a rejected request."""
+        response = JsonResponse({
+            'error': 'Rate limit exceeded',
+            'message': (
+                f'You can only send {self.limiter.limit} messages per '
+                f'{self.limiter.window} seconds. Please try again later.'
+            ),
+            'retry_after': f'{retry_after} seconds'
+        }, status=429)
+        response['Retry-After'] = str(retry_after)
+        return response
+    
+    def get_rate_limit_key(self, request, user):
+        """Return the key requests are counted under, according to the KEY setting."""
+        if self.key_mode != 'ip':
+            user_id = self.get_user_id(request, user)
+            if user_id is not None:
+                return f'user:{user_id}'
+        return f'ip:{self.get_client_ip(request)}'
+    
+    def get_user_id(self, request, user):
+        """
+        Return the requesting user's id, or None for anonymous requests.
+        
+        DRF authenticates JWT requests inside the view, after this middleware
+        runs, so the bearer token is validated here without a database query.
+        """
+        if user is not None and user.is_authenticated:
+            return user.pk
+        authentication = JWTAuthentication()
+        header = authentication.get_header(request)
+        if header is None:
+            return None
+        try:
+            raw_token = authentication.get_raw_token(header)
+            if raw_token is None:
+                return None
+            token = authentication.get_validated_token(raw_token)
+        except AuthenticationFailed:
+            # Malformed or invalid tokens are limited by IP
+            return None
+        return token.get(jwt_settings.USER_ID_CLAIM)
+    
     def get_client_ip(self, request):
         """Extract the client's IP address from the request."""
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
@@ -155,81 +262,111 @@ class OffensiveLanguageMiddleware(MiddlewareMixin):
         else:
             ip = request.META.get('REMOTE_ADDR')
         return ip
-    
-    def cleanup_old_entries(self, ip_address, current_timestamp):
-        """Remove entries older than the time window."""
-        if ip_address in self.request_tracking:
-            # Keep only entries within the time window
-            cutoff_time = current_timestamp - self.TIME_WINDOW
-            self.request_tracking[ip_address] = [
-                timestamp for timestamp in self.request_tracking[ip_address]
-                if timestamp > cutoff_time
-            ]
-    
-    def is_rate_limited(self, ip_address, current_timestamp):
-        """Check if the IP address has exceeded the rate limit."""
-        if ip_address not in self.request_tracking:
-            return False
-        
-        # Count requests within the time window
-        request_count = len(self.request_tracking[ip_address])
-        
-        return request_count >= self.MAX_REQUESTS
 
 
+@timed_middleware
 class RolepermissionMiddleware(MiddlewareMixin):
     """
     Middleware to enforce role-based permissions.
     
-    Checks if the user has admin or moderator role before allowing access.
+    Checks if the user has one of the roles listed in the path's policy
+    (admin or moderator for the users, conversations and messages APIs).
     Returns 403 Forbidden if user doesn't have required permissions.
     """
     
-    # Paths that require admin/moderator role
-    PROTECTED_PATHS = [
-        '/api/users/',
-        '/api/conversations/',
-        '/api/messages/',
-    ]
-    
-    # Allowed roles
-    ALLOWED_ROLES = ['admin', 'moderator']
-    
     def __init__(self, get_response):
         """Initialize the middleware."""
-        self.get_response = get_response
+        super().__init__(get_response)
     
     def __call__(self, request):
         """Check user role before allowing access to protected paths."""
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        
         # Check if the request path requires role checking
-        if self.is_protected_path(request.path):
-            # Check if user is authenticated
-            if not request.user.is_authenticated:
-                return JsonResponse({
-                    'error': 'Authentication required',
-                    'message': 'You must be logged in to access this resource.'
-                }, status=401)
-            
-            # Check if user has the required role
-            user_role = getattr(request.user, 'role', None)
-            
-            if user_role not in self.ALLOWED_ROLES:
-                return JsonResponse({
-                    'error': 'Permission denied',
-                    'message': 'Access restricted to admin and moderator roles only.',
-                    'your_role': user_role or 'guest',
-                    'required_roles': self.ALLOWED_ROLES
-                }, status=403)
+        roles = get_policy(request).roles
+        if roles is not None:
+            denied = self.check_role(request.user, roles)
+            if denied is not None:
+                return denied
+        
+        # Process the request
+        response = self.get_response(request)
+        
+        return response
+    
+    async def __acall__(self, request):
+        """Async version of __call__."""
+        roles = get_policy(request).roles
+        if roles is not None:
+            denied = self.check_role(await aget_user(request), roles)
+            if denied is not None:
+                return denied
+        
+        return await self.get_response(request)
+    
+    def check_role(self, user, roles):
+        """Return a 401 or 403 response if ``user`` lacks one of ``roles``, else None."""
+        # Check if user is authenticated
+        if not user.is_authenticated:
+            return JsonResponse({
+                'error': 'Authentication required',
+                'message': 'You must be logged in to access this resource.'
+            }, status=401)
+        
+        # Check if user has the required role
+        user_role = getattr(user, 'role', None)
+        
+        if user_role not in roles:
+            return JsonResponse({
+                'error': 'Permission denied',
+                'message': f'Access restricted to {" and ".join(roles)} roles only.',
+                'your_role': user_role or 'guest',
+                'required_roles': list(roles)
+            }, status=403)
+        return None
+
+
+class RequestMetricsMiddleware(MiddlewareMixin):
+    """
+    Middleware to record how long each view takes.
+    
+    Placed last in MIDDLEWARE, so the time covers URL resolution and the
+    view itself. Observations go to the chats_view_seconds histogram,
+    labelled by view name and method.
+    """
+    
+    def __init__(self, get_response):
+        """Initialize the middleware."""
+        super().__init__(get_response)
+    
+    def __call__(self, request):
+        """Time the view and record it in the metrics registry."""
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = perf_counter()
         
         # Process the request
         response = self.get_response(request)
         
+        self.observe(request, started)
+        
+        return response
+    
+    async def __acall__(self, request):
+        """Async version of __call__."""
+        started = perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, started)
         return response
     
-    def is_protected_path(self, path):
-        """Check if the path requires role-based protection."""
-        # Check if path starts with any protected path
-        for protected_path in self.PROTECTED_PATHS:
-            if path.startswith(protected_path):
-                return True
-        return False
+    def observe(self, request, started):
+        """Record the view's duration."""
+        match = getattr(request, 'resolver_match', None)
+        metrics.observe(
+            'chats_view_seconds',
+            perf_counter() - started,
+            view=match.view_name if match is not None else '<unresolved>',
+            method=request.method
+        )
+        metrics.maybe_persist()
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-19 08:50
+
+import chats.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0003_alter_user_password'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversation',
+            name='conversation_id',
+            field=models.UUIDField(db_index=True, default=chats.models.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='message_id',
+            field=models.UUIDField(db_index=True, default=chats.models.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='user_id',
+            field=models.UUIDField(db_index=True, default=chats.models.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+    ]
@@ -1,14 +1,58 @@
 """Models for the messaging application."""
+import os
+import threading
+import time
 import uuid
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 
+_uuid7_lock = threading.Lock()
+_uuid7_last = [0, 0]  # [last timestamp in ms, counter within that ms]
+
+
+def uuid7(timestamp_ms=None):
+    """
+    Return a time-ordered UUID (version 7, RFC 9562).
+
+    The first 48 bits hold the Unix timestamp in milliseconds, so new keys
+    are appended at the end of the clustered index instead of scattered
+    across it like uuid4. A 12-bit counter keeps ids generated within the
+    same millisecond in this process monotonic.
+
+    Pass ``timestamp_ms`` to derive an id from a historic timestamp.
+    """
+    if timestamp_ms is None:
+        with _uuid7_lock:
+            timestamp_ms = time.time_ns() // 1_000_000
+            last_ms, counter = _uuid7_last
+            if timestamp_ms <= last_ms:
+                timestamp_ms = last_ms
+                counter += 1
+                if counter > 0xFFF:
+                    timestamp_ms += 1
+                    counter = 0
+            else:
+                counter = int.from_bytes(os.urandom(2), 'big') & 0x7FF
+            _uuid7_last[:] = [timestamp_ms, counter]
+    else:
+        counter = int.from_bytes(os.urandom(2), 'big') & 0xFFF
+
+    rand_b = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    value = (
+        (timestamp_ms & ((1 << 48) - 1)) << 80
+        | 0x7 << 76
+        | counter << 64
+        | 0b10 << 62
+        | rand_b
+    )
+    return uuid.UUID(int=value)
+
 
 class User(AbstractUser):
     """Custom user model extending Django's AbstractUser."""
     user_id = models.UUIDField(
         primary_key=True,
-        default=uuid.uuid4,
+        default=uuid7,
         editable=False,
         db_index=True
     )
@@ -39,7 +83,7 @@ class Conversation(models.Model):
     """Conversation model to track user conversations."""
     conversation_id = models.UUIDField(
         primary_key=True,
-        default=uuid.uuid4,
+        default=uuid7,
         editable=False,
         db_index=True
     )
@@ -53,12 +97,49 @@ class Conversation(models.Model):
         """Return string representation."""
         return f"Conversation {self.conversation_id}"
 
+    def has_participant(self, user):
+        """Check membership with an indexed lookup instead of loading all participants."""
+        return Conversation.participants.through.objects.filter(
+            conversation_id=self.pk,
+            user_id=user.pk
+        ).exists()
+
+    def add_participants(self, user_ids):
+        """
+        Add existing users to the conversation with one bulk insert.
+
+        Cost is proportional to the number of ids given, not the size of the
+        conversation. Unknown ids and existing members are ignored. Returns
+        the ids of the users that exist.
+        """
+        through = Conversation.participants.through
+        existing_ids = list(
+            User.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True)
+        )
+        through.objects.bulk_create(
+            [through(conversation_id=self.pk, user_id=user_id) for user_id in existing_ids],
+            ignore_conflicts=True
+        )
+        from .inbox import add_members
+        add_members(self.pk, existing_ids)
+        return existing_ids
+
+    def remove_participants(self, user_ids):
+        """Remove users from the conversation; returns the number removed."""
+        deleted, _ = Conversation.participants.through.objects.filter(
+            conversation_id=self.pk,
+            user_id__in=user_ids
+        ).delete()
+        from .inbox import remove_members
+        remove_members(self.pk, user_ids)
+        return deleted
+
 
 class Message(models.Model):
     """Message model for chat messages."""
     message_id = models.UUIDField(
         primary_key=True,
-        default=uuid.uuid4,
+        default=uuid7,
         editable=False,
         db_index=True
     )
@@ -82,3 +163,52 @@ class Message(models.Model):
     def __str__(self):
         """Return string representation."""
         return f"Message from {self.sender} at {self.sent_at}"
+
+
+class InboxEntry(models.Model):
+    """
+    Per-user inbox row, one per (user, conversation) membership.
+
+    Maintained on write by chats.inbox so a user's conversation list is a
+    single indexed range read instead of a join over conversations,
+    participants and messages.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='inbox_entries'
+    )
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='inbox_entries'
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=100, blank=True, default='')
+    last_sender = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        """Meta options for InboxEntry model."""
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'conversation'],
+                name='unique_inbox_entry'
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', '-last_message_at'],
+                name='inbox_user_recent_idx'
+            ),
+        ]
+
+    def __str__(self):
+        """Return string representation."""
+        return f"Inbox entry for {self.user_id} in {self.conversation_id}"
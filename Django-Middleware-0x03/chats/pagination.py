@@ -1,13 +1,184 @@
 """Custom pagination classes for the messaging application."""
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models.query import QuerySet
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 
 
+def estimate_count(queryset):
+    """
+    Estimate the number of rows a queryset returns from database statistics.
+
+    Unfiltered querysets use the table row estimate; filtered querysets use
+    the query planner's estimate from EXPLAIN on PostgreSQL and MySQL.
+    Returns None when no estimate is available (e.g. SQLite).
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    queryset = queryset.order_by()
+
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                    [table]
+                )
+            elif connection.vendor == 'mysql':
+                cursor.execute(
+                    'SELECT TABLE_ROWS FROM information_schema.TABLES '
+                    'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+                    [table]
+                )
+            else:
+                return None
+            row = cursor.fetchone()
+            return int(row[0]) if row and row[0] is not None and row[0] >= 0 else None
+
+        if connection.vendor == 'postgresql':
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+
+        if connection.vendor == 'mysql':
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute(f'EXPLAIN {sql}', params)
+            columns = [column[0].lower() for column in cursor.description]
+            return mysql_plan_rows([dict(zip(columns, row)) for row in cursor.fetchall()])
+
+    return None
+
+
+def mysql_plan_rows(plan):
+    """
+    Return the row estimate of a MySQL EXPLAIN result, or None.
+
+    The estimate is the product of rows x filtered% over the tables of the
+    outer SELECT, which is how MySQL sizes the join's output.
+    """
+    estimate = None
+    for row in plan:
+        if str(row.get('id')) != '1' or row.get('rows') is None:
+            continue
+        rows = float(row['rows']) * float(row.get('filtered') or 100) / 100
+        estimate = rows if estimate is None else estimate * rows
+    return int(estimate) if estimate is not None else None
+
+
+class ApproximatePage(Page):
+    """
+    Page of an approximately counted queryset.
+
+    Whether another page follows is known from one extra row fetched with
+    the page, not from the count, which may be a lower bound or an estimate.
+    """
+
+    def __init__(self, object_list, number, paginator, has_more):
+        super().__init__(object_list, number, paginator)
+        self.has_more = has_more
+
+    def has_next(self):
+        return self.has_more
+
+    def end_index(self):
+        return (self.number - 1) * self.paginator.per_page + len(self)
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Paginator that avoids an exact COUNT(*) over large querysets.
+
+    Counts up to APPROXIMATE_COUNT_THRESHOLD rows exactly with a bounded
+    count query. Above the threshold it uses database statistics, and sets
+    is_approximate; without statistics the bounded count itself is used as
+    a lower bound, so a large queryset is never counted in full. Counts are
+    cached for COUNT_CACHE_TIMEOUT seconds.
+    """
+
+    APPROXIMATE_COUNT_THRESHOLD = 10000
+    COUNT_CACHE_TIMEOUT = 30
+
+    is_approximate = False
+
+    def get_count_cache_key(self, queryset):
+        """Return a cache key identifying the queryset's SQL and parameters."""
+        sql, params = queryset.order_by().query.sql_with_params()
+        digest = hashlib.md5(repr((sql, params)).encode(), usedforsecurity=False)
+        return f'chats:count:{digest.hexdigest()}'
+
+    def compute_count(self, queryset):
+        """Return a (count, is_approximate) pair for the queryset."""
+        bounded = queryset[:self.APPROXIMATE_COUNT_THRESHOLD + 1].count()
+        if bounded <= self.APPROXIMATE_COUNT_THRESHOLD:
+            return bounded, False
+
+        estimate = estimate_count(queryset)
+        if estimate is None:
+            return bounded, True
+        return max(estimate, bounded), True
+
+    @cached_property
+    def count(self):
+        """Return the exact or approximate number of objects."""
+        if not isinstance(self.object_list, QuerySet):
+            return super().count
+
+        cache_key = self.get_count_cache_key(self.object_list)
+        cached = cache.get(cache_key)
+        if cached is None:
+            cached = self.compute_count(self.object_list)
+            cache.set(cache_key, cached, self.COUNT_CACHE_TIMEOUT)
+
+        count, self.is_approximate = cached
+        return count
+
+    def validate_number(self, number):
+        """Skip the upper-bound check when the count is only approximate."""
+        if self.count == 0 or not self.is_approximate:
+            return super().validate_number(number)
+        try:
+            if isinstance(number, float) and not number.is_integer():
+                raise ValueError
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_('That page number is not an integer'))
+        if number < 1:
+            raise EmptyPage(_('That page number is less than 1'))
+        return number
+
+    def page(self, number):
+        """
+        Return a page, slicing by page size alone when the count is approximate.
+
+        An approximate page fetches one row more than it shows, to tell
+        whether a next page exists.
+        """
+        number = self.validate_number(number)
+        if not self.is_approximate:
+            return super().page(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        return ApproximatePage(
+            rows[:self.per_page], number, self, has_more=len(rows) > self.per_page
+        )
+
+
 class MessagePagination(PageNumberPagination):
     """
     Custom pagination for messages.
     Returns 20 messages per page by default.
     """
+    django_paginator_class = ApproximateCountPaginator
     page_size = 20
     page_size_query_param = 'page_size'
     max_page_size = 100
@@ -17,6 +188,7 @@ class MessagePagination(PageNumberPagination):
         """Return paginated response with page.paginator.count."""
         return Response({
             'count': self.page.paginator.count,
+            'count_is_approximate': self.page.paginator.is_approximate,
             'next': self.get_next_link(),
             'previous': self.get_previous_link(),
             'results': data
@@ -28,6 +200,7 @@ class ConversationPagination(PageNumberPagination):
     Custom pagination for conversations.
     Returns 10 conversations per page by default.
     """
+    django_paginator_class = ApproximateCountPaginator
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = 50
@@ -37,6 +210,29 @@ class ConversationPagination(PageNumberPagination):
         """Return paginated response with page.paginator.count."""
         return Response({
             'count': self.page.paginator.count,
+            'count_is_approximate': self.page.paginator.is_approximate,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data
+        })
+
+
+class ParticipantPagination(PageNumberPagination):
+    """
+    Custom pagination for conversation participants.
+    Returns 50 participants per page by default.
+    """
+    django_paginator_class = ApproximateCountPaginator
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    page_query_param = 'page'
+    
+    def get_paginated_response(self, data):
+        """Return paginated response with page.paginator.count."""
+        return Response({
+            'count': self.page.paginator.count,
+            'count_is_approximate': self.page.paginator.is_approximate,
             'next': self.get_next_link(),
             'previous': self.get_previous_link(),
             'results': data
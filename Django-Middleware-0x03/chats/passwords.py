@@ -0,0 +1,127 @@
+"""
+Bounded worker pool for password verification.
+
+Each PBKDF2 verification costs tens of milliseconds of CPU. Running them on
+a small dedicated pool keeps a burst of logins from occupying the threads
+that serve the rest of the API, and the bounded number of pending
+verifications gives backpressure instead of an ever-growing backlog.
+
+Like ModelBackend, a correct password stored with an outdated hasher or
+iteration count is rehashed. The new hash is computed on the pool, and the
+caller's update_hash callback stores it outside the pool.
+"""
+import asyncio
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+
+from .metrics import metrics
+
+
+class PasswordVerifierSaturated(Exception):
+    """Raised when too many password verifications are already pending."""
+
+
+def check_and_rehash(raw_password, encoded):
+    """
+    Check a password against its hash.
+
+    Returns:
+        Tuple of (matches, new hash if the stored one should be upgraded, else None)
+    """
+    upgraded = None
+
+    def setter(raw):
+        nonlocal upgraded
+        upgraded = make_password(raw)
+
+    return check_password(raw_password, encoded, setter), upgraded
+
+
+class PasswordVerifier:
+    """
+    Run password checks on a fixed-size thread pool.
+
+    hashlib releases the GIL while hashing, so threads give real parallelism
+    here. At most ``max_pending`` checks may be queued or running at once;
+    further submissions raise PasswordVerifierSaturated immediately.
+    """
+
+    def __init__(self, max_workers=4, max_pending=64):
+        """Create the pool; threads are started lazily by the executor."""
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='chats-password'
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._peak_pending = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def submit(self, raw_password, encoded):
+        """Schedule a check and return a Future resolving to check_and_rehash()'s result."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise PasswordVerifierSaturated()
+
+        with self._lock:
+            self._pending += 1
+            self._peak_pending = max(self._peak_pending, self._pending)
+
+        future = self._executor.submit(check_and_rehash, raw_password, encoded)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        """Free the slot held by a finished check."""
+        with self._lock:
+            self._pending -= 1
+            self._completed += 1
+        self._slots.release()
+
+    def verify(self, raw_password, encoded, update_hash=None):
+        """
+        Check a password, blocking the calling thread until it is done.
+
+        ``update_hash`` is called with the upgraded hash when a correct
+        password's stored hash is outdated.
+        """
+        matches, upgraded = self.submit(raw_password, encoded).result()
+        if upgraded is not None and update_hash is not None:
+            update_hash(upgraded)
+        return matches
+
+    async def averify(self, raw_password, encoded, update_hash=None):
+        """Check a password without blocking the event loop; ``update_hash`` may be async."""
+        matches, upgraded = await asyncio.wrap_future(self.submit(raw_password, encoded))
+        if upgraded is not None and update_hash is not None:
+            result = update_hash(upgraded)
+            if inspect.isawaitable(result):
+                await result
+        return matches
+
+    def stats(self):
+        """Return queue depth and throughput counters."""
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'peak_pending': self._peak_pending,
+                'completed': self._completed,
+                'rejected': self._rejected,
+            }
+
+
+password_verifier = PasswordVerifier(
+    max_workers=getattr(settings, 'CHATS_PASSWORD_WORKERS', 4),
+    max_pending=getattr(settings, 'CHATS_PASSWORD_MAX_PENDING', 64),
+)
+metrics.register_collector('chats_password_verifier', password_verifier.stats)
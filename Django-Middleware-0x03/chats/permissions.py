@@ -1,4 +1,6 @@
 """Custom permission classes for the messaging application."""
+import uuid
+
 from rest_framework import permissions
 
 
@@ -35,15 +37,15 @@ class IsParticipantOfConversation(permissions.BasePermission):
         if isinstance(obj, Message):
             # Check if user is participant for all methods including PUT, PATCH, DELETE
             if request.method in ['PUT', 'PATCH', 'DELETE']:
-                return request.user in obj.conversation.participants.all()
-            return request.user in obj.conversation.participants.all()
+                return obj.conversation.has_participant(request.user)
+            return obj.conversation.has_participant(request.user)
         
         # If the object is a Conversation, check participants directly
         if isinstance(obj, Conversation):
             # Check if user is participant for all methods including PUT, PATCH, DELETE
             if request.method in ['PUT', 'PATCH', 'DELETE']:
-                return request.user in obj.participants.all()
-            return request.user in obj.participants.all()
+                return obj.has_participant(request.user)
+            return obj.has_participant(request.user)
         
         return False
 
@@ -121,3 +123,43 @@ class IsAdminOrOwner(permissions.BasePermission):
             return obj.sender == request.user
         
         return False
+
+
+class CanManageParticipants(permissions.BasePermission):
+    """
+    Custom permission limiting who may change a conversation's members.
+    
+    Any participant may list the members and leave the conversation;
+    adding members or removing anyone else is limited to hosts, admins and
+    staff. Use together with IsParticipantOfConversation.
+    """
+    
+    message = "Only hosts and admins can add or remove other participants."
+    
+    MANAGER_ROLES = ('host', 'admin')
+    
+    def has_permission(self, request, view):
+        """
+        Check if user is authenticated.
+        """
+        return request.user and request.user.is_authenticated
+    
+    def has_object_permission(self, request, view, obj):
+        """
+        Allow reads and self-removal to everyone, other changes to managers.
+        """
+        if request.method in permissions.SAFE_METHODS:
+            return True
+        if request.user.role in self.MANAGER_ROLES or request.user.is_staff:
+            return True
+        return request.method == 'DELETE' and self.removes_only_self(request)
+    
+    def removes_only_self(self, request):
+        """Return True if the request's user_ids name only the requesting user."""
+        user_ids = request.data.get('user_ids') if hasattr(request.data, 'get') else None
+        if not isinstance(user_ids, list) or not user_ids:
+            return False
+        try:
+            return {uuid.UUID(str(user_id)) for user_id in user_ids} == {request.user.pk}
+        except ValueError:
+            return False
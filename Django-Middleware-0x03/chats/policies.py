@@ -0,0 +1,115 @@
+"""
+Path policy table shared by the chats middleware.
+
+CHATS_PATH_POLICIES maps path prefixes to the checks that apply below them:
+
+    CHATS_PATH_POLICIES = {
+        '/api/': {'log': True, 'restrict_hours': True, 'rate_limit': True},
+        '/api/users/': {'roles': ['admin', 'moderator']},
+    }
+
+A prefix inherits the settings of the longest configured prefix above it and
+overrides the keys it sets. Paths matching no prefix get no checks at all.
+
+The table is compiled once into a trie of path segments. The first
+middleware to see a request classifies its path with one walk down the trie
+and attaches the result as ``request.chats_policy``; every later middleware
+reads its flag from there.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+class PathPolicy:
+    """The checks that apply to a path."""
+
+    __slots__ = ('log', 'restrict_hours', 'rate_limit', 'roles')
+
+    FIELDS = __slots__
+
+    def __init__(self, log=False, restrict_hours=False, rate_limit=False, roles=None):
+        """Set the flags; ``roles`` lists the roles allowed, or None for any user."""
+        self.log = log
+        self.restrict_hours = restrict_hours
+        self.rate_limit = rate_limit
+        self.roles = tuple(roles) if roles is not None else None
+
+    def merged(self, overrides):
+        """Return a copy with the keys in ``overrides`` replaced."""
+        unknown = set(overrides) - set(self.FIELDS)
+        if unknown:
+            raise ImproperlyConfigured(
+                f'Unknown path policy keys: {", ".join(sorted(unknown))}'
+            )
+        values = {field: getattr(self, field) for field in self.FIELDS}
+        values.update(overrides)
+        return PathPolicy(**values)
+
+    def __eq__(self, other):
+        """Compare policies field by field."""
+        if not isinstance(other, PathPolicy):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.FIELDS)
+
+    def __repr__(self):
+        """Return a readable representation."""
+        values = ', '.join(f'{field}={getattr(self, field)!r}' for field in self.FIELDS)
+        return f'PathPolicy({values})'
+
+
+NO_POLICY = PathPolicy()
+
+
+def split_path(path):
+    """Return the non-empty segments of a URL path."""
+    return [segment for segment in path.split('/') if segment]
+
+
+class PathPolicyTable:
+    """Longest-prefix lookup of path policies over a segment trie."""
+
+    def __init__(self, policies):
+        """Compile ``policies``, a mapping of path prefixes to policy dicts."""
+        # Each node is [children, effective policy or None]
+        self._root = [{}, None]
+        # Shorter prefixes first, so each one can inherit from its parent
+        for prefix in sorted(policies, key=lambda prefix: len(split_path(prefix))):
+            if not prefix.startswith('/') or not prefix.endswith('/'):
+                raise ImproperlyConfigured(
+                    f'Path policy prefix {prefix!r} must start and end with "/"'
+                )
+            node = self._root
+            inherited = node[1] or NO_POLICY
+            for segment in split_path(prefix):
+                node = node[0].setdefault(segment, [{}, None])
+                inherited = node[1] or inherited
+            node[1] = inherited.merged(policies[prefix])
+
+    def classify(self, path):
+        """Return the policy of the longest configured prefix of ``path``."""
+        node = self._root
+        policy = node[1] or NO_POLICY
+        for segment in split_path(path):
+            node = node[0].get(segment)
+            if node is None:
+                break
+            if node[1] is not None:
+                policy = node[1]
+        return policy
+
+
+def build_path_policy_table():
+    """Compile the table described by the CHATS_PATH_POLICIES setting."""
+    return PathPolicyTable(getattr(settings, 'CHATS_PATH_POLICIES', {}))
+
+
+path_policies = build_path_policy_table()
+
+
+def get_policy(request):
+    """Return the request's policy, classifying its path on first use."""
+    policy = getattr(request, 'chats_policy', None)
+    if policy is None:
+        policy = path_policies.classify(request.path)
+        request.chats_policy = policy
+    return policy
@@ -0,0 +1,327 @@
+"""
+Sliding-window rate limiting with pluggable storage.
+
+Each key keeps two counters: requests in the current fixed window and in the
+previous one. The request rate over the last ``window`` seconds is estimated
+by weighting the previous counter by how much of it still overlaps the
+sliding window, so every check is O(1) in time and memory regardless of the
+limit. Rejected requests are not counted.
+
+Backends:
+
+- LocalRateLimitBackend: per-process LRU, for a single worker
+- SharedMemoryRateLimitBackend: fixed-size table in a memory-mapped file,
+  shared by all worker processes on one host
+- DjangoCacheRateLimitBackend: a Django cache shared by all hosts
+
+Configured by the CHATS_RATE_LIMIT setting:
+
+    CHATS_RATE_LIMIT = {
+        'BACKEND': 'chats.ratelimit.LocalRateLimitBackend',
+        'OPTIONS': {'max_keys': 100000},
+        'LIMIT': 5,
+        'WINDOW': 60,
+        'KEY': 'user_or_ip',
+    }
+"""
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from time import time as current_time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+def sliding_window(previous, current, elapsed, window, limit):
+    """
+    Decide one request against the two window counters.
+
+    Returns (allowed, retry_after), where retry_after is the number of
+    seconds until a request would be allowed again.
+    """
+    weight = 1 - elapsed / window
+    if previous * weight + current + 1 <= limit:
+        return True, 0
+    if current + 1 > limit:
+        # The current window alone is full: wait for it to end, then for its
+        # count to slide far enough out of the next one
+        fraction = 1 - (limit - 1) / current if current else 0
+        wait = (window - elapsed) + fraction * window
+    else:
+        fraction = 1 - (limit - current - 1) / previous
+        wait = fraction * window - elapsed
+    return False, max(math.ceil(wait), 1)
+
+
+def roll_counters(stored_index, current, previous, index):
+    """Return (previous, current) counts as seen from window ``index``."""
+    if stored_index == index:
+        return previous, current
+    if stored_index == index - 1:
+        return current, 0
+    return 0, 0
+
+
+class LocalRateLimitBackend:
+    """
+    In-process LRU of window counters.
+
+    Keys idle for two windows are evicted as new requests arrive, and at most
+    ``max_keys`` are kept. Each worker process counts separately.
+    """
+
+    def __init__(self, max_keys=100000):
+        """Initialize an empty table holding at most ``max_keys`` keys."""
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # key -> [window index, current, previous, expires_at]
+        self._items = OrderedDict()
+
+    def hit(self, key, limit, window, now):
+        """Check and count one request for ``key``."""
+        index, elapsed = divmod(now, window)
+        index = int(index)
+        with self._lock:
+            self._evict(now)
+            item = self._items.get(key)
+            if item is None:
+                previous, current = 0, 0
+            else:
+                previous, current = roll_counters(item[0], item[1], item[2], index)
+            allowed, retry_after = sliding_window(previous, current, elapsed, window, limit)
+            if allowed:
+                current += 1
+            self._items[key] = [index, current, previous, (index + 2) * window]
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_keys:
+                self._items.popitem(last=False)
+        return allowed, retry_after
+
+    def _evict(self, now):
+        """Drop keys idle for two windows, starting from the LRU end."""
+        while self._items and next(iter(self._items.values()))[3] <= now:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        """Return the number of tracked keys."""
+        return len(self._items)
+
+    def clear(self):
+        """Remove every key."""
+        with self._lock:
+            self._items.clear()
+
+
+class SharedMemoryRateLimitBackend:
+    """
+    Fixed-size counter table in a memory-mapped file.
+
+    All worker processes on a host that use the same ``path`` share counts.
+    Keys are hashed into ``slots`` slots with linear probing over ``probes``
+    slots; a slot whose counters are two windows old is free for reuse, and
+    when none is free the stalest slot in the probe range is taken over. A
+    POSIX record lock serializes updates across processes.
+    """
+
+    # key hash, window index, current count, previous count
+    SLOT = struct.Struct('<QqII')
+
+    def __init__(self, path=None, slots=65536, probes=8):
+        """Use the table at ``path``, creating it on first use."""
+        if fcntl is None:
+            raise ImproperlyConfigured(
+                'SharedMemoryRateLimitBackend requires POSIX file locking'
+            )
+        self.path = path or os.path.join(tempfile.gettempdir(), 'chats-ratelimit.bin')
+        self.slots = slots
+        self.probes = probes
+        self._lock = threading.Lock()
+        self._fd = None
+        self._map = None
+        self._pid = None
+
+    def _open(self):
+        """Map the table, reopening it in a forked child process."""
+        if self._pid == os.getpid():
+            return
+        size = self.slots * self.SLOT.size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+
+    def _hash(self, key):
+        """Return a non-zero 64-bit hash of ``key``; zero marks an empty slot."""
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') or 1
+
+    def hit(self, key, limit, window, now):
+        """Check and count one request for ``key``."""
+        index, elapsed = divmod(now, window)
+        index = int(index)
+        key_hash = self._hash(key)
+        with self._lock:
+            self._open()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                slot, stored = self._find(key_hash, index)
+                if stored is None:
+                    previous, current = 0, 0
+                else:
+                    previous, current = roll_counters(stored[1], stored[2], stored[3], index)
+                allowed, retry_after = sliding_window(previous, current, elapsed, window, limit)
+                if allowed:
+                    current += 1
+                self.SLOT.pack_into(
+                    self._map, slot * self.SLOT.size, key_hash, index, current, previous
+                )
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return allowed, retry_after
+
+    def _find(self, key_hash, index):
+        """Return (slot, stored values or None) for a key hash."""
+        start = key_hash % self.slots
+        reusable = None
+        stalest = None
+        for offset in range(self.probes):
+            slot = (start + offset) % self.slots
+            stored = self.SLOT.unpack_from(self._map, slot * self.SLOT.size)
+            if stored[0] == key_hash:
+                return slot, stored
+            if reusable is None and (stored[0] == 0 or stored[1] < index - 1):
+                reusable = slot
+            if stalest is None or stored[1] < stalest[1]:
+                stalest = (slot, stored[1])
+        return (reusable if reusable is not None else stalest[0]), None
+
+    def clear(self):
+        """Zero the whole table."""
+        with self._lock:
+            self._open()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                self._map[:] = bytes(len(self._map))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+
+class DjangoCacheRateLimitBackend:
+    """
+    Backend keeping counters in a Django cache shared by all workers.
+
+    Counters expire on their own after two windows. The check and the
+    increment are separate cache calls, so concurrent requests for the same
+    key may overshoot the limit slightly.
+    """
+
+    KEY_PREFIX = 'chats:ratelimit'
+
+    def __init__(self, alias='default'):
+        """Use the cache configured under ``alias``."""
+        self.alias = alias
+
+    @property
+    def cache(self):
+        """Return the configured Django cache."""
+        return caches[self.alias]
+
+    def hit(self, key, limit, window, now):
+        """Check and count one request for ``key``."""
+        index, elapsed = divmod(now, window)
+        index = int(index)
+        current_key = f'{self.KEY_PREFIX}:{key}:{index}'
+        previous_key = f'{self.KEY_PREFIX}:{key}:{index - 1}'
+        values = self.cache.get_many([current_key, previous_key])
+        allowed, retry_after = sliding_window(
+            values.get(previous_key, 0), values.get(current_key, 0), elapsed, window, limit
+        )
+        if allowed and not self.cache.add(current_key, 1, 2 * window):
+            try:
+                self.cache.incr(current_key)
+            except ValueError:
+                # Expired between add() and incr()
+                self.cache.set(current_key, 1, 2 * window)
+        return allowed, retry_after
+
+    async def ahit(self, key, limit, window, now):
+        """Async version of hit() using the cache's async API."""
+        index, elapsed = divmod(now, window)
+        index = int(index)
+        current_key = f'{self.KEY_PREFIX}:{key}:{index}'
+        previous_key = f'{self.KEY_PREFIX}:{key}:{index - 1}'
+        values = await self.cache.aget_many([current_key, previous_key])
+        allowed, retry_after = sliding_window(
+            values.get(previous_key, 0), values.get(current_key, 0), elapsed, window, limit
+        )
+        if allowed and not await self.cache.aadd(current_key, 1, 2 * window):
+            try:
+                await self.cache.aincr(current_key)
+            except ValueError:
+                await self.cache.aset(current_key, 1, 2 * window)
+        return allowed, retry_after
+
+    def clear(self):
+        """Counters expire on their own; nothing to clear eagerly."""
+
+
+class RateLimiter:
+    """Apply one limit of ``limit`` requests per ``window`` seconds."""
+
+    def __init__(self, backend, limit=5, window=60):
+        """Wrap ``backend`` with the given limit."""
+        self.backend = backend
+        self.limit = limit
+        self.window = window
+
+    def hit(self, key, now=None):
+        """Check and count a request; return (allowed, retry_after)."""
+        if now is None:
+            now = current_time()
+        return self.backend.hit(f'{key}:{self.window}', self.limit, self.window, now)
+
+    async def ahit(self, key, now=None):
+        """
+        Async version of hit().
+
+        Backends without an ahit() method are called directly: the local and
+        shared-memory backends only take a short lock and never do I/O.
+        """
+        if now is None:
+            now = current_time()
+        backend_ahit = getattr(self.backend, 'ahit', None)
+        if backend_ahit is None:
+            return self.hit(key, now)
+        return await backend_ahit(f'{key}:{self.window}', self.limit, self.window, now)
+
+
+def build_rate_limiter():
+    """Create the limiter described by the CHATS_RATE_LIMIT setting."""
+    config = getattr(settings, 'CHATS_RATE_LIMIT', {})
+    backend_class = import_string(
+        config.get('BACKEND', 'chats.ratelimit.LocalRateLimitBackend')
+    )
+    backend = backend_class(**config.get('OPTIONS', {}))
+    return RateLimiter(backend, limit=config.get('LIMIT', 5), window=config.get('WINDOW', 60))
+
+
+rate_limiter = build_rate_limiter()
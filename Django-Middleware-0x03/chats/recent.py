@@ -0,0 +1,242 @@
+"""
+Cache of the newest serialized messages per conversation.
+
+Busy conversations are read far more often than they are written, and almost
+always from the first page. This module keeps the newest messages of each
+conversation in a bounded ring buffer so that first page can be served
+without querying messages.
+
+Consistency is kept with a per-conversation generation number: every append
+or invalidation bumps the generation, and an entry is only served when it was
+written for the current generation. A reader that filled the cache while a
+message was being written therefore never serves the stale result.
+
+Configured by the CHATS_RECENT_MESSAGES setting:
+
+    CHATS_RECENT_MESSAGES = {
+        'BACKEND': 'chats.recent.DjangoCacheRecentMessageBackend',
+        'SIZE': 20,
+        'OPTIONS': {'alias': 'default', 'timeout': 300},
+    }
+
+The default backend keeps entries in a Django cache, which every worker
+must share for invalidations to reach them. LocalRecentMessageBackend is an
+opt-in for single-process deployments.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from time import monotonic
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .metrics import metrics
+
+
+class LocalRecentMessageBackend:
+    """
+    In-process LRU of conversation buffers.
+
+    Opt-in, and only suitable for a single worker process, since other
+    processes cannot see its invalidations. The default is
+    DjangoCacheRecentMessageBackend.
+    """
+
+    def __init__(self, max_conversations=1000, timeout=300):
+        """Initialize an empty LRU holding at most ``max_conversations`` entries."""
+        self.max_conversations = max_conversations
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # conversation_id -> [generation, entry or None, stored_at]
+        self._items = OrderedDict()
+
+    def get(self, conversation_id):
+        """Return (generation, entry) for a conversation."""
+        with self._lock:
+            item = self._items.get(conversation_id)
+            if item is None:
+                return 0, None
+            self._items.move_to_end(conversation_id)
+            generation, entry, stored_at = item
+            if entry is None:
+                return generation, None
+            if monotonic() - stored_at > self.timeout:
+                item[1] = None
+                return generation, None
+            # Hand out a copy so callers never see the buffer change under them
+            messages = entry['messages']
+            return generation, {**entry, 'messages': deque(messages, maxlen=messages.maxlen)}
+
+    def bump(self, conversation_id):
+        """Increment and return the conversation's generation."""
+        with self._lock:
+            item = self._items.setdefault(conversation_id, [0, None, 0.0])
+            item[0] += 1
+            self._items.move_to_end(conversation_id)
+            self._evict()
+            return item[0]
+
+    def set_entry(self, conversation_id, entry):
+        """Store an entry, evicting the least recently used conversation if full."""
+        with self._lock:
+            item = self._items.setdefault(conversation_id, [0, None, 0.0])
+            item[1] = entry
+            item[2] = monotonic()
+            self._items.move_to_end(conversation_id)
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used conversations above the size limit."""
+        while len(self._items) > self.max_conversations:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._items.clear()
+
+
+class DjangoCacheRecentMessageBackend:
+    """
+    Backend storing buffers in a Django cache shared by all workers.
+
+    A generation missing from the cache, never set or evicted, is started
+    at the current time in microseconds rather than at 1, so it is always
+    above any generation an entry still in the cache was written for.
+    """
+
+    KEY_PREFIX = 'chats:recent'
+
+    def __init__(self, alias='default', timeout=300):
+        """Use the cache configured under ``alias``."""
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        """Return the configured Django cache."""
+        return caches[self.alias]
+
+    def _keys(self, conversation_id):
+        """Return the (generation key, entry key) pair for a conversation."""
+        return (
+            f'{self.KEY_PREFIX}:gen:{conversation_id}',
+            f'{self.KEY_PREFIX}:entry:{conversation_id}',
+        )
+
+    def new_generation(self):
+        """Return the generation a missing sequence starts from."""
+        return time.time_ns() // 1000
+
+    def get(self, conversation_id):
+        """Return (generation, entry) for a conversation, in one round trip when seeded."""
+        generation_key, entry_key = self._keys(conversation_id)
+        values = self.cache.get_many([generation_key, entry_key])
+        generation = values.get(generation_key)
+        if generation is None:
+            # Another request may have seeded it meanwhile
+            self.cache.add(generation_key, self.new_generation(), None)
+            generation = self.cache.get(generation_key, 0)
+        return generation, values.get(entry_key)
+
+    def bump(self, conversation_id):
+        """Atomically increment and return the conversation's generation."""
+        generation_key, _ = self._keys(conversation_id)
+        generation = self.new_generation()
+        if self.cache.add(generation_key, generation, None):
+            return generation
+        try:
+            return self.cache.incr(generation_key)
+        except ValueError:
+            # Evicted between add() and incr(); start a new sequence
+            self.cache.set(generation_key, generation, None)
+            return generation
+
+    def set_entry(self, conversation_id, entry):
+        """Store an entry for ``timeout`` seconds."""
+        _, entry_key = self._keys(conversation_id)
+        self.cache.set(entry_key, entry, self.timeout)
+
+    def clear(self):
+        """Entries expire on their own; nothing to clear eagerly."""
+
+
+class RecentMessageCache:
+    """Versioned cache of the newest serialized messages per conversation."""
+
+    def __init__(self, backend, size=20):
+        """Wrap ``backend`` and keep the newest ``size`` messages per conversation."""
+        self.backend = backend
+        self.size = size
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'fills': 0, 'appends': 0, 'invalidations': 0}
+
+    def _count(self, name):
+        """Increment a metrics counter."""
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, conversation_id):
+        """Return the current entry for a conversation, or None on a miss."""
+        generation, entry = self.backend.get(conversation_id)
+        if entry is None or entry['generation'] != generation:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return entry
+
+    def current_generation(self, conversation_id):
+        """Return the generation to pass to fill() before reading the database."""
+        return self.backend.get(conversation_id)[0]
+
+    def fill(self, conversation_id, generation, messages, count, count_is_approximate=False):
+        """Store the newest messages (newest first) read at ``generation``."""
+        self.backend.set_entry(conversation_id, {
+            'generation': generation,
+            'count': count,
+            'count_is_approximate': count_is_approximate,
+            'messages': deque(messages[:self.size], maxlen=self.size),
+        })
+        self._count('fills')
+
+    def append(self, conversation_id, message):
+        """Push a newly written message onto the front of the buffer."""
+        generation, entry = self.backend.get(conversation_id)
+        new_generation = self.backend.bump(conversation_id)
+        self._count('appends')
+        if entry is None or entry['generation'] != generation or new_generation != generation + 1:
+            # Another write raced with this one; the entry is now invalid
+            return
+        entry['messages'].appendleft(message)
+        entry['count'] += 1
+        entry['generation'] = new_generation
+        self.backend.set_entry(conversation_id, entry)
+
+    def invalidate(self, conversation_id):
+        """Invalidate a conversation's buffer after an edit or delete."""
+        self.backend.bump(conversation_id)
+        self._count('invalidations')
+
+    def stats(self):
+        """Return hit/miss counters and the hit rate."""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+def build_recent_message_cache():
+    """Create the cache described by the CHATS_RECENT_MESSAGES setting."""
+    config = getattr(settings, 'CHATS_RECENT_MESSAGES', {})
+    backend_class = import_string(
+        config.get('BACKEND', 'chats.recent.DjangoCacheRecentMessageBackend')
+    )
+    backend = backend_class(**config.get('OPTIONS', {}))
+    return RecentMessageCache(backend, size=config.get('SIZE', 20))
+
+
+recent_messages = build_recent_message_cache()
+metrics.register_collector('chats_recent_messages', recent_messages.stats)
@@ -0,0 +1,237 @@
+"""
+Queue-backed request log writer.
+
+RequestLoggingMiddleware hands each request record to an in-memory queue and
+returns immediately; a single background thread serializes the records as
+JSON lines, writes them in batches and rotates the file by size. When the
+queue is full the record is dropped and counted instead of blocking the
+request, and the writer notes the number of dropped records in the log.
+
+Rotation renames the file underneath any other process appending to it, so
+each file must have a single writer. With several worker processes, put
+{pid} in PATH (e.g. 'requests.{pid}.log') to give every process its own
+file; replay_requests accepts all of them at once.
+
+Query strings are logged through redact_query(): parameters named in
+QUERY_PARAMS keep their values, every other value is replaced with
+REDACTED, so tokens or search terms passed in URLs never reach the file.
+
+Configured by the CHATS_REQUEST_LOG setting:
+
+    CHATS_REQUEST_LOG = {
+        'PATH': 'requests.{pid}.log',
+        'MAX_BYTES': 10 * 1024 * 1024,
+        'BACKUP_COUNT': 5,
+        'QUEUE_SIZE': 10000,
+        'BATCH_SIZE': 256,
+        'FLUSH_INTERVAL': 0.5,
+        'QUERY_PARAMS': ['page', 'page_size', 'limit', 'file_format'],
+    }
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, urlencode
+
+from django.conf import settings
+
+from .batching import BatchingWorker
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Value logged in place of query parameters that are not allowlisted
+REDACTED = 'REDACTED'
+
+# Query parameters logged verbatim unless QUERY_PARAMS says otherwise
+DEFAULT_QUERY_PARAMS = ('page', 'page_size', 'limit', 'file_format')
+
+
+def redact_query(query_string, allowed):
+    """Return the query string with the values of non-allowlisted parameters redacted."""
+    if not query_string:
+        return ''
+    return urlencode([
+        (name, value if name in allowed else REDACTED)
+        for name, value in parse_qsl(query_string, keep_blank_values=True)
+    ])
+
+
+def get_logged_query_params():
+    """Return the query parameters whose values are logged, from settings."""
+    return frozenset(
+        getattr(settings, 'CHATS_REQUEST_LOG', {}).get('QUERY_PARAMS', DEFAULT_QUERY_PARAMS)
+    )
+
+
+class RequestLogWriter(BatchingWorker):
+    """
+    Append JSON request records to a size-rotated file from a background thread.
+
+    emit() never blocks: it returns False and counts the record as dropped
+    when ``queue_size`` records are already waiting. shutdown() drains
+    everything already queued before returning.
+
+    ``path`` may contain {pid}, which is replaced with the id of the process
+    writing the file, so forked workers never share (and rotate) one file.
+    """
+
+    def __init__(self, path='requests.log', max_bytes=10 * 1024 * 1024,
+                 backup_count=5, queue_size=10000, batch_size=256,
+                 flush_interval=0.5):
+        """Initialize the writer; the thread starts on first emit."""
+        super().__init__(
+            batch_size=batch_size, flush_interval=flush_interval, queue_size=queue_size
+        )
+        self.path = os.fspath(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._stream = None
+        self._dropped = 0
+        self._dropped_reported = 0
+        self._written = 0
+        self._batches = 0
+        self._rotations = 0
+
+    thread_name = 'chats-request-log'
+
+    def emit(self, record):
+        """Queue a record dict; return False if it was dropped."""
+        if not self.start():
+            return False
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            return False
+        return True
+
+    def shutdown(self, timeout=None):
+        """Stop accepting records and wait until queued ones are written."""
+        started = self.is_running()
+        super().shutdown(timeout)
+        if not started:
+            self.finish()
+
+    def stats(self):
+        """Return queue depth and write counters."""
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'written': self._written,
+                'dropped': self._dropped,
+                'batches': self._batches,
+                'rotations': self._rotations,
+            }
+
+    def finish(self):
+        """Note any records dropped since the last batch and close the file."""
+        try:
+            self._flush_dropped()
+        finally:
+            self._close_stream()
+
+    def write_batch(self, batch):
+        """Serialize and append a batch with a single write call."""
+        lines = [self._format(record) for record in batch]
+        self._flush_dropped(lines)
+        try:
+            self._append(''.join(lines))
+        except OSError:
+            logger.exception('Could not write %d request log records', len(batch))
+            with self._lock:
+                self._dropped += len(batch)
+            return
+        with self._lock:
+            self._written += len(batch)
+            self._batches += 1
+
+    def _flush_dropped(self, lines=None):
+        """Add a record noting newly dropped records to ``lines``, or write it."""
+        with self._lock:
+            dropped = self._dropped - self._dropped_reported
+            self._dropped_reported = self._dropped
+        if not dropped:
+            return
+        logger.warning('Request log queue full; dropped %d records', dropped)
+        line = self._format({'event': 'dropped', 'count': dropped})
+        if lines is not None:
+            lines.append(line)
+            return
+        try:
+            self._append(line)
+        except OSError:
+            logger.exception('Could not write the dropped record count')
+
+    def _format(self, record):
+        """Return a record as one JSON line, converting its epoch timestamp."""
+        record = dict(record)
+        timestamp = record.pop('timestamp', None)
+        if timestamp is None:
+            moment = datetime.now(timezone.utc)
+        else:
+            moment = datetime.fromtimestamp(timestamp, timezone.utc)
+        record = {'time': moment.isoformat(timespec='milliseconds'), **record}
+        return json.dumps(record, default=str, separators=(',', ':')) + '\n'
+
+    def current_path(self):
+        """Return the file this process writes to."""
+        return self.path.format(pid=os.getpid())
+
+    def _append(self, data):
+        """Write ``data`` to the log, rotating the file once it is too large."""
+        if self._stream is None:
+            self._stream = open(self.current_path(), 'a', encoding='utf-8')
+        self._stream.write(data)
+        self._stream.flush()
+        if self.max_bytes and self._stream.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        """Shift requests.log.N to requests.log.N+1 and start a new file."""
+        self._close_stream()
+        path = self.current_path()
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = f'{path}.{index}'
+                if os.path.exists(source):
+                    os.replace(source, f'{path}.{index + 1}')
+            os.replace(path, f'{path}.1')
+        else:
+            os.remove(path)
+        with self._lock:
+            self._rotations += 1
+
+    def _close_stream(self):
+        """Close the open log file, if any."""
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
+_request_log_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_request_log_writer():
+    """Return the process-wide request log writer, creating it on first use."""
+    global _request_log_writer
+    with _writer_lock:
+        if _request_log_writer is None:
+            config = getattr(settings, 'CHATS_REQUEST_LOG', {})
+            _request_log_writer = RequestLogWriter(
+                path=config.get('PATH', 'requests.log'),
+                max_bytes=config.get('MAX_BYTES', 10 * 1024 * 1024),
+                backup_count=config.get('BACKUP_COUNT', 5),
+                queue_size=config.get('QUEUE_SIZE', 10000),
+                batch_size=config.get('BATCH_SIZE', 256),
+                flush_interval=config.get('FLUSH_INTERVAL', 0.5),
+            )
+            atexit.register(_request_log_writer.shutdown)
+            metrics.register_collector('chats_request_log', _request_log_writer.stats)
+        return _request_log_writer
@@ -1,7 +1,7 @@
 """Serializers for the messaging application."""
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
-from .models import User, Conversation, Message
+from .models import User, Conversation, Message, InboxEntry
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -31,12 +31,12 @@ class UserSerializer(serializers.ModelSerializer):
         }
     
     def create(self, validated_data):
-        """Create a new user with encrypted password."""
+        """Create a new user with encrypted password in a single INSERT."""
         password = validated_data.pop('password', None)
-        user = User.objects.create(**validated_data)
+        user = User(**validated_data)
         if password:
             user.set_password(password)
-            user.save()
+        user.save(force_insert=True)
         return user
     
     def update(self, instance, validated_data):
@@ -78,9 +78,37 @@ class MessageSerializer(serializers.ModelSerializer):
         read_only_fields = ['message_id', 'sent_at']
 
 
+class ParticipantSerializer(serializers.ModelSerializer):
+    """Compact serializer for conversation participants."""
+    
+    class Meta:
+        """Meta options for ParticipantSerializer."""
+        model = User
+        fields = ['user_id', 'username', 'first_name', 'last_name']
+        read_only_fields = fields
+
+
+class ParticipantIdsSerializer(serializers.Serializer):
+    """Validate a list of user ids for adding or removing participants."""
+    user_ids = serializers.ListField(
+        child=serializers.UUIDField(),
+        allow_empty=False,
+        max_length=1000
+    )
+
+
 class ConversationSerializer(serializers.ModelSerializer):
-    """Serializer for Conversation model with nested messages."""
-    participants = UserSerializer(many=True, read_only=True)
+    """
+    Serializer for Conversation model with nested messages.
+    
+    Only a participant count and a small sample of participants are returned,
+    so reads stay cheap for very large conversations. The full list is
+    available from the paginated participants endpoint.
+    """
+    PARTICIPANT_SAMPLE_SIZE = 5
+    
+    participant_count = serializers.SerializerMethodField()
+    participants_sample = serializers.SerializerMethodField()
     participant_ids = serializers.ListField(
         child=serializers.UUIDField(),
         write_only=True,
@@ -92,25 +120,57 @@ class ConversationSerializer(serializers.ModelSerializer):
     def get_message_count(self, obj):
         """Get the count of messages in the conversation."""
         return obj.messages.count()
+    
+    def get_participant_count(self, obj):
+        """Get the number of participants, using the queryset annotation if present."""
+        count = getattr(obj, 'participant_count', None)
+        if count is None:
+            count = obj.participants.count()
+        return count
+    
+    def get_participants_sample(self, obj):
+        """Get the first few participants, using the sliced prefetch if present."""
+        sample = getattr(obj, 'participant_sample', None)
+        if sample is None:
+            sample = obj.participants.order_by('username')[:self.PARTICIPANT_SAMPLE_SIZE]
+        return ParticipantSerializer(sample, many=True).data
 
     class Meta:
         """Meta options for ConversationSerializer."""
         model = Conversation
         fields = [
             'conversation_id',
-            'participants',
+            'participant_count',
+            'participants_sample',
             'participant_ids',
             'messages',
             'message_count',
             'created_at'
         ]
-        read_only_fields = ['conversation_id', 'created_at', 'message_count']
+        read_only_fields = ['conversation_id', 'created_at', 'message_count', 'participant_count']
 
     def create(self, validated_data):
         """Create a conversation with participants."""
         participant_ids = validated_data.pop('participant_ids', [])
         conversation = Conversation.objects.create(**validated_data)
         if participant_ids:
-            participants = User.objects.filter(user_id__in=participant_ids)
-            conversation.participants.set(participants)
+            conversation.add_participants(participant_ids)
         return conversation
+
+
+class InboxEntrySerializer(serializers.ModelSerializer):
+    """Serializer for a user's inbox row."""
+    conversation_id = serializers.UUIDField(read_only=True)
+    last_sender = ParticipantSerializer(read_only=True)
+    
+    class Meta:
+        """Meta options for InboxEntrySerializer."""
+        model = InboxEntry
+        fields = [
+            'conversation_id',
+            'last_message_at',
+            'last_message_preview',
+            'last_sender',
+            'unread_count'
+        ]
+        read_only_fields = fields
@@ -0,0 +1,57 @@
+"""
+Django signals for the chats app.
+
+This module contains signal handlers for:
+- Keeping the user autocomplete index in sync with saved and deleted users
+- Invalidating the recent-message cache when messages are edited or deleted
+- Fanning new messages out to participants' inbox rows, and refreshing
+  them when messages are edited or deleted
+"""
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import User, Message
+from .autocomplete import user_index
+from .recent import recent_messages
+from .inbox import fan_out_on_commit, refresh_on_commit
+
+
+@receiver(post_save, sender=User)
+def update_autocomplete_index(sender, instance, **kwargs):
+    """Re-index a user in the autocomplete index after it is saved."""
+    user_index.update_user(instance)
+
+
+@receiver(post_delete, sender=User)
+def remove_from_autocomplete_index(sender, instance, **kwargs):
+    """Remove a deleted user from the autocomplete index."""
+    user_index.remove_user(instance.user_id)
+
+
+@receiver(post_save, sender=Message)
+def invalidate_recent_messages_on_edit(sender, instance, created, **kwargs):
+    """Invalidate the conversation's recent messages when a message is edited."""
+    # New messages are appended explicitly by the views that create them
+    if not created:
+        recent_messages.invalidate(instance.conversation_id)
+
+
+@receiver(post_save, sender=Message)
+def update_inbox_on_new_message(sender, instance, created, **kwargs):
+    """Update every participant's inbox row once a message write commits."""
+    if created:
+        fan_out_on_commit([instance])
+    else:
+        refresh_on_commit(instance.conversation_id)
+
+
+@receiver(post_delete, sender=Message)
+def invalidate_recent_messages_on_delete(sender, instance, **kwargs):
+    """Invalidate the conversation's recent messages when a message is deleted."""
+    recent_messages.invalidate(instance.conversation_id)
+
+
+@receiver(post_delete, sender=Message)
+def refresh_inbox_on_delete(sender, instance, **kwargs):
+    """Refresh every participant's inbox row once a message delete commits."""
+    refresh_on_commit(instance.conversation_id)
@@ -1,3 +1,1368 @@
-from django.test import TestCase
+"""Tests for the chats application."""
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import iscoroutinefunction
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.http import HttpResponse
+from django.utils.functional import SimpleLazyObject
+from django.test import (
+    LiveServerTestCase,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .autocomplete import user_index
+from .ingest import MessageWriteQueue
+from .metrics import MetricsRegistry, timed_middleware
+from .middleware import (
+    OffensiveLanguageMiddleware,
+    RequestLoggingMiddleware,
+    RequestMetricsMiddleware,
+    RestrictAccessByTimeMiddleware,
+    RolepermissionMiddleware,
+)
+from .models import User, Conversation, Message, InboxEntry, uuid7
+from .inbox import InboxFanout
+from .management.commands import replay_requests
+from .pagination import ApproximateCountPaginator, MessagePagination, mysql_plan_rows
+from .policies import PathPolicy, PathPolicyTable, get_policy, path_policies
+from .passwords import PasswordVerifier
+from .ratelimit import (
+    DjangoCacheRateLimitBackend,
+    LocalRateLimitBackend,
+    RateLimiter,
+    SharedMemoryRateLimitBackend,
+)
+from . import batching
+from .request_log import RequestLogWriter
+from .recent import (
+    DjangoCacheRecentMessageBackend,
+    LocalRecentMessageBackend,
+    RecentMessageCache,
+    build_recent_message_cache,
+    recent_messages,
+)
+
+# The custom middleware stack restricts access by wall-clock time and role,
+# which is not what these API tests exercise.
+API_TEST_MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+]
+
+
+def create_user(username, **kwargs):
+    """Create a user with the required profile fields filled in."""
+    defaults = {
+        'email': f'{username}@example.com',
+        'first_name': username.title(),
+        'last_name': 'Tester',
+    }
+    defaults.update(kwargs)
+    return User.objects.create_user(username=username, password='pass12345', **defaults)
+
+
+@override_settings(MIDDLEWARE=API_TEST_MIDDLEWARE)
+class ConversationExportTest(TestCase):
+    """Tests for the streaming transcript export actions."""
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.bob = create_user('bob')
+        self.carol = create_user('carol')
+
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.set([self.alice, self.bob])
+        self.other = Conversation.objects.create()
+        self.other.participants.set([self.alice, self.carol])
+        self.private = Conversation.objects.create()
+        self.private.participants.set([self.bob, self.carol])
+
+        for index in range(3):
+            Message.objects.create(
+                sender=self.alice, conversation=self.conversation,
+                message_body=f'hello {index}'
+            )
+        Message.objects.create(
+            sender=self.carol, conversation=self.other, message_body='hi, "alice"'
+        )
+        Message.objects.create(
+            sender=self.bob, conversation=self.private, message_body='secret'
+        )
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def read_stream(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def test_export_conversation_ndjson(self):
+        """A single conversation is streamed as one JSON object per line."""
+        response = self.client.get(
+            f'/api/conversations/{self.conversation.conversation_id}/export/'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        lines = self.read_stream(response).splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual(
+            [record['message_body'] for record in records],
+            ['hello 0', 'hello 1', 'hello 2']
+        )
+        self.assertEqual(records[0]['sender_username'], 'alice')
+
+    def test_export_conversation_csv(self):
+        """CSV exports include a header row and quote values correctly."""
+        response = self.client.get(
+            f'/api/conversations/{self.other.conversation_id}/export/',
+            {'file_format': 'csv'}
+        )
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(io.StringIO(self.read_stream(response))))
+        self.assertEqual(rows[0][0], 'message_id')
+        self.assertEqual(rows[1][4], 'hi, "alice"')
+
+    def test_export_all_conversations(self):
+        """Exporting everything only includes the user's conversations."""
+        response = self.client.get('/api/conversations/export/')
+        self.assertEqual(response.status_code, 200)
+        bodies = [
+            json.loads(line)['message_body']
+            for line in self.read_stream(response).splitlines()
+        ]
+        self.assertEqual(len(bodies), 4)
+        self.assertNotIn('secret', bodies)
+
+    def test_export_rejects_non_participant(self):
+        """Users cannot export conversations they are not part of."""
+        response = self.client.get(
+            f'/api/conversations/{self.private.conversation_id}/export/'
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_export_rejects_unknown_format(self):
+        """Unsupported formats return a 400 error."""
+        response = self.client.get(
+            '/api/conversations/export/', {'file_format': 'xml'}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class ImportMessagesCommandTest(TestCase):
+    """Tests for the import_messages management command."""
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.alice)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write_ndjson(self, records):
+        path = os.path.join(self.directory.name, 'history.ndjson')
+        with open(path, 'w', encoding='utf-8') as handle:
+            for record in records:
+                handle.write(json.dumps(record) + '\n')
+        return path
+
+    def test_import_resolves_legacy_ids_and_keeps_timestamps(self):
+        """Legacy ids are mapped and sent_at is taken from the file."""
+        path = self.write_ndjson([
+            {'sender_id': 'legacy-7', 'conversation_id': 'room-1',
+             'message_body': 'first', 'sent_at': '2020-01-01T10:00:00Z'},
+            {'sender_username': 'alice', 'conversation_id': 'room-1',
+             'message_body': 'second', 'sent_at': '2020-01-01T10:01:00Z'},
+            {'sender_id': 'unknown', 'conversation_id': 'room-1',
+             'message_body': 'dropped'},
+        ])
+        id_map = os.path.join(self.directory.name, 'ids.json')
+        with open(id_map, 'w', encoding='utf-8') as handle:
+            json.dump({
+                'users': {'legacy-7': str(self.alice.user_id)},
+                'conversations': {'room-1': str(self.conversation.conversation_id)},
+            }, handle)
+
+        call_command('import_messages', path, id_map=id_map, stdout=io.StringIO())
+
+        messages = list(Message.objects.order_by('sent_at'))
+        self.assertEqual([m.message_body for m in messages], ['first', 'second'])
+        self.assertEqual(messages[0].sent_at.year, 2020)
+
+    def test_import_reports_malformed_rows(self):
+        """Bad JSON lines and message ids are reported and the rest imported."""
+        conversation_id = str(self.conversation.conversation_id)
+        path = self.write_ndjson([
+            {'sender_username': 'alice', 'conversation_id': conversation_id,
+             'message_body': 'kept', 'sent_at': '2020-01-01T10:00:00Z'},
+            {'sender_username': 'alice', 'conversation_id': conversation_id,
+             'message_body': 'bad id', 'message_id': 'not-a-uuid'},
+        ])
+        with open(path, 'a', encoding='utf-8') as handle:
+            handle.write('{"truncated": \n')
+        stderr = io.StringIO()
+
+        call_command('import_messages', path, stdout=io.StringIO(), stderr=stderr)
+
+        self.assertEqual(list(Message.objects.values_list('message_body', flat=True)), ['kept'])
+        self.assertEqual(Message.objects.get().sent_at.year, 2020)
+        self.assertIn("Row 2: invalid message_id 'not-a-uuid'", stderr.getvalue())
+        self.assertIn('Row 3: not a JSON object', stderr.getvalue())
+        self.assertTrue(Message._meta.get_field('sent_at').auto_now_add)
+
+    def test_import_counts_duplicates_and_rejects_bad_types(self):
+        """Re-imported ids are not counted as imported; bad field types are malformed."""
+        conversation_id = str(self.conversation.conversation_id)
+        message_id = str(uuid.uuid4())
+        path = self.write_ndjson([
+            {'sender_username': 'alice', 'conversation_id': conversation_id,
+             'message_id': message_id, 'message_body': 'naive',
+             'sent_at': '2020-01-01T10:00:00'},
+            {'sender_username': 'alice', 'conversation_id': conversation_id,
+             'message_body': 42},
+            {'sender_username': 'alice', 'conversation_id': conversation_id,
+             'message_body': 'epoch', 'sent_at': 1577872800},
+        ])
+        stderr = io.StringIO()
+        call_command('import_messages', path, stdout=io.StringIO(), stderr=stderr)
+
+        message = Message.objects.get()
+        self.assertEqual(message.sent_at, datetime(2020, 1, 1, 10, tzinfo=timezone.utc))
+        self.assertIn('Row 2: message_body must be a string', stderr.getvalue())
+        self.assertIn('Row 3: sent_at must be a string', stderr.getvalue())
+
+        out = io.StringIO()
+        call_command('import_messages', path, stdout=out, stderr=io.StringIO())
+        self.assertIn('Imported 0 messages, 1 already present', out.getvalue())
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_import_resumes_from_checkpoint(self):
+        """Rows before the checkpoint offset are not imported again."""
+        conversation_id = str(self.conversation.conversation_id)
+        path = self.write_ndjson([
+            {'sender_username': 'alice', 'conversation_id': conversation_id,
+             'message_body': f'message {index}'}
+            for index in range(5)
+        ])
+        checkpoint = os.path.join(self.directory.name, 'import.ckpt')
+        with open(checkpoint, 'w', encoding='utf-8') as handle:
+            handle.write('3')
+
+        call_command(
+            'import_messages', path, checkpoint=checkpoint, chunk_size=1,
+            stdout=io.StringIO()
+        )
+
+        self.assertEqual(
+            sorted(Message.objects.values_list('message_body', flat=True)),
+            ['message 3', 'message 4']
+        )
+        with open(checkpoint, encoding='utf-8') as handle:
+            self.assertEqual(handle.read(), '5')
+
+
+@override_settings(MIDDLEWARE=API_TEST_MIDDLEWARE)
+class UserAutocompleteTest(TestCase):
+    """Tests for the prefix-indexed user autocomplete endpoint."""
+
+    def setUp(self):
+        user_index.clear()
+        self.addCleanup(user_index.clear)
+        self.alice = create_user('alice', first_name='Alice', last_name='Smith')
+        self.alan = create_user('alan', first_name='Alan', last_name='Turing')
+        self.bob = create_user('bob', first_name='Robert', last_name='Alston')
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def search(self, term, **params):
+        response = self.client.get('/api/users/autocomplete/', {'q': term, **params})
+        self.assertEqual(response.status_code, 200)
+        return [user['username'] for user in response.data['results']]
+
+    def test_matches_username_and_names_by_prefix(self):
+        """Prefixes match usernames, full names and last names case-insensitively."""
+        self.assertEqual(self.search('AL'), ['alan', 'alice', 'bob'])
+        self.assertEqual(self.search('alice sm'), ['alice'])
+        self.assertEqual(self.search('tur'), ['alan'])
+        self.assertEqual(self.search('lice'), [])
+
+    def test_email_addresses_are_not_searchable(self):
+        """Other users' email addresses cannot be discovered by prefix."""
+        self.alice.email = 'secret.agent@example.com'
+        self.alice.save()
+        self.assertEqual(self.search('secret'), [])
+
+    def test_stale_index_is_served_while_rebuilding(self):
+        """A stale index answers at once and is rebuilt off the request thread."""
+        self.search('a')
+        create_user('alfred', first_name='Alfred', last_name='Hitch')
+        user_index._built_at -= user_index.REFRESH_INTERVAL + 1
+        user_index._entries = [entry for entry in user_index._entries if entry[1] != self.alice.user_id]
+
+        with mock.patch('chats.autocomplete.threading.Thread') as thread:
+            self.assertEqual(self.search('al'), ['alan', 'alfred', 'bob'])
+        thread.return_value.start.assert_called_once_with()
+
+        user_index._refresh()
+        self.assertEqual(self.search('al'), ['alan', 'alfred', 'alice', 'bob'])
+
+    def test_limit_and_empty_query(self):
+        """Results are capped by limit and an empty query returns nothing."""
+        self.assertEqual(len(self.search('a', limit=1)), 1)
+        self.assertEqual(self.search(''), [])
+
+    def test_index_follows_user_saves_and_deletes(self):
+        """Saved and deleted users are reflected without a rebuild."""
+        self.search('a')
+        self.alan.username = 'zed'
+        self.alan.save()
+        self.alice.delete()
+        create_user('alfred', first_name='Alfred', last_name='Hitch')
+        self.assertEqual(self.search('al'), ['zed', 'alfred', 'bob'])
+        self.assertEqual(self.search('zed'), ['zed'])
+
+
+class ApproximateCountPaginatorTest(TestCase):
+    """Tests for the approximate-count paginator."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        sender = create_user('alice')
+        conversation = Conversation.objects.create()
+        Message.objects.bulk_create([
+            Message(sender=sender, conversation=conversation, message_body=str(index))
+            for index in range(5)
+        ])
+        self.queryset = Message.objects.order_by('sent_at')
+
+    def test_small_querysets_are_counted_exactly(self):
+        """Counts below the threshold are exact and served from cache."""
+        paginator = ApproximateCountPaginator(self.queryset, 2)
+        self.assertEqual(paginator.count, 5)
+        self.assertFalse(paginator.is_approximate)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(ApproximateCountPaginator(self.queryset, 2).count, 5)
+
+    @mock.patch('chats.pagination.estimate_count', return_value=500)
+    @mock.patch.object(ApproximateCountPaginator, 'APPROXIMATE_COUNT_THRESHOLD', 3)
+    def test_large_querysets_use_estimate(self, estimate):
+        """Counts above the threshold come from statistics and are flagged."""
+        paginator = ApproximateCountPaginator(self.queryset, 2)
+        self.assertEqual(paginator.count, 500)
+        self.assertTrue(paginator.is_approximate)
+
+        # Pages beyond the real data are empty rather than an error
+        self.assertEqual(len(paginator.page(3)), 1)
+        self.assertEqual(len(paginator.page(10)), 0)
+
+    @mock.patch('chats.pagination.estimate_count', return_value=None)
+    @mock.patch.object(ApproximateCountPaginator, 'APPROXIMATE_COUNT_THRESHOLD', 3)
+    def test_falls_back_to_bounded_count_without_statistics(self, estimate):
+        """Backends without statistics report the bounded count, in one query."""
+        with self.assertNumQueries(1):
+            paginator = ApproximateCountPaginator(self.queryset, 2)
+            self.assertEqual(paginator.count, 4)
+        self.assertTrue(paginator.is_approximate)
+        self.assertEqual(len(paginator.page(3)), 1)
+
+    @mock.patch('chats.pagination.estimate_count', return_value=None)
+    @mock.patch.object(ApproximateCountPaginator, 'APPROXIMATE_COUNT_THRESHOLD', 3)
+    def test_next_links_continue_past_an_approximate_count(self, estimate):
+        """Following next reaches every row even when the count is a lower bound."""
+        pagination = MessagePagination()
+        url = '/api/messages/?page_size=1'
+        seen = []
+        while url:
+            page = pagination.paginate_queryset(self.queryset, Request(APIRequestFactory().get(url)))
+            self.assertEqual(pagination.page.paginator.count, 4)
+            seen += [message.message_body for message in page]
+            url = pagination.get_next_link()
+        self.assertEqual(seen, [str(index) for index in range(5)])
+
+    def test_mysql_plan_rows(self):
+        """MySQL estimates multiply rows and filtered over the outer SELECT."""
+        plan = [
+            {'id': 1, 'table': 'message', 'rows': 2000, 'filtered': 50.0},
+            {'id': 1, 'table': 'conversation', 'rows': 1, 'filtered': 100.0},
+            {'id': 2, 'table': 'participants', 'rows': 30, 'filtered': 10.0},
+        ]
+        self.assertEqual(mysql_plan_rows(plan), 1000)
+        self.assertIsNone(mysql_plan_rows([{'id': 1, 'rows': None}]))
+
+
+class MessageWriteQueueTest(TransactionTestCase):
+    """Tests for the write-coalescing message ingestion queue."""
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.alice)
+
+    def new_message(self, body):
+        return Message(
+            sender=self.alice, conversation=self.conversation, message_body=body
+        )
+
+    def test_messages_are_written_in_submission_order(self):
+        """Messages in a conversation keep their submission order across batches."""
+        write_queue = MessageWriteQueue(batch_size=7, flush_interval=0.01)
+        self.addCleanup(write_queue.shutdown)
+        futures = [write_queue.submit(self.new_message(str(i))) for i in range(30)]
+        saved = [future.result(timeout=5) for future in futures]
+
+        self.assertEqual([m.message_body for m in saved], [str(i) for i in range(30)])
+        sent_at = [m.sent_at for m in saved]
+        self.assertEqual(sent_at, sorted(sent_at))
+        stored = list(
+            Message.objects.filter(conversation=self.conversation)
+            .order_by('sent_at').values_list('message_body', flat=True)
+        )
+        self.assertEqual(stored, [str(i) for i in range(30)])
+
+    def test_shutdown_flushes_pending_messages(self):
+        """Messages queued before shutdown are committed before it returns."""
+        write_queue = MessageWriteQueue(batch_size=1000, flush_interval=60)
+        futures = [write_queue.submit(self.new_message(str(i))) for i in range(10)]
+        write_queue.shutdown(timeout=5)
+
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(Message.objects.count(), 10)
+        with self.assertRaises(RuntimeError):
+            write_queue.submit(self.new_message('late'))
+
+    def test_failed_message_does_not_fail_its_batch(self):
+        """A bad row only fails its own future."""
+        write_queue = MessageWriteQueue(batch_size=10, flush_interval=0.05)
+        self.addCleanup(write_queue.shutdown)
+        good = write_queue.submit(self.new_message('good'))
+        bad_message = self.new_message('bad')
+        bad_message.conversation_id = self.alice.user_id
+        bad = write_queue.submit(bad_message)
+
+        self.assertEqual(good.result(timeout=5).message_body, 'good')
+        self.assertIsNotNone(bad.exception(timeout=5))
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_unexpected_error_fails_batch_and_keeps_writer(self):
+        """Errors other than DatabaseError resolve the futures and the writer survives."""
+        write_queue = MessageWriteQueue(batch_size=10, flush_interval=0.01)
+        self.addCleanup(write_queue.shutdown)
+        with mock.patch('chats.ingest.record_messages', side_effect=RuntimeError('boom')), \
+                self.assertLogs('chats.batching', 'ERROR'):
+            failed = write_queue.submit(self.new_message('lost'))
+            self.assertIsInstance(failed.exception(timeout=5), RuntimeError)
+
+        later = write_queue.submit(self.new_message('later'))
+        self.assertEqual(later.result(timeout=5).message_body, 'later')
+        self.assertEqual(list(Message.objects.values_list('message_body', flat=True)), ['later'])
+
+
+class UUID7Test(TestCase):
+    """Tests for time-ordered UUIDv7 primary keys."""
+
+    def test_uuid7_is_version_7_and_monotonic(self):
+        """Generated ids have the v7 layout and sort in creation order."""
+        ids = [uuid7() for _ in range(5000)]
+        self.assertTrue(all(value.version == 7 for value in ids))
+        self.assertTrue(all(value.variant == uuid.RFC_4122 for value in ids))
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_uuid7_from_timestamp(self):
+        """Ids derived from a timestamp embed it in the first 48 bits."""
+        timestamp_ms = 1_600_000_000_000
+        self.assertEqual(uuid7(timestamp_ms).int >> 80, timestamp_ms)
+
+    def test_new_rows_default_to_uuid7(self):
+        """Users, conversations and messages get UUIDv7 keys by default."""
+        user = create_user('alice')
+        conversation = Conversation.objects.create()
+        message = Message.objects.create(
+            sender=user, conversation=conversation, message_body='hi'
+        )
+        self.assertEqual(user.user_id.version, 7)
+        self.assertEqual(conversation.conversation_id.version, 7)
+        self.assertEqual(message.message_id.version, 7)
+
+    def test_rekey_message_ids(self):
+        """Existing uuid4 message ids are rewritten in sent_at order."""
+        user = create_user('alice')
+        conversation = Conversation.objects.create()
+        for index in range(3):
+            message = Message.objects.create(
+                message_id=uuid.uuid4(), sender=user,
+                conversation=conversation, message_body=str(index)
+            )
+            Message.objects.filter(pk=message.pk).update(
+                sent_at=datetime(2020, 1, 1, 0, index, tzinfo=timezone.utc)
+            )
+
+        call_command('rekey_message_ids', batch_size=2, stdout=io.StringIO())
+
+        self.assertEqual(
+            list(Message.objects.order_by('message_id').values_list('message_body', flat=True)),
+            ['0', '1', '2']
+        )
+        self.assertTrue(all(
+            message_id.version == 7
+            for message_id in Message.objects.values_list('message_id', flat=True)
+        ))
+
+
+class UserProvisioningTest(TestCase):
+    """Tests for single-INSERT registration and bulk user provisioning."""
+
+    def test_serializer_creates_user_with_one_insert(self):
+        """UserSerializer.create hashes first and saves the user once."""
+        from .serializers import UserSerializer
+
+        serializer = UserSerializer(data={
+            'username': 'alice', 'email': 'alice@example.com',
+            'first_name': 'Alice', 'last_name': 'Smith', 'password': 'pass12345',
+        })
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        with self.assertNumQueries(1):
+            user = serializer.save()
+        self.assertTrue(user.check_password('pass12345'))
+
+    def test_provision_users_command(self):
+        """Users are bulk created with hashed passwords; bad rows are skipped."""
+        create_user('existing')
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as handle:
+            writer = csv.writer(handle)
+            writer.writerow(['username', 'email', 'first_name', 'last_name', 'password', 'role'])
+            writer.writerow(['ann', 'ann@example.com', 'Ann', 'Lee', 'secret-1', 'host'])
+            writer.writerow(['ben', 'ben@example.com', 'Ben', 'Kay', 'secret-2', 'bogus'])
+            writer.writerow(['', 'nobody@example.com', 'No', 'Name', 'secret-3', ''])
+            writer.writerow(['existing', 'other@example.com', 'Dup', 'User', 'secret-4', ''])
+        self.addCleanup(os.remove, handle.name)
+
+        call_command('provision_users', handle.name, workers=2, stdout=io.StringIO())
+
+        ann = User.objects.get(username='ann')
+        self.assertTrue(ann.check_password('secret-1'))
+        self.assertEqual(ann.role, 'host')
+        self.assertEqual(User.objects.get(username='ben').role, 'guest')
+        self.assertEqual(User.objects.count(), 3)
+
+
+    def test_provision_users_reports_ignored_and_malformed_rows(self):
+        """Existing users are reported as ignored; non-string fields are skipped."""
+        create_user('existing')
+        rows = [
+            {'username': 'ann', 'email': 'ann@example.com', 'first_name': 'Ann',
+             'last_name': 'Lee', 'password': 'secret-1'},
+            {'username': 'existing', 'email': 'dup@example.com', 'first_name': 'Dup',
+             'last_name': 'User', 'password': 'secret-2'},
+            {'username': 42, 'email': 'num@example.com', 'first_name': 'Num',
+             'last_name': 'Ber', 'password': 'secret-3'},
+            {'username': 'cat', 'email': 'cat@example.com', 'first_name': 'Cat',
+             'last_name': 'Ray', 'phone_number': 5550100, 'password': 'secret-4'},
+            {'username': 'dan', 'email': 'dan@example.com', 'first_name': 'Dan',
+             'last_name': 'Orr', 'password': ['secret-5']},
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as handle:
+            handle.write(''.join(json.dumps(row) + '\n' for row in rows))
+        self.addCleanup(os.remove, handle.name)
+
+        out = io.StringIO()
+        call_command('provision_users', handle.name, workers=1, stdout=out)
+
+        self.assertIn('Provisioned 1 users, ignored 1', out.getvalue())
+        self.assertIn('skipped 3 malformed', out.getvalue())
+        self.assertEqual(
+            set(User.objects.values_list('username', flat=True)), {'existing', 'ann'}
+        )
+
+@override_settings(MIDDLEWARE=API_TEST_MIDDLEWARE)
+class LoginUserTest(TestCase):
+    """Tests for the async login endpoint and its password worker pool."""
+
+    def setUp(self):
+        self.alice = create_user('alice')
+
+    def login(self, password):
+        return self.client.post(
+            '/api/auth/login/',
+            {'username': 'alice', 'password': password},
+            content_type='application/json'
+        )
+
+    def test_login_returns_tokens(self):
+        """Valid credentials return the user and a token pair."""
+        response = self.login('pass12345')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['user']['username'], 'alice')
+        self.assertIn('access', response.json())
+
+    def test_login_upgrades_outdated_hash(self):
+        """A correct password stored with an old hasher is rehashed on login."""
+        User.objects.filter(pk=self.alice.pk).update(
+            password=make_password('pass12345', hasher='pbkdf2_sha1')
+        )
+        self.assertEqual(self.login('pass12345').status_code, 200)
+        self.alice.refresh_from_db()
+        self.assertTrue(self.alice.password.startswith('pbkdf2_sha256$'))
+        self.assertTrue(self.alice.check_password('pass12345'))
+
+    def test_login_rejects_bad_password(self):
+        """Invalid credentials return 401."""
+        self.assertEqual(self.login('wrong').status_code, 401)
+
+    def test_login_requires_credentials(self):
+        """Missing fields return 400 and GET is not allowed."""
+        response = self.client.post('/api/auth/login/', {'username': 'alice'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/auth/login/').status_code, 405)
+
+    def test_login_returns_429_when_pool_is_saturated(self):
+        """Logins are rejected instead of queued when the pool is full."""
+        saturated = PasswordVerifier(max_workers=1, max_pending=0)
+        with mock.patch('chats.auth.password_verifier', saturated):
+            response = self.login('pass12345')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(saturated.stats()['rejected'], 1)
+
+
+@override_settings(MIDDLEWARE=API_TEST_MIDDLEWARE)
+class ConversationParticipantsTest(TestCase):
+    """Tests for participant counts, samples and incremental membership changes."""
+
+    def setUp(self):
+        self.owner = create_user('owner', role='host')
+        self.members = User.objects.bulk_create([
+            User(username=f'member{index:02d}', email=f'member{index}@example.com',
+                 first_name='Member', last_name=str(index))
+            for index in range(12)
+        ])
+        self.conversation = Conversation.objects.create()
+        self.conversation.add_participants([self.owner.pk] + [m.pk for m in self.members])
+        self.url = f'/api/conversations/{self.conversation.conversation_id}/'
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def test_read_returns_count_and_sample(self):
+        """Conversation reads include a count and a bounded sample."""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['participant_count'], 13)
+        self.assertEqual(len(response.data['participants_sample']), 5)
+        self.assertNotIn('participants', response.data)
+
+        listing = self.client.get('/api/conversations/')
+        self.assertEqual(listing.data['results'][0]['participant_count'], 13)
+
+    def test_participants_are_paginated(self):
+        """The participants endpoint pages through members."""
+        response = self.client.get(self.url + 'participants/', {'page_size': 10})
+        self.assertEqual(response.data['count'], 13)
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertIsNotNone(response.data['next'])
+
+    @override_settings(CHATS_INBOX_ENABLED=True, CHATS_INBOX_ASYNC=False)
+    def test_add_and_remove_participants(self):
+        """Adding and removing only touches the given memberships."""
+        newcomer = create_user('newcomer')
+        missing = uuid.uuid4()
+        # user lookup, membership insert, latest message, inbox insert
+        with self.assertNumQueries(4):
+            self.assertTrue(self.conversation.add_participants([newcomer.pk, self.owner.pk]))
+
+        response = self.client.post(
+            self.url + 'participants/',
+            {'user_ids': [str(newcomer.pk), str(missing)]}, format='json'
+        )
+        self.assertEqual(response.data['added'], [newcomer.pk])
+
+        response = self.client.delete(
+            self.url + 'participants/',
+            {'user_ids': [str(newcomer.pk), str(self.members[0].pk)]}, format='json'
+        )
+        self.assertEqual(response.data['removed'], 2)
+        self.assertEqual(self.conversation.participants.count(), 12)
+        self.assertFalse(self.conversation.has_participant(newcomer))
+
+    def test_non_participant_cannot_manage_members(self):
+        """Users outside the conversation cannot list or change participants."""
+        outsider = create_user('outsider')
+        self.client.force_authenticate(outsider)
+        response = self.client.post(
+            self.url + 'participants/', {'user_ids': [str(outsider.pk)]}, format='json'
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_member_cannot_add_or_remove_others(self):
+        """Members without a host or admin role can only remove themselves."""
+        member = self.members[0]
+        self.client.force_authenticate(member)
+        newcomer = create_user('newcomer')
+
+        response = self.client.post(
+            self.url + 'participants/', {'user_ids': [str(newcomer.pk)]}, format='json'
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.conversation.has_participant(newcomer))
+
+        response = self.client.delete(
+            self.url + 'participants/',
+            {'user_ids': [str(self.owner.pk), str(member.pk)]}, format='json'
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(self.conversation.has_participant(self.owner))
+
+        response = self.client.delete(
+            self.url + 'participants/', {'user_ids': [str(member.pk)]}, format='json'
+        )
+        self.assertEqual(response.data['removed'], 1)
+        self.assertFalse(self.conversation.has_participant(member))
+
+
+@override_settings(MIDDLEWARE=API_TEST_MIDDLEWARE)
+class RecentMessageCacheTest(TestCase):
+    """Tests for the hot-conversation recent-message cache."""
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.conversation = Conversation.objects.create()
+        self.conversation.add_participants([self.alice.pk])
+        for index in range(3):
+            Message.objects.create(
+                sender=self.alice, conversation=self.conversation,
+                message_body=f'old {index}'
+            )
+        self.url = f'/api/conversations/{self.conversation.conversation_id}/'
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def bodies(self, response):
+        return [message['message_body'] for message in response.data['results']]
+
+    def test_first_page_is_served_from_cache(self):
+        """A warm first page skips the message queries."""
+        first = self.client.get(self.url + 'messages/')
+        hits = recent_messages.stats()['hits']
+        with self.assertNumQueries(2):  # conversation lookup + membership check
+            second = self.client.get(self.url + 'messages/')
+        self.assertEqual(recent_messages.stats()['hits'], hits + 1)
+        self.assertEqual(second.data, first.data)
+
+    def test_add_message_appends_to_cache(self):
+        """New messages show up first without a refill."""
+        self.client.get(self.url + 'messages/')
+        self.client.post(self.url + 'add_message/', {'message_body': 'new'}, format='json')
+        response = self.client.get(self.url + 'messages/')
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(self.bodies(response)[0], 'new')
+
+    def test_timed_out_write_can_be_retried_without_duplicate(self):
+        """A 503 returns an idempotency key, and retrying with it is a no-op."""
+        def commit_late(message):
+            message.save()
+            raise TimeoutError
+
+        with mock.patch('chats.views.save_message', side_effect=commit_late):
+            response = self.client.post(self.url + 'add_message/', {'message_body': 'slow'}, format='json')
+        self.assertEqual(response.status_code, 503)
+        key = response.data['idempotency_key']
+
+        retry = self.client.post(
+            self.url + 'add_message/', {'message_body': 'slow'}, format='json',
+            HTTP_IDEMPOTENCY_KEY=key
+        )
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(str(retry.data['message_id']), key)
+        self.assertEqual(Message.objects.filter(message_body='slow').count(), 1)
+
+    def test_idempotency_key_of_another_message_is_a_conflict(self):
+        """A key that names a message in another conversation or from another sender is a 409."""
+        bob = create_user('bob')
+        other = Conversation.objects.create()
+        other.add_participants([bob.pk])
+        foreign = Message.objects.create(sender=bob, conversation=other, message_body='theirs')
+
+        response = self.client.post(
+            self.url + 'add_message/', {'message_body': 'mine'}, format='json',
+            HTTP_IDEMPOTENCY_KEY=str(foreign.message_id)
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Message.objects.filter(message_body='mine').exists())
+
+    def test_evicted_generation_does_not_revive_stale_entries(self):
+        """After its generation is evicted, an old entry is never current again."""
+        backend = DjangoCacheRecentMessageBackend()
+        recent = RecentMessageCache(backend, size=2)
+        key = uuid.uuid4()
+        generation_key, _ = backend._keys(key)
+
+        recent.fill(key, recent.current_generation(key), [{'message_body': 'stale'}], 1)
+        cache.delete(generation_key)
+        self.assertIsNone(recent.get(key))
+
+        recent.fill(key, recent.current_generation(key), [{'message_body': 'stale'}], 1)
+        cache.delete(generation_key)
+        # An edit after the eviction must not land on the entry's generation
+        recent.invalidate(key)
+        self.assertIsNone(recent.get(key))
+
+    def test_edit_and_delete_invalidate_cache(self):
+        """Edits and deletes are never served stale."""
+        self.client.get(self.url + 'messages/')
+        message = Message.objects.get(message_body='old 0')
+        message.message_body = 'edited'
+        message.save()
+        self.assertIn('edited', self.bodies(self.client.get(self.url + 'messages/')))
+
+        message.delete()
+        self.assertNotIn('edited', self.bodies(self.client.get(self.url + 'messages/')))
+
+    def test_fill_racing_with_a_write_is_not_served(self):
+        """An entry filled from a read older than a write is ignored."""
+        for backend in (LocalRecentMessageBackend(), DjangoCacheRecentMessageBackend()):
+            cache = RecentMessageCache(backend, size=2)
+            key = uuid.uuid4()
+            generation = cache.current_generation(key)
+            cache.append(key, {'message_body': 'written meanwhile'})
+            cache.fill(key, generation, [{'message_body': 'stale'}], 1)
+            self.assertIsNone(cache.get(key))
+
+            cache.fill(key, cache.current_generation(key), [{'message_body': 'b'}], 1)
+            cache.append(key, {'message_body': 'c'})
+            cache.append(key, {'message_body': 'd'})
+            entry = cache.get(key)
+            self.assertEqual([m['message_body'] for m in entry['messages']], ['d', 'c'])
+            self.assertEqual(entry['count'], 3)
+
+    def test_local_backend_evicts_least_recently_used(self):
+        """The local backend keeps at most max_conversations buffers."""
+        cache = RecentMessageCache(LocalRecentMessageBackend(max_conversations=2))
+        for key in ('a', 'b', 'c'):
+            cache.fill(key, cache.current_generation(key), [], 0)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+
+    @override_settings(CHATS_RECENT_MESSAGES={})
+    def test_default_backend_is_shared_cache(self):
+        """Without configuration, buffers live in the shared Django cache."""
+        self.assertIsInstance(build_recent_message_cache().backend, DjangoCacheRecentMessageBackend)
+
+
+@override_settings(MIDDLEWARE=API_TEST_MIDDLEWARE, CHATS_INBOX_ENABLED=True, CHATS_INBOX_ASYNC=False)
+class InboxTest(TestCase):
+    """Tests for the fan-out-on-write inbox table."""
+
+    def setUp(self):
+        self.alice = create_user('alice')
+        self.bob = create_user('bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.add_participants([self.alice.pk, self.bob.pk])
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def send(self, sender, body):
+        return Message.objects.create(
+            sender=sender, conversation=self.conversation, message_body=body
+        )
+
+    def test_messages_update_every_participant(self):
+        """Writes update previews and unread counts for all members."""
+        self.send(self.alice, 'hello bob')
+        self.send(self.alice, 'x' * 200)
+        self.send(self.bob, 'hi alice')
+
+        entries = {e.user_id: e for e in InboxEntry.objects.all()}
+        self.assertEqual(entries[self.bob.pk].unread_count, 2)
+        self.assertEqual(entries[self.alice.pk].unread_count, 1)
+        self.assertEqual(entries[self.bob.pk].last_message_preview, 'hi alice')
+        self.assertEqual(entries[self.bob.pk].last_sender_id, self.bob.pk)
+
+    def test_edits_and_deletes_refresh_previews(self):
+        """Editing or deleting the latest message updates every preview."""
+        first = self.send(self.alice, 'first')
+        latest = self.send(self.bob, 'latest')
+
+        latest.message_body = 'edited'
+        latest.save()
+        entries = InboxEntry.objects.filter(conversation=self.conversation)
+        self.assertEqual({e.last_message_preview for e in entries}, {'edited'})
+
+        latest.delete()
+        for entry in InboxEntry.objects.filter(conversation=self.conversation):
+            self.assertEqual(entry.last_message_preview, 'first')
+            self.assertEqual(entry.last_sender_id, self.alice.pk)
+            self.assertEqual(entry.last_message_at, first.sent_at)
+
+        first.delete()
+        self.assertEqual(
+            set(entries.values_list('last_message_preview', 'last_message_at')), {('', None)}
+        )
+
+    def test_inbox_endpoint_and_mark_read(self):
+        """The inbox lists conversations by activity and can be marked read."""
+        other = Conversation.objects.create()
+        other.add_participants([self.bob.pk])
+        self.send(self.alice, 'latest')
+
+        response = self.client.get('/api/inbox/')
+        results = response.data['results']
+        self.assertEqual(results[0]['conversation_id'], str(self.conversation.pk))
+        self.assertEqual(results[0]['unread_count'], 1)
+        self.assertEqual(results[0]['last_sender']['username'], 'alice')
+
+        self.client.post(f'/api/conversations/{self.conversation.pk}/read/')
+        self.assertEqual(
+            InboxEntry.objects.get(user=self.bob, conversation=self.conversation).unread_count, 0
+        )
+
+    def test_membership_changes_and_rebuild(self):
+        """Leaving removes the row; check_inbox finds drift and rebuild fixes it."""
+        self.send(self.alice, 'before')
+        self.conversation.remove_participants([self.alice.pk])
+        self.assertFalse(InboxEntry.objects.filter(user=self.alice).exists())
+
+        InboxEntry.objects.filter(user=self.bob).update(last_message_preview='wrong')
+        with self.assertRaises(CommandError):
+            call_command('check_inbox', stdout=io.StringIO())
+
+        call_command('rebuild_inbox', stdout=io.StringIO())
+        entry = InboxEntry.objects.get(user=self.bob)
+        self.assertEqual(entry.last_message_preview, 'before')
+        self.assertEqual(entry.unread_count, 1)
+        call_command('check_inbox', stdout=io.StringIO())
+
+    @override_settings(CHATS_INBOX_ENABLED=False)
+    def test_disabled_inbox_is_not_served_or_maintained(self):
+        """With the flag off, nothing is written and the endpoint is a 404."""
+        InboxEntry.objects.all().delete()
+        self.send(self.alice, 'hello')
+        self.conversation.add_participants([create_user('carol').pk])
+
+        self.assertFalse(InboxEntry.objects.exists())
+        self.assertEqual(self.client.get('/api/inbox/').status_code, 404)
+
+
+@override_settings(CHATS_INBOX_ENABLED=True, CHATS_INBOX_ASYNC=True)
+class InboxFanoutTest(TransactionTestCase):
+    """Tests for the background inbox fan-out."""
+
+    def test_messages_are_fanned_out_after_commit(self):
+        """Committed messages reach the inbox rows from the background thread."""
+        alice = create_user('alice')
+        bob = create_user('bob')
+        conversation = Conversation.objects.create()
+        conversation.add_participants([alice.pk, bob.pk])
+        fanout = InboxFanout(flush_interval=0.01)
+
+        with mock.patch('chats.inbox.get_inbox_fanout', return_value=fanout):
+            for body in ('one', 'two'):
+                Message.objects.create(sender=alice, conversation=conversation, message_body=body)
+        fanout.shutdown(timeout=5)
+
+        entry = InboxEntry.objects.get(user=bob)
+        self.assertEqual(entry.unread_count, 2)
+        self.assertEqual(entry.last_message_preview, 'two')
+
+
+class RequestLogWriterTest(TestCase):
+    """Tests for the background request log writer and its middleware."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'requests.log')
+
+    def read_records(self, path=None):
+        with open(path or self.path, encoding='utf-8') as handle:
+            return [json.loads(line) for line in handle]
+
+    def test_dead_writer_thread_is_restarted(self):
+        """Records emitted after the writer thread died start a new one."""
+        writer = RequestLogWriter(path=self.path, flush_interval=0.01)
+        self.addCleanup(writer.shutdown, 5)
+        writer.emit({'path': '/first/'})
+        writer._queue.put(batching._STOP)
+        writer._thread.join(5)
+        self.assertFalse(writer.is_running())
+
+        self.assertTrue(writer.emit({'path': '/second/'}))
+        writer.shutdown(timeout=5)
+
+        self.assertEqual([record['path'] for record in self.read_records()], ['/first/', '/second/'])
+
+    def test_middleware_logs_status_and_latency(self):
+        """Each request becomes one JSON record written off the request thread."""
+        writer = RequestLogWriter(path=self.path, flush_interval=0.01)
+        with mock.patch('chats.middleware.get_request_log_writer', return_value=writer):
+            middleware = RequestLoggingMiddleware(lambda request: HttpResponse(status=201))
+        request = RequestFactory().post('/api/messages/')
+        request.user = create_user('alice')
+
+        response = middleware(request)
+        writer.shutdown(timeout=5)
+
+        self.assertEqual(response.status_code, 201)
+        [record] = self.read_records()
+        self.assertEqual(record['user'], 'alice')
+        self.assertEqual(record['method'], 'POST')
+        self.assertEqual(record['path'], '/api/messages/')
+        self.assertEqual(record['status'], 201)
+        self.assertGreaterEqual(record['duration_ms'], 0)
+        self.assertIn('time', record)
+
+    def test_middleware_redacts_query_values_outside_allowlist(self):
+        """Only allowlisted query parameters keep their values in the log."""
+        writer = RequestLogWriter(path=self.path, flush_interval=0.01)
+        with mock.patch('chats.middleware.get_request_log_writer', return_value=writer):
+            middleware = RequestLoggingMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get('/api/users/?q=alice&token=s3cret&page=2')
+        request.user = AnonymousUser()
+
+        middleware(request)
+        writer.shutdown(timeout=5)
+
+        [record] = self.read_records()
+        self.assertEqual(record['query'], 'q=REDACTED&token=REDACTED&page=2')
+        self.assertEqual(replay_requests.parse_line(json.dumps(record))['query'], 'page=2')
+
+    def test_full_queue_drops_and_reports(self):
+        """A full queue drops records without blocking and logs the count."""
+        writer = RequestLogWriter(path=self.path, queue_size=2)
+        with mock.patch.object(writer, 'start'):
+            results = [writer.emit({'path': f'/{i}'}) for i in range(5)]
+        self.assertEqual(results, [True, True, False, False, False])
+        self.assertEqual(writer.stats()['dropped'], 3)
+
+        writer._thread = None
+        writer.start()
+        writer.shutdown(timeout=5)
+        records = self.read_records()
+        self.assertEqual([r.get('path') for r in records[:2]], ['/0', '/1'])
+        self.assertEqual(records[-1], {'time': records[-1]['time'], 'event': 'dropped', 'count': 3})
+
+    def test_rotates_by_size(self):
+        """The file is rotated once it reaches max_bytes, keeping backup_count files."""
+        writer = RequestLogWriter(path=self.path, max_bytes=200, backup_count=2, batch_size=1)
+        for i in range(20):
+            writer.emit({'path': f'/{i}', 'padding': 'x' * 50})
+        writer.shutdown(timeout=5)
+
+        self.assertGreater(writer.stats()['rotations'], 2)
+        self.assertTrue(os.path.exists(self.path + '.2'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+        newest = self.read_records(self.path + '.1')
+        if os.path.exists(self.path):
+            newest += self.read_records()
+        self.assertEqual(newest[-1]['path'], '/19')
+
+    def test_pid_in_path_gives_each_process_its_own_file(self):
+        """{pid} in the path is replaced, so rotation only touches this process's file."""
+        template = self.path.replace('requests.log', 'requests.{pid}.log')
+        writer = RequestLogWriter(path=template, max_bytes=200, backup_count=1, batch_size=1)
+        for i in range(5):
+            writer.emit({'path': f'/{i}', 'padding': 'x' * 50})
+        writer.shutdown(timeout=5)
+
+        own = self.path.replace('requests.log', f'requests.{os.getpid()}.log')
+        self.assertEqual(writer.current_path(), own)
+        self.assertTrue(os.path.exists(own + '.1'))
+        self.assertFalse(os.path.exists(self.path))
+
+
+class RateLimiterTest(TestCase):
+    """Tests for the sliding-window rate limiter and its middleware."""
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.shared_path = os.path.join(directory.name, 'ratelimit.bin')
+
+    def backends(self):
+        return [
+            LocalRateLimitBackend(),
+            SharedMemoryRateLimitBackend(path=self.shared_path, slots=64),
+            DjangoCacheRateLimitBackend(),
+        ]
+
+    def test_sliding_window_on_every_backend(self):
+        """The previous window's count slides out as the current one advances."""
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                backend.clear()
+                limiter = RateLimiter(backend, limit=5, window=60)
+                results = [limiter.hit('ip:1', now=6000 + i)[0] for i in range(6)]
+                self.assertEqual(results, [True] * 5 + [False])
+
+                # A quarter into the next window 5 * 0.75 = 3.75 still count
+                self.assertEqual(limiter.hit('ip:1', now=6075), (True, 0))
+                allowed, retry_after = limiter.hit('ip:1', now=6076)
+                self.assertFalse(allowed)
+                self.assertGreater(retry_after, 0)
+                # Another key is counted separately
+                self.assertTrue(limiter.hit('ip:2', now=6076)[0])
+                # Two windows later everything has expired
+                self.assertTrue(limiter.hit('ip:1', now=6200)[0])
+
+    def test_shared_memory_counts_across_instances(self):
+        """Separate backend instances on one file share their counters."""
+        first = RateLimiter(SharedMemoryRateLimitBackend(path=self.shared_path), limit=2)
+        second = RateLimiter(SharedMemoryRateLimitBackend(path=self.shared_path), limit=2)
+        self.assertTrue(first.hit('user:a', now=600)[0])
+        self.assertTrue(second.hit('user:a', now=601)[0])
+        self.assertFalse(first.hit('user:a', now=602)[0])
+
+    def test_local_backend_evicts_idle_keys(self):
+        """Idle keys are dropped and the table never exceeds max_keys."""
+        backend = LocalRateLimitBackend(max_keys=3)
+        limiter = RateLimiter(backend, limit=5, window=60)
+        for i in range(5):
+            limiter.hit(f'ip:{i}', now=600)
+        self.assertEqual(len(backend), 3)
+        limiter.hit('ip:late', now=800)
+        self.assertEqual(len(backend), 1)
+
+    def test_middleware_keys_by_user_then_ip(self):
+        """Authenticated requests are limited per user, others per IP."""
+        limiter = RateLimiter(LocalRateLimitBackend(), limit=1, window=60)
+        with mock.patch('chats.middleware.rate_limiter', limiter):
+            middleware = OffensiveLanguageMiddleware(lambda request: HttpResponse())
+        factory = RequestFactory()
+        alice = create_user('alice')
+        token = str(AccessToken.for_user(alice))
+
+        def post(ip, **extra):
+            return middleware(factory.post('/api/messages/', REMOTE_ADDR=ip, **extra))
+
+        self.assertEqual(post('10.0.0.1').status_code, 200)
+        response = post('10.0.0.1')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        # A JWT user behind the same IP has their own budget
+        self.assertEqual(post('10.0.0.1', HTTP_AUTHORIZATION=f'Bearer {token}').status_code, 200)
+        self.assertEqual(post('10.0.0.2', HTTP_AUTHORIZATION=f'Bearer {token}').status_code, 429)
+        # GET requests are never limited
+        self.assertEqual(middleware(factory.get('/api/messages/', REMOTE_ADDR='10.0.0.1')).status_code, 200)
+
+
+class MetricsTest(TestCase):
+    """Tests for latency histograms and the metrics endpoint."""
+
+    def test_middleware_time_excludes_downstream(self):
+        """A wrapped middleware is charged only for its own work."""
+        registry = MetricsRegistry()
+
+        @timed_middleware
+        class Passthrough:
+            def __init__(self, get_response):
+                self.get_response = get_response
+
+            def __call__(self, request):
+                return self.get_response(request)
+
+        def slow_view(request):
+            time.sleep(0.05)
+            return HttpResponse()
+
+        with mock.patch('chats.metrics.metrics', registry):
+            Passthrough(Passthrough(slow_view))(RequestFactory().get('/'))
+
+        [(labels, histogram)] = registry.snapshot()['histograms']['chats_middleware_seconds']
+        self.assertEqual(labels, [['middleware', 'Passthrough']])
+        self.assertEqual(histogram['count'], 2)
+        self.assertLess(histogram['sum'], 0.04)
+
+    def test_render_merges_worker_snapshots(self):
+        """Histograms from other workers' snapshots are summed into the output."""
+        with tempfile.TemporaryDirectory() as directory:
+            other = {
+                'pid': os.getppid(),
+                'histograms': {'chats_view_seconds': [
+                    [[['method', 'GET'], ['view', 'user-list']],
+                     {'counts': [0] * 16 + [1], 'sum': 20.0, 'count': 1}],
+                ]},
+                'collectors': {'chats_pool': {'pending': 3}},
+            }
+            with open(os.path.join(directory, 'worker-1.json'), 'w') as handle:
+                json.dump(other, handle)
+
+            registry = MetricsRegistry(directory=directory)
+            registry.observe('chats_view_seconds', 0.002, view='user-list', method='GET')
+            registry.register_collector('chats_pool', lambda: {'pending': 1, 'name': 'x'})
+            output = registry.render()
+
+        self.assertIn('chats_view_seconds_bucket{method="GET",view="user-list",le="0.0025"} 1', output)
+        self.assertIn('chats_view_seconds_bucket{method="GET",view="user-list",le="+Inf"} 2', output)
+        self.assertIn('chats_view_seconds_count{method="GET",view="user-list"} 2', output)
+        self.assertIn(f'chats_pool_pending{{pid="{os.getpid()}"}} 1', output)
+        self.assertIn(f'chats_pool_pending{{pid="{os.getppid()}"}} 3', output)
+        self.assertNotIn('chats_pool_name', output)
+
+    @override_settings(
+        MIDDLEWARE=API_TEST_MIDDLEWARE + ['chats.middleware.RequestMetricsMiddleware']
+    )
+    def test_metrics_endpoint(self):
+        """View timings and collector values are served to allowed clients."""
+        client = APIClient()
+        client.force_authenticate(create_user('alice'))
+        client.get('/api/users/')
+
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('chats_view_seconds_count{method="GET",view="user-list"}', body)
+        self.assertIn('chats_recent_messages_hits{pid=', body)
+        self.assertIn('chats_password_verifier_pending{pid=', body)
+
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.9').status_code, 403)
+
+
+@mock.patch('chats.middleware.datetime')
+class AsyncMiddlewareTest(TestCase):
+    """Tests for the async paths of the custom middleware."""
+
+    def build_stack(self, get_response):
+        writer = mock.patch('chats.middleware.get_request_log_writer')
+        writer.start()
+        self.addCleanup(writer.stop)
+        handler = get_response
+        for middleware_class in reversed([
+            RequestLoggingMiddleware,
+            RestrictAccessByTimeMiddleware,
+            OffensiveLanguageMiddleware,
+            RolepermissionMiddleware,
+            RequestMetricsMiddleware,
+        ]):
+            handler = middleware_class(handler)
+            self.assertTrue(iscoroutinefunction(handler))
+        return handler
+
+    async def test_async_stack_runs_without_thread_hops(self, fake_datetime):
+        """An async chain stays on the event loop and keeps sync behavior."""
+        fake_datetime.now.return_value = datetime(2026, 1, 1, 12, 0)
+
+        async def view(request):
+            return HttpResponse(status=204)
+
+        limiter = RateLimiter(LocalRateLimitBackend(), limit=1, window=60)
+        with mock.patch('chats.middleware.rate_limiter', limiter), \
+                mock.patch('chats.middleware.sync_to_async') as sync_to_async:
+            stack = self.build_stack(view)
+            factory = RequestFactory()
+            self.assertEqual((await stack(factory.get('/api/inbox/'))).status_code, 204)
+            self.assertEqual((await stack(factory.post('/api/inbox/'))).status_code, 204)
+            self.assertEqual((await stack(factory.post('/api/inbox/'))).status_code, 429)
+        sync_to_async.assert_not_called()
+
+    async def test_async_stack_denies_like_sync(self, fake_datetime):
+        """Time and role checks answer the same way on the async path."""
+        async def view(request):
+            return HttpResponse()
+
+        stack = self.build_stack(view)
+        request = RequestFactory().get('/api/users/')
+        request.user = SimpleLazyObject(AnonymousUser)
+
+        fake_datetime.now.return_value = datetime(2026, 1, 1, 12, 0)
+        self.assertEqual((await stack(request)).status_code, 401)
+        fake_datetime.now.return_value = datetime(2026, 1, 1, 22, 0)
+        self.assertEqual((await stack(RequestFactory().get('/api/inbox/'))).status_code, 403)
+
+
+class PathPolicyTableTest(TestCase):
+    """Tests for the compiled path policy table."""
+
+    def setUp(self):
+        self.table = PathPolicyTable({
+            '/api/': {'log': True, 'rate_limit': True},
+            '/api/users/': {'roles': ['admin']},
+            '/api/users/public/': {'roles': None, 'rate_limit': False},
+        })
+
+    def test_longest_prefix_inherits_and_overrides(self):
+        """A prefix inherits from the one above it and overrides its own keys."""
+        self.assertEqual(self.table.classify('/api/inbox/'), PathPolicy(log=True, rate_limit=True))
+        self.assertEqual(
+            self.table.classify('/api/users/42/'),
+            PathPolicy(log=True, rate_limit=True, roles=['admin'])
+        )
+        self.assertEqual(
+            self.table.classify('/api/users/public/x/'),
+            PathPolicy(log=True, rate_limit=False)
+        )
+        # Prefixes match whole segments only
+        self.assertEqual(self.table.classify('/api/usersearch/').roles, None)
+        self.assertEqual(self.table.classify('/admin/'), PathPolicy())
+        self.assertEqual(self.table.classify('/'), PathPolicy())
+
+    def test_invalid_configuration(self):
+        """Unknown keys and malformed prefixes fail at compile time."""
+        with self.assertRaises(ImproperlyConfigured):
+            PathPolicyTable({'/api/': {'audit': True}})
+        with self.assertRaises(ImproperlyConfigured):
+            PathPolicyTable({'/api': {'log': True}})
+
+    def test_policy_is_attached_once(self):
+        """The first middleware classifies the path; the rest reuse it."""
+        request = RequestFactory().get('/api/messages/')
+        with mock.patch.object(
+            path_policies, 'classify', wraps=path_policies.classify
+        ) as classify:
+            self.assertEqual(get_policy(request).roles, ('admin', 'moderator'))
+            get_policy(request)
+        classify.assert_called_once_with('/api/messages/')
+
+
+@override_settings(MIDDLEWARE=API_TEST_MIDDLEWARE)
+class ReplayRequestsTest(LiveServerTestCase):
+    """Tests for the request log replay command."""
+
+    def test_replays_both_log_formats(self):
+        """JSON and legacy lines are replayed, as the logged users, per path."""
+        alice = create_user('alice')
+        conversation = Conversation.objects.create()
+        conversation.add_participants([alice.pk])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'requests.log')
+            with open(path, 'w', encoding='utf-8') as handle:
+                handle.write(
+                    '2026-01-01 12:00:00.000000 - User: Anonymous - Path: /api/users/\n'
+                    '{"time":"2026-01-01T12:00:00.050+00:00","user":"alice","method":"GET",'
+                    f'"path":"/api/conversations/{conversation.pk}/messages/","query":"page=1",'
+                    '"status":200,"duration_ms":3.2}\n'
+                    '{"time":"2026-01-01T12:00:00.100+00:00","user":"alice","method":"POST",'
+                    '"path":"/api/messages/","query":"","status":201,"duration_ms":4.0}\n'
+                    '{"time":"2026-01-01T12:00:00.200+00:00","event":"dropped","count":2}\n'
+                )
+            out = io.StringIO()
+            call_command(
+                'replay_requests', path, base_url=self.live_server_url,
+                speedup=0, auth='logged-users', stdout=out
+            )
+
+        report = out.getvalue()
+        self.assertIn('/api/conversations/{id}/messages/', report)
+        self.assertRegex(report, r'/api/conversations/\{id\}/messages/ +1 .* 200=1')
+        self.assertRegex(report, r'/api/users/ +1 .* 401=1')
+        self.assertRegex(report, r'TOTAL +2 ')
+        self.assertIn('Replayed 2 requests', report)
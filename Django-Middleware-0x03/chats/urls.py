@@ -1,12 +1,13 @@
 """URL configuration for chats app."""
 from django.urls import path, include
 from rest_framework import routers
-from .views import UserViewSet, ConversationViewSet, MessageViewSet
+from .views import UserViewSet, ConversationViewSet, MessageViewSet, InboxViewSet
 
 router = routers.DefaultRouter()
 router.register(r'users', UserViewSet, basename='user')
 router.register(r'conversations', ConversationViewSet, basename='conversation')
 router.register(r'messages', MessageViewSet, basename='message')
+router.register(r'inbox', InboxViewSet, basename='inbox')
 
 urlpatterns = [
     path('', include(router.urls)),
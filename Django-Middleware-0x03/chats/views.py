@@ -1,22 +1,37 @@
 """Views for the messaging application."""
-from rest_framework import viewsets, status, filters
+import uuid
+
+from rest_framework import viewsets, status, filters, serializers
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from django.db import IntegrityError
+from django.db.models import Count, Prefetch
 from django_filters.rest_framework import DjangoFilterBackend
-from .models import User, Conversation, Message
+from .models import User, Conversation, Message, InboxEntry
 from .serializers import (
     UserSerializer,
     ConversationSerializer,
-    MessageSerializer
+    MessageSerializer,
+    ParticipantSerializer,
+    ParticipantIdsSerializer,
+    InboxEntrySerializer
 )
 from .permissions import (
+    CanManageParticipants,
     IsParticipantOfConversation,
     IsMessageSender,
     IsAdminOrOwner
 )
-from .pagination import MessagePagination, ConversationPagination
+from .pagination import MessagePagination, ConversationPagination, ParticipantPagination
 from .filters import MessageFilter, ConversationFilter
+from .exports import EXPORT_FORMATS, streaming_export_response
+from .autocomplete import user_index
+from .ingest import save_message
+from .recent import recent_messages
+from .inbox import is_enabled as inbox_enabled, mark_read
 
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -56,6 +71,23 @@ class UserViewSet(viewsets.ModelViewSet):
         """Get current authenticated user."""
         serializer = self.get_serializer(request.user)
         return Response(serializer.data)
+    
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def autocomplete(self, request):
+        """
+        Return users whose username or name starts with ?q=.
+        Served from an in-memory prefix index instead of icontains scans.
+        """
+        try:
+            limit = int(request.query_params.get('limit', user_index.DEFAULT_LIMIT))
+        except ValueError:
+            return Response(
+                {'error': 'limit must be an integer'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        results = user_index.search(request.query_params.get('q', ''), limit)
+        return Response({'results': results})
 
 
 class ConversationViewSet(viewsets.ModelViewSet):
@@ -74,9 +106,24 @@ class ConversationViewSet(viewsets.ModelViewSet):
         """
         user = self.request.user
         if user.is_authenticated:
-            return Conversation.objects.filter(
-                participants=user
-            ).prefetch_related('participants', 'messages').distinct()
+            # Filter through a membership subquery so the participant join
+            # below counts every member, not just the requesting user
+            memberships = Conversation.participants.through.objects.filter(
+                user_id=user.pk
+            ).values('conversation_id')
+            queryset = Conversation.objects.filter(conversation_id__in=memberships)
+            if self.action in ('export', 'participants', 'messages', 'add_message', 'read'):
+                # Messages and participants are fetched separately
+                return queryset
+            sample = User.objects.order_by('username', 'user_id')[
+                :ConversationSerializer.PARTICIPANT_SAMPLE_SIZE
+            ]
+            return queryset.annotate(
+                participant_count=Count('participants')
+            ).prefetch_related(
+                Prefetch('participants', queryset=sample, to_attr='participant_sample'),
+                'messages'
+            )
         return Conversation.objects.none()
     
     def perform_create(self, serializer):
@@ -85,19 +132,24 @@ class ConversationViewSet(viewsets.ModelViewSet):
         """
         conversation = serializer.save()
         # Add the creator as a participant if not already added
-        if self.request.user not in conversation.participants.all():
-            conversation.participants.add(self.request.user)
+        conversation.add_participants([self.request.user.pk])
     
     @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated, IsParticipantOfConversation])
     def add_message(self, request, pk=None):
         """
         Add a message to a conversation.
         Only participants can send messages.
+        
+        An Idempotency-Key header (a UUID) becomes the message's id, so a
+        retried request returns the message already saved instead of
+        creating a second one; a key already used for another message is
+        a 409. If the write is not confirmed in time the response is 503
+        with the key to retry with.
         """
         conversation = self.get_object()
         
         # Verify user is a participant
-        if request.user not in conversation.participants.all():
+        if not conversation.has_participant(request.user):
             return Response(
                 {'error': 'You must be a participant to send messages'},
                 status=status.HTTP_403_FORBIDDEN
@@ -109,10 +161,66 @@ class ConversationViewSet(viewsets.ModelViewSet):
         message_data['conversation'] = conversation.conversation_id
         
         serializer = MessageSerializer(data=message_data)
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        message = Message(**serializer.validated_data)
+        key = request.headers.get('Idempotency-Key')
+        if key:
+            try:
+                message.message_id = uuid.UUID(key)
+            except ValueError:
+                return Response(
+                    {'error': 'Idempotency-Key must be a UUID'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            replay = self.idempotent_response(message)
+            if replay is not None:
+                return replay
+        
+        try:
+            # Coalesced into a batched INSERT when write coalescing is enabled
+            serializer.instance = save_message(message)
+        except TimeoutError:
+            return Response(
+                {
+                    'error': 'Message write not confirmed',
+                    'message': 'The message may still be saved; retry with the same Idempotency-Key.',
+                    'idempotency_key': str(message.message_id)
+                },
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': '1'}
+            )
+        except IntegrityError:
+            # A retry raced the original request, which has now committed
+            replay = self.idempotent_response(message) if key else None
+            if replay is None:
+                raise
+            return replay
+        recent_messages.append(conversation.conversation_id, serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+    
+    def idempotent_response(self, message):
+        """
+        Return the response for an Idempotency-Key that was already used, or None.
+        
+        A key naming the sender's earlier message in the same conversation
+        replays it with 200; a key already naming any other message is a 409.
+        """
+        existing = Message.objects.select_related('sender').filter(
+            message_id=message.message_id
+        ).first()
+        if existing is None:
+            return None
+        if (existing.sender_id, existing.conversation_id) != (message.sender_id, message.conversation_id):
+            return Response(
+                {
+                    'error': 'Idempotency-Key already used',
+                    'message': 'The key belongs to another message; send a new key.'
+                },
+                status=status.HTTP_409_CONFLICT
+            )
+        return Response(MessageSerializer(existing).data, status=status.HTTP_200_OK)
     
     @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated, IsParticipantOfConversation])
     def messages(self, request, pk=None):
@@ -120,14 +228,140 @@ class ConversationViewSet(viewsets.ModelViewSet):
         Get all messages in a conversation with pagination.
         """
         conversation = self.get_object()
-        messages = conversation.messages.all().order_by('-sent_at')
+        paginator = MessagePagination()
+        page_size = paginator.get_page_size(request)
+        first_page = request.query_params.get(paginator.page_query_param, '1') == '1'
+        
+        # The first page of a busy conversation is served from the recent-message cache
+        if first_page and page_size <= recent_messages.size:
+            cached = recent_messages.get(conversation.conversation_id)
+            if cached is not None:
+                return self.recent_messages_response(request, paginator, cached, page_size)
+        
+        generation = recent_messages.current_generation(conversation.conversation_id)
+        messages = conversation.messages.select_related('sender').order_by('-sent_at')
         
         # Apply pagination
-        paginator = MessagePagination()
         paginated_messages = paginator.paginate_queryset(messages, request)
         
         serializer = MessageSerializer(paginated_messages, many=True)
+        if first_page and page_size >= recent_messages.size:
+            django_paginator = paginator.page.paginator
+            recent_messages.fill(
+                conversation.conversation_id,
+                generation,
+                serializer.data,
+                django_paginator.count,
+                django_paginator.is_approximate
+            )
         return paginator.get_paginated_response(serializer.data)
+    
+    def recent_messages_response(self, request, paginator, cached, page_size):
+        """Build the first-page response from a recent-message cache entry."""
+        results = list(cached['messages'])[:page_size]
+        next_link = None
+        if cached['count'] > page_size:
+            next_link = replace_query_param(
+                request.build_absolute_uri(), paginator.page_query_param, 2
+            )
+        return Response({
+            'count': cached['count'],
+            'count_is_approximate': cached['count_is_approximate'],
+            'next': next_link,
+            'previous': None,
+            'results': results
+        })
+    
+    @action(detail=True, methods=['get', 'post', 'delete'], permission_classes=[IsAuthenticated, IsParticipantOfConversation, CanManageParticipants])
+    def participants(self, request, pk=None):
+        """
+        List, add or remove conversation participants.
+        
+        GET returns a paginated participant list. POST and DELETE take
+        {"user_ids": [...]} and only touch the given memberships, so the cost
+        depends on the number of ids, not the size of the conversation.
+        Only hosts and admins may add members or remove others; any member
+        may remove themselves.
+        """
+        conversation = self.get_object()
+        
+        if request.method == 'GET':
+            participants = conversation.participants.order_by('username', 'user_id')
+            paginator = ParticipantPagination()
+            page = paginator.paginate_queryset(participants, request)
+            serializer = ParticipantSerializer(page, many=True)
+            return paginator.get_paginated_response(serializer.data)
+        
+        ids_serializer = ParticipantIdsSerializer(data=request.data)
+        ids_serializer.is_valid(raise_exception=True)
+        user_ids = ids_serializer.validated_data['user_ids']
+        
+        if request.method == 'POST':
+            added = conversation.add_participants(user_ids)
+            return Response({'added': added}, status=status.HTTP_200_OK)
+        
+        removed = conversation.remove_participants(user_ids)
+        return Response({'removed': removed}, status=status.HTTP_200_OK)
+    
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated, IsParticipantOfConversation])
+    def read(self, request, pk=None):
+        """Mark the conversation as read in the user's inbox."""
+        conversation = self.get_object()
+        mark_read(request.user, conversation.conversation_id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    
+    def get_export_format(self, request):
+        """Return the requested export format, or None if unsupported."""
+        export_format = request.query_params.get('file_format', 'ndjson').lower()
+        if export_format not in EXPORT_FORMATS:
+            return None
+        return export_format
+    
+    def unsupported_export_format_response(self):
+        """Return a 400 response listing the supported export formats."""
+        return Response(
+            {'error': f"file_format must be one of: {', '.join(EXPORT_FORMATS)}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated, IsParticipantOfConversation])
+    def export(self, request, pk=None):
+        """
+        Stream the full transcript of a conversation as NDJSON or CSV.
+        Use ?file_format=ndjson (default) or ?file_format=csv.
+        """
+        export_format = self.get_export_format(request)
+        if export_format is None:
+            return self.unsupported_export_format_response()
+        
+        conversation = self.get_object()
+        messages = Message.objects.filter(
+            conversation=conversation
+        ).order_by('sent_at', 'message_id')
+        return streaming_export_response(
+            messages,
+            export_format,
+            f'conversation-{conversation.conversation_id}'
+        )
+    
+    @action(detail=False, methods=['get'], url_path='export', permission_classes=[IsAuthenticated])
+    def export_all(self, request):
+        """
+        Stream the transcripts of all of the user's conversations as NDJSON or CSV.
+        Messages are grouped by conversation and ordered by send time.
+        """
+        export_format = self.get_export_format(request)
+        if export_format is None:
+            return self.unsupported_export_format_response()
+        
+        messages = Message.objects.filter(
+            conversation__participants=request.user
+        ).order_by('conversation_id', 'sent_at', 'message_id')
+        return streaming_export_response(
+            messages,
+            export_format,
+            f'conversations-{request.user.user_id}'
+        )
 
 
 class MessageViewSet(viewsets.ModelViewSet):
@@ -169,9 +403,37 @@ class MessageViewSet(viewsets.ModelViewSet):
         conversation = serializer.validated_data.get('conversation')
         
         # Verify user is a participant
-        if self.request.user not in conversation.participants.all():
+        if not conversation.has_participant(self.request.user):
             raise serializers.ValidationError(
                 'You must be a participant of the conversation to send messages'
             )
         
         serializer.save(sender=self.request.user)
+        recent_messages.append(conversation.conversation_id, serializer.data)
+
+
+class InboxViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    ViewSet for the user's inbox.
+    
+    Lists the user's conversations newest activity first from the
+    InboxEntry table, a single indexed range read. Answers 404 unless
+    CHATS_INBOX_ENABLED is set.
+    """
+    serializer_class = InboxEntrySerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = ConversationPagination
+    filter_backends = []
+    lookup_field = 'conversation_id'
+    
+    def initial(self, request, *args, **kwargs):
+        """Hide the endpoint while the inbox table is not maintained."""
+        if not inbox_enabled():
+            raise NotFound()
+        super().initial(request, *args, **kwargs)
+    
+    def get_queryset(self):
+        """Return the user's inbox rows ordered by latest activity."""
+        return InboxEntry.objects.filter(
+            user=self.request.user
+        ).select_related('last_sender').order_by('-last_message_at', '-id')
@@ -57,6 +57,7 @@ MIDDLEWARE = [
     'chats.middleware.RestrictAccessByTimeMiddleware',
     'chats.middleware.OffensiveLanguageMiddleware',
     'chats.middleware.RolepermissionMiddleware',
+    'chats.middleware.RequestMetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'messaging_app.urls'
@@ -171,3 +172,91 @@ SIMPLE_JWT = {
     'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),
     'TOKEN_TYPE_CLAIM': 'token_type',
 }
+
+# Message ingestion
+# When enabled, add_message hands new messages to an in-process queue that
+# commits them in micro-batches with bulk_create (group commit).
+CHATS_MESSAGE_WRITE_COALESCING = False
+CHATS_MESSAGE_WRITE_BATCH_SIZE = 500
+CHATS_MESSAGE_WRITE_FLUSH_INTERVAL = 0.005  # seconds
+CHATS_MESSAGE_WRITE_TIMEOUT = 5  # seconds a request waits for its batch
+
+# Password verification pool used by the login endpoint
+CHATS_PASSWORD_WORKERS = 4
+CHATS_PASSWORD_MAX_PENDING = 64  # pending checks before login returns 429
+
+# Recent-message cache used for the first page of conversation messages.
+# Entries live in the 'default' cache, which must be shared (e.g. Redis or
+# Memcached) when running several workers. Single-process deployments may use
+# 'chats.recent.LocalRecentMessageBackend' with
+# {'max_conversations': 1000, 'timeout': 300} as OPTIONS instead.
+CHATS_RECENT_MESSAGES = {
+    'BACKEND': 'chats.recent.DjangoCacheRecentMessageBackend',
+    'SIZE': 20,
+    'OPTIONS': {
+        'alias': 'default',
+        'timeout': 300,
+    },
+}
+
+# Optional per-user inbox table maintained on message write (fan-out on
+# write), served at /api/inbox/. Off by default. Messages are fanned out by a
+# background thread after they commit; CHATS_INBOX_ASYNC = False does it in
+# the writing transaction instead. Run `python manage.py rebuild_inbox` after
+# enabling it on existing data.
+CHATS_INBOX_ENABLED = False
+CHATS_INBOX_ASYNC = True
+
+# Request log written by RequestLoggingMiddleware on a background thread.
+# Each process writes and rotates its own file; {pid} in PATH is replaced
+# with the process id.
+# Records that do not fit in the queue are dropped (and counted) rather than
+# delaying requests. Query parameters outside QUERY_PARAMS are logged with
+# their values redacted.
+CHATS_REQUEST_LOG = {
+    'PATH': str(BASE_DIR / 'requests.{pid}.log'),
+    'MAX_BYTES': 10 * 1024 * 1024,  # rotate after 10 MB
+    'BACKUP_COUNT': 5,
+    'QUEUE_SIZE': 10000,
+    'BATCH_SIZE': 256,
+    'FLUSH_INTERVAL': 0.5,  # seconds
+    'QUERY_PARAMS': ['page', 'page_size', 'limit', 'file_format'],
+}
+
+# Sliding-window rate limit applied to POST requests by
+# OffensiveLanguageMiddleware. KEY is 'user_or_ip' or 'ip'. The local backend
+# counts per process; use 'chats.ratelimit.SharedMemoryRateLimitBackend' for
+# several workers on one host, or 'chats.ratelimit.DjangoCacheRateLimitBackend'
+# with a shared cache across hosts.
+CHATS_RATE_LIMIT = {
+    'BACKEND': 'chats.ratelimit.LocalRateLimitBackend',
+    'OPTIONS': {
+        'max_keys': 100000,
+    },
+    'LIMIT': 5,
+    'WINDOW': 60,  # seconds
+    'KEY': 'user_or_ip',
+}
+
+# Latency histograms served at /metrics/. With several worker processes, set
+# DIRECTORY to a path shared by the workers so the endpoint reports all of
+# them, not just the one answering the scrape.
+CHATS_METRICS = {
+    'DIRECTORY': None,
+    'PERSIST_INTERVAL': 5,  # seconds between snapshot writes per worker
+    'ALLOWED_IPS': ['127.0.0.1', '::1'],  # None allows every client
+}
+
+# Checks the chats middleware apply below each path prefix. A prefix inherits
+# from the longest configured prefix above it; paths matching no prefix skip
+# the checks entirely. Compiled once at startup (see chats.policies).
+CHATS_PATH_POLICIES = {
+    '/api/': {
+        'log': True,
+        'restrict_hours': True,
+        'rate_limit': True,
+    },
+    '/api/users/': {'roles': ['admin', 'moderator']},
+    '/api/conversations/': {'roles': ['admin', 'moderator']},
+    '/api/messages/': {'roles': ['admin', 'moderator']},
+}
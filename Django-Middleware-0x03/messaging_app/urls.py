@@ -23,6 +23,7 @@ from rest_framework_simplejwt.views import (
     TokenVerifyView,
 )
 from chats.auth import register_user, login_user, logout_user
+from chats.metrics import metrics_view
 
 
 def api_root(request):
@@ -61,6 +62,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('chats.urls')),
     path('api-auth/', include('rest_framework.urls')),
+    path('metrics/', metrics_view, name='metrics'),
     
     # JWT Authentication endpoints
     path('api/auth/register/', register_user, name='auth_register'),
@@ -1,26 +1,28 @@
 """
 Views for the chats app with caching implementation.
 
-Task 5: Implements basic view-level caching using Django's cache_page decorator.
+Task 5: Implements view-level caching per user with messaging.cache, so
+pages stay cached until one of the user's messages changes.
 """
 
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
-from django.views.decorators.cache import cache_page
+from messaging.cache import page_timeout, user_cache_page
 from messaging.models import Message
 
 
 @login_required
-@cache_page(60)  # Cache for 60 seconds as required by Task 5
+@user_cache_page()
 def conversation_list(request):
     """
     Task 5: Display a list of messages in a conversation with caching.
     
-    This view is cached for 60 seconds using the @cache_page decorator.
-    This reduces database load by serving cached responses for repeated
-    requests within the cache timeout period.
+    This view is cached with the @user_cache_page decorator. Repeated
+    requests are served from the cache until one of the user's messages
+    changes, or at most for the cache timeout.
     
-    The cache key is automatically generated based on the URL and user session.
+    The cache key is generated from the user, the user's cache version and
+    the URL, so cached pages are never shared between users.
     """
     # Get all messages involving the current user
     messages = Message.objects.filter(
@@ -29,20 +31,20 @@ def conversation_list(request):
     
     context = {
         'messages': messages,
-        'cache_timeout': 60,  # Display cache info to user
+        'cache_timeout': page_timeout(),  # Display cache info to user
     }
     
     return render(request, 'chats/conversation_list.html', context)
 
 
 @login_required
-@cache_page(60)
+@user_cache_page()
 def message_list(request):
     """
     Alternative cached view for displaying messages.
     
-    This demonstrates basic view-level caching with a 60-second timeout.
-    Multiple views can use caching to improve performance across the app.
+    This demonstrates per-user view-level caching: the page is rebuilt only
+    after one of the user's sent or received messages changes.
     """
     # Get messages with optimized queries
     sent_messages = Message.objects.filter(
@@ -0,0 +1,85 @@
+"""
+Marking many messages or notifications read at once.
+
+Task 4: Message.mark_as_read and Notification.mark_as_read save one row at a
+time, each with its own signals. The functions here mark every matching
+unread row of one user with a single UPDATE instead:
+
+- with no arguments, everything the user has not read yet
+- with ``until``, what arrived at or before that time
+- with ``ids``, only those rows (ids of other users' rows are ignored)
+
+The UPDATE only touches rows that are still unread, so the number it
+reports is exactly what leaves the user's unread count, which is adjusted
+in the same transaction (see messaging.counters). The user's cached pages
+are invalidated once it commits; read state is only shown on the
+receiver's own pages, so no other user's pages are affected.
+"""
+
+from django.db import transaction
+
+from .cache import bump_on_commit
+from .counters import adjust_unread
+from .models import Message, Notification
+
+
+def mark_read(queryset, user_id, field, ids=None, until=None):
+    """
+    Mark the unread rows of ``queryset`` read with one UPDATE.
+
+    Args:
+        queryset: The user's messages or notifications
+        user_id: The user whose counts they are part of
+        field: 'messages' or 'notifications', the counter to adjust
+        ids: Optional primary keys to restrict to
+        until: Optional datetime; only rows with an earlier or equal timestamp
+
+    Returns:
+        Number of rows marked read
+    """
+    queryset = queryset.filter(read=False)
+    if ids is not None:
+        queryset = queryset.filter(pk__in=ids)
+    if until is not None:
+        queryset = queryset.filter(timestamp__lte=until)
+    with transaction.atomic():
+        marked = queryset.update(read=True)
+        if marked:
+            changes = (-marked, 0) if field == 'messages' else (0, -marked)
+            adjust_unread({user_id: changes})
+            bump_on_commit(user_ids=[user_id])
+    return marked
+
+
+def mark_messages_read(user, ids=None, until=None):
+    """
+    Mark messages received by ``user`` read.
+
+    Args:
+        user: The receiving User
+        ids: Optional message ids to restrict to
+        until: Optional datetime; only messages sent at or before it
+
+    Returns:
+        Number of messages marked read
+    """
+    return mark_read(
+        Message.objects.filter(receiver_id=user.pk), user.pk, 'messages', ids, until
+    )
+
+
+def mark_notifications_read(user, ids=None, until=None):
+    """
+    Mark notifications of ``user`` read.
+
+    Args:
+        user: The User the notifications belong to
+        ids: Optional notification ids to restrict to
+        until: Optional datetime; only notifications created at or before it
+
+    Returns:
+        Number of notifications marked read
+    """
+    return mark_read(
+        Notification.objects.filter(user_id=user.pk), user.pk, 'notifications', ids, until
+    )
@@ -0,0 +1,144 @@
+"""
+Per-user page caching with version keys.
+
+Task 5: cache_page keys pages by URL alone, so a page rendered for one user
+could be served to another, and every page was rebuilt after 60 seconds
+whether or not anything had changed. user_cache_page instead keys each page
+by the requesting user and by that user's cache version:
+
+- every change to a message bumps the version of its sender and receiver,
+  and every change to a notification bumps its user's (see
+  messaging.signals); bulk updates bump the versions of the users they touch
+- a bumped version makes every page cached for the user unreachable, so the
+  next request renders a fresh one; old entries simply expire
+- pages showing a whole thread also carry the thread's version, bumped when
+  any message in the thread changes, since its participants can be more
+  than the viewer's correspondents
+
+Versions are bumped once the change commits, so a page rendered from data
+that is about to change is never cached under the new version. A version
+missing from the cache starts at the current time in microseconds, never at
+a number an evicted version may already have used.
+
+Versions must be visible to every process serving pages, so deployments
+with several workers need a shared cache backend (Memcached, Redis or the
+database) rather than LocMemCache.
+
+    MESSAGING_PAGE_CACHE = {
+        'TIMEOUT': 600,
+    }
+"""
+
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import patch_cache_control, patch_vary_headers
+
+KEY_PREFIX = 'messaging'
+
+
+def user_version_key(user_id):
+    """Return the cache key of a user's page version."""
+    return f'{KEY_PREFIX}:version:user:{user_id}'
+
+
+def thread_version_key(thread_root_id):
+    """Return the cache key of a thread's page version."""
+    return f'{KEY_PREFIX}:version:thread:{thread_root_id}'
+
+
+def get_versions(keys):
+    """
+    Return the current value of each version key, creating missing ones.
+
+    Args:
+        keys: Version cache keys
+
+    Returns:
+        List of versions in the order of ``keys``
+    """
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        initial = time.time_ns() // 1000
+        for key in missing:
+            # Another request may have created it meanwhile
+            cache.add(key, initial, timeout=None)
+        versions.update(cache.get_many(missing))
+    return [versions.get(key, 0) for key in keys]
+
+
+def bump_versions(keys):
+    """Invalidate the pages cached under each of ``keys`` right away."""
+    for key in set(keys):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Not created yet, so nothing has been cached under it
+            pass
+
+
+def bump_on_commit(user_ids=(), thread_root_ids=()):
+    """
+    Bump the versions of users and threads once the current transaction commits.
+
+    Args:
+        user_ids: Users whose pages show the changed rows
+        thread_root_ids: Threads whose pages show the changed rows
+    """
+    keys = [user_version_key(user_id) for user_id in user_ids if user_id is not None]
+    keys += [
+        thread_version_key(thread_root_id)
+        for thread_root_id in thread_root_ids if thread_root_id is not None
+    ]
+    if keys:
+        transaction.on_commit(lambda: bump_versions(keys))
+
+
+def page_timeout():
+    """Return how long cached pages are kept, from the MESSAGING_PAGE_CACHE setting."""
+    return getattr(settings, 'MESSAGING_PAGE_CACHE', {}).get('TIMEOUT', 600)
+
+
+def user_cache_page(version_keys=None):
+    """
+    Decorator caching a view's successful GET responses per user and version.
+
+    Args:
+        version_keys: Optional function called with the view's arguments,
+            returning further version keys the page depends on, or None if
+            the page cannot be cached
+
+    Anonymous requests and other methods are passed through uncached.
+    Responses are marked private, so shared HTTP caches never store them.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or not request.user.is_authenticated:
+                return view(request, *args, **kwargs)
+
+            keys = [user_version_key(request.user.pk)]
+            if version_keys is not None:
+                extra_keys = version_keys(request, *args, **kwargs)
+                if extra_keys is None:
+                    return view(request, *args, **kwargs)
+                keys += extra_keys
+            versions = '.'.join(str(version) for version in get_versions(keys))
+            path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+            key = f'{KEY_PREFIX}:page:{request.user.pk}:{view.__name__}:{versions}:{path}'
+
+            response = cache.get(key)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200 and not response.streaming and not response.cookies:
+                    cache.set(key, response, page_timeout())
+            patch_cache_control(response, private=True)
+            patch_vary_headers(response, ['Cookie'])
+            return response
+        return wrapped
+    return decorator
@@ -0,0 +1,219 @@
+"""
+Per-user unread counters for badges.
+
+Task 4: Counting a user's unread messages and notifications on every page
+load costs two COUNT queries that grow with the inbox. Each user instead has
+an UnreadCounter row, so a badge is one primary-key read:
+
+- new unread messages and notifications add to the receiver's counts, and
+  reading or deleting them subtracts, in the same transaction as the change
+  (see messaging.signals, messaging.outbox and messaging.bulk_read)
+- a user's row is created from real counts the first time it is read, so
+  adjustments never need to insert, and users who never look at a badge
+  never get a row
+- deleting unread rows subtracts too, but only through delete_counted():
+  per-row delete signals would stop Django from deleting cascaded rows in
+  bulk, so there are none, and a batch of deletes costs one grouped
+  adjustment instead of one UPDATE per row
+- updates and deletes that bypass this module, such as
+  QuerySet.update(read=True) or Model.delete(), leave the counts stale until
+  the reconciler recounts them; run
+  ``python manage.py reconcile_unread_counters`` periodically for that
+"""
+
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Q, Value
+from django.db.models.deletion import Collector
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .cache import bump_on_commit
+from .models import Message, Notification, UnreadCounter
+
+
+def adjust_unread(changes):
+    """
+    Add to the unread counts of users who have a counter row.
+
+    Users with the same deltas are updated together, so a batch touching
+    many users usually costs one UPDATE.
+
+    Args:
+        changes: Dict of user id to (messages delta, notifications delta)
+    """
+    by_delta = defaultdict(list)
+    for user_id, delta in changes.items():
+        if user_id is not None and any(delta):
+            by_delta[tuple(delta)].append(user_id)
+    for (messages, notifications), user_ids in by_delta.items():
+        updates = {}
+        if messages:
+            updates['messages'] = Greatest(F('messages') + messages, Value(0))
+        if notifications:
+            updates['notifications'] = Greatest(F('notifications') + notifications, Value(0))
+        UnreadCounter.objects.filter(pk__in=user_ids).update(**updates)
+
+
+def delete_counted(queryset):
+    """
+    Delete ``queryset`` and everything cascading from it, keeping counts and caches current.
+
+    The rows the deletion reaches are collected first, so the counters get
+    one grouped adjustment and the pages one invalidation for the whole
+    batch, whatever its size.
+
+    Args:
+        queryset: Messages or notifications to delete
+
+    Returns:
+        The (total, per model) counts, as from QuerySet.delete()
+    """
+    with transaction.atomic(using=queryset.db):
+        collector = Collector(using=queryset.db, origin=queryset)
+        collector.collect(queryset)
+        message_pks = [message.pk for message in collector.data.get(Message, ())]
+        notifications = [
+            deletes for deletes in collector.fast_deletes if deletes.model is Notification
+        ]
+        if Notification in collector.data:
+            notifications.append(Notification.objects.filter(
+                pk__in=[notification.pk for notification in collector.data[Notification]]
+            ))
+
+        changes = defaultdict(lambda: [0, 0])
+        user_ids = set()
+        thread_root_ids = set()
+        if message_pks:
+            messages = Message.objects.filter(pk__in=message_pks).values_list(
+                'sender_id', 'receiver_id', 'thread_root_id', 'read'
+            )
+            for sender_id, receiver_id, thread_root_id, read in messages:
+                user_ids.update((sender_id, receiver_id))
+                thread_root_ids.add(thread_root_id)
+                if not read:
+                    changes[receiver_id][0] -= 1
+        for deletes in notifications:
+            unread = deletes.values('user_id').annotate(
+                count=Count('pk', filter=Q(read=False))
+            ).values_list('user_id', 'count').order_by()
+            for user_id, count in unread:
+                user_ids.add(user_id)
+                changes[user_id][1] -= count
+
+        deleted = collector.delete()
+        adjust_unread(changes)
+        bump_on_commit(user_ids=user_ids, thread_root_ids=thread_root_ids)
+    return deleted
+
+
+def count_unread(user_ids):
+    """
+    Count the unread messages and notifications of each user.
+
+    Returns:
+        Dict of user id to (messages, notifications), for every user in ``user_ids``
+    """
+    messages = dict(
+        Message.objects.filter(receiver_id__in=user_ids, read=False).values(
+            'receiver_id'
+        ).annotate(count=Count('pk')).values_list('receiver_id', 'count').order_by()
+    )
+    notifications = dict(
+        Notification.objects.filter(user_id__in=user_ids, read=False).values(
+            'user_id'
+        ).annotate(count=Count('pk')).values_list('user_id', 'count').order_by()
+    )
+    return {
+        user_id: (messages.get(user_id, 0), notifications.get(user_id, 0))
+        for user_id in user_ids
+    }
+
+
+def recount(user_ids):
+    """
+    Write each user's real unread counts to their counter row, creating it if needed.
+
+    Uses one upsert where the database has one; MySQL and MariaDB take no
+    conflict target and upsert on the primary key. Elsewhere each row is
+    created or updated on its own.
+
+    Returns:
+        Dict of user id to the UnreadCounter written
+    """
+    now = timezone.now()
+    counters = [
+        UnreadCounter(user_id=user_id, messages=messages, notifications=notifications, updated_at=now)
+        for user_id, (messages, notifications) in count_unread(list(user_ids)).items()
+    ]
+    fields = ['messages', 'notifications', 'updated_at']
+    features = connection.features
+    if features.supports_update_conflicts:
+        UnreadCounter.objects.bulk_create(
+            counters,
+            update_conflicts=True,
+            unique_fields=['user'] if features.supports_update_conflicts_with_target else None,
+            update_fields=fields,
+        )
+    else:
+        for counter in counters:
+            UnreadCounter.objects.update_or_create(
+                user_id=counter.user_id,
+                defaults={field: getattr(counter, field) for field in fields},
+            )
+    return {counter.user_id: counter for counter in counters}
+
+
+def unread_counts(user_id):
+    """
+    Return a user's counter row, counting from scratch on first use.
+
+    Returns:
+        UnreadCounter with the user's ``messages`` and ``notifications``
+    """
+    counter = UnreadCounter.objects.filter(pk=user_id).first()
+    if counter is None:
+        counter = recount([user_id])[user_id]
+    return counter
+
+
+def reconcile_unread_counters(batch_size=500):
+    """
+    Correct counter rows that have drifted from the real counts.
+
+    Rows are checked in primary-key batches, each locked while it is
+    recounted so concurrent adjustments are not lost. Users whose counts
+    changed have their cached pages invalidated.
+
+    Returns:
+        Number of counter rows corrected
+    """
+    corrected = 0
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            counters = list(
+                UnreadCounter.objects.select_for_update().filter(
+                    pk__gt=last_pk
+                ).order_by('pk')[:batch_size]
+            )
+            if not counters:
+                break
+            actual = count_unread([counter.pk for counter in counters])
+            stale = []
+            for counter in counters:
+                messages, notifications = actual[counter.pk]
+                if (counter.messages, counter.notifications) != (messages, notifications):
+                    counter.messages = messages
+                    counter.notifications = notifications
+                    counter.updated_at = timezone.now()
+                    stale.append(counter)
+            if stale:
+                UnreadCounter.objects.bulk_update(
+                    stale, ['messages', 'notifications', 'updated_at']
+                )
+                bump_on_commit(user_ids=[counter.pk for counter in stale])
+            corrected += len(stale)
+        last_pk = counters[-1].pk
+    return corrected
@@ -0,0 +1,97 @@
+"""
+Management command filling in thread_root and path for existing messages.
+
+Messages saved before Message had these fields have them empty (see
+messaging.threads). Root messages are filled in first, then replies whose
+parent already has a path, a batch at a time, until every reachable message
+has one. Each batch is its own short transaction, so the command can run
+against a live database and be interrupted and restarted at any point.
+
+Usage:
+    python manage.py backfill_thread_paths
+    python manage.py backfill_thread_paths --batch-size 5000
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from messaging.models import Message
+from messaging.threads import path_segment
+
+
+class Command(BaseCommand):
+    """Compute thread roots and paths for messages that have none."""
+    
+    help = 'Fill in thread_root and path for messages saved before they existed'
+    
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Messages per batch (default: 1000)'
+        )
+    
+    def handle(self, *args, **options):
+        """Backfill roots, then replies level by level."""
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+        max_length = Message._meta.get_field('path').max_length
+        
+        roots = self.backfill(
+            Message.objects.filter(path__isnull=True, parent_message__isnull=True),
+            lambda row: (row['pk'], path_segment(row['pk'])),
+            batch_size
+        )
+        self.stdout.write(f'Backfilled {roots} root messages')
+        
+        def reply_position(row):
+            path = row['parent_message__path'] + path_segment(row['pk'])
+            if len(path) > max_length:
+                # Too deep to have a path; still counted in its thread
+                path = None
+            return row['parent_message__thread_root_id'], path
+        
+        replies = self.backfill(
+            Message.objects.filter(
+                path__isnull=True,
+                thread_root__isnull=True,
+                parent_message__path__isnull=False
+            ),
+            reply_position,
+            batch_size
+        )
+        self.stdout.write(f'Backfilled {replies} replies')
+        
+        remaining = Message.objects.filter(thread_root__isnull=True).count()
+        if remaining:
+            self.stdout.write(self.style.WARNING(
+                f'{remaining} messages could not be placed in a thread'
+            ))
+    
+    def backfill(self, queryset, position, batch_size):
+        """
+        Fill in batches of ``queryset`` until it is empty.
+        
+        Args:
+            queryset: Messages still to fill in
+            position: Function returning (thread root id, path) for a row
+            batch_size: Messages per batch
+        
+        Returns:
+            Number of messages filled in
+        """
+        total = 0
+        fields = ['pk', 'parent_message__thread_root_id', 'parent_message__path']
+        while True:
+            with transaction.atomic():
+                rows = list(queryset.order_by('pk').values(*fields)[:batch_size])
+                if not rows:
+                    return total
+                messages = []
+                for row in rows:
+                    thread_root_id, path = position(row)
+                    messages.append(Message(pk=row['pk'], thread_root_id=thread_root_id, path=path))
+                Message.objects.bulk_update(messages, ['thread_root', 'path'])
+            total += len(rows)
+            self.stdout.write(f'  {total} messages...')
@@ -0,0 +1,82 @@
+"""
+Management command delivering queued notifications from the outbox.
+
+Runs the notification outbox drainer (see messaging.outbox) in the
+foreground, as the separate worker delivering notifications unless
+AUTOSTART is on, or to flush the outbox once.
+
+Usage:
+    python manage.py drain_notifications
+    python manage.py drain_notifications --once --batch-size 1000
+    python manage.py drain_notifications --once --requeue-failed
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from messaging.outbox import OutboxDrainer, outbox_lag, requeue_failed
+
+
+class Command(BaseCommand):
+    """Create notifications for queued messages in batches."""
+    
+    help = 'Deliver queued notifications from the notification outbox'
+    
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Empty the outbox and exit instead of polling'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Entries per batch (default: 500)'
+        )
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds between polls of an empty outbox (default: 1)'
+        )
+        parser.add_argument(
+            '--requeue-failed', action='store_true',
+            help='Retry entries that reached the attempt limit'
+        )
+    
+    def handle(self, *args, **options):
+        """Drain the outbox once, or keep draining until interrupted."""
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        config = getattr(settings, 'MESSAGING_NOTIFICATION_OUTBOX', {})
+        drainer = OutboxDrainer(
+            batch_size=options['batch_size'],
+            max_attempts=config.get('MAX_ATTEMPTS', 5),
+        )
+        
+        if options['requeue_failed']:
+            requeued = requeue_failed(drainer.max_attempts)
+            self.stdout.write(f"Requeued {requeued} failed entries")
+        
+        if options['once']:
+            delivered = drainer.drain()
+            self.report(drainer, delivered)
+            return
+        
+        try:
+            while True:
+                delivered = drainer.drain()
+                if delivered:
+                    self.report(drainer, delivered)
+                else:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+    
+    def report(self, drainer, delivered):
+        """Print what was delivered and the remaining lag."""
+        stats = drainer.stats()
+        self.stdout.write(
+            f"Delivered {delivered} notifications "
+            f"(last batch lag {stats['last_lag']:.3f}s, "
+            f"outbox lag {outbox_lag(drainer.max_attempts):.3f}s, failures {stats['failures']})"
+        )
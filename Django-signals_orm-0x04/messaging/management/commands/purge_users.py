@@ -0,0 +1,93 @@
+"""
+Management command deleting the data of deleted accounts.
+
+Runs the user purger (see messaging.purge) in the foreground, for
+deployments that set AUTOSTART to False and run it as a separate worker.
+Failed purges are retried with backoff and purges left running by a stopped
+process are taken over once stale. --resume also runs every running or
+failed purge at once, including those that used up their attempts; only use
+it while no other purger is running.
+
+Usage:
+    python manage.py purge_users
+    python manage.py purge_users --once --resume --batch-size 1000
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from messaging.models import UserPurge
+from messaging.purge import UserPurger
+
+
+class Command(BaseCommand):
+    """Run pending user purges."""
+    
+    help = 'Delete the messages, history and notifications of deleted accounts'
+    
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Run the pending purges and exit instead of polling'
+        )
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Also run every running or failed purge, ignoring retry limits'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Rows per delete batch (default: 500)'
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0.05,
+            help='Seconds to wait between batches (default: 0.05)'
+        )
+        parser.add_argument(
+            '--interval', type=float, default=5.0,
+            help='Seconds between checks for new purges (default: 5)'
+        )
+    
+    def handle(self, *args, **options):
+        """Run the purges once, or keep running new ones until interrupted."""
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        config = getattr(settings, 'MESSAGING_USER_PURGE', {})
+        purger = UserPurger(
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            max_attempts=config.get('MAX_ATTEMPTS', 5),
+            retry_delay=config.get('RETRY_DELAY', 60),
+            stale_after=config.get('STALE_AFTER', 600),
+        )
+        statuses = None
+        if options['resume']:
+            statuses = [
+                UserPurge.STATUS_PENDING, UserPurge.STATUS_RUNNING, UserPurge.STATUS_FAILED
+            ]
+        
+        try:
+            while True:
+                started = time.monotonic()
+                failed = purger.failed
+                finished = purger.run_pending(statuses)
+                if finished or purger.failed > failed:
+                    self.report(finished, time.monotonic() - started)
+                if options['once']:
+                    break
+                # Resumed purges are only forced on the first pass
+                statuses = None
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+    
+    def report(self, finished, elapsed):
+        """Print the purges run and the state of any failures."""
+        self.stdout.write(f'Finished {finished} purges in {elapsed:.1f}s')
+        for purge in UserPurge.objects.filter(status=UserPurge.STATUS_FAILED):
+            self.stdout.write(
+                f'Failed: {purge.username} at {purge.stage or "start"} '
+                f'after {purge.batches} batches, attempt {purge.attempts}: {purge.error}'
+            )
@@ -0,0 +1,53 @@
+"""
+Management command correcting drifted unread counters.
+
+Recounts every user's unread messages and notifications and fixes the
+UnreadCounter rows that disagree (see messaging.counters). Run it
+periodically, e.g. from cron with --once, or as a long-running worker.
+
+Usage:
+    python manage.py reconcile_unread_counters --once
+    python manage.py reconcile_unread_counters --interval 300 --batch-size 1000
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from messaging.counters import reconcile_unread_counters
+
+
+class Command(BaseCommand):
+    """Recount unread messages and notifications and correct the counters."""
+    
+    help = 'Correct unread counters that have drifted from the real counts'
+    
+    def add_arguments(self, parser):
+        """Register command line arguments."""
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Reconcile once and exit instead of repeating'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Counter rows recounted per transaction (default: 500)'
+        )
+        parser.add_argument(
+            '--interval', type=float, default=300.0,
+            help='Seconds between passes (default: 300)'
+        )
+    
+    def handle(self, *args, **options):
+        """Reconcile once, or repeatedly until interrupted."""
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        
+        try:
+            while True:
+                corrected = reconcile_unread_counters(options['batch_size'])
+                self.stdout.write(f"Corrected {corrected} unread counters")
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,89 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:08
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField(help_text='The message content')),
+                ('timestamp', models.DateTimeField(auto_now_add=True, help_text='When the message was created')),
+                ('edited', models.BooleanField(default=False, help_text='Whether the message has been edited (Task 1)')),
+                ('read', models.BooleanField(default=False, help_text='Whether the message has been read by the receiver (Task 4)')),
+                ('parent_message', models.ForeignKey(blank=True, help_text='Parent message for threading conversations (Task 3)', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='replies', to='messaging.message')),
+                ('receiver', models.ForeignKey(help_text='User who receives the message', on_delete=django.db.models.deletion.CASCADE, related_name='received_messages', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(help_text='User who sent the message', on_delete=django.db.models.deletion.CASCADE, related_name='sent_messages', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-timestamp'],
+            },
+        ),
+        migrations.CreateModel(
+            name='NotificationOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='When the message was queued')),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='Failed attempts to deliver this entry')),
+                ('message', models.ForeignKey(help_text='The new message to notify the receiver about', on_delete=django.db.models.deletion.CASCADE, related_name='+', to='messaging.message')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('notification_type', models.CharField(default='new_message', help_text='Type of notification (e.g., new_message, message_reply)', max_length=50)),
+                ('content', models.TextField(help_text='Notification message content')),
+                ('timestamp', models.DateTimeField(auto_now_add=True, help_text='When the notification was created')),
+                ('read', models.BooleanField(default=False, help_text='Whether the notification has been read')),
+                ('message', models.ForeignKey(help_text='The message that triggered this notification', on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='messaging.message')),
+                ('user', models.ForeignKey(help_text='User who receives the notification', on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-timestamp'],
+                'indexes': [models.Index(fields=['user', 'read'], name='messaging_n_user_id_49d2b0_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='MessageHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('old_content', models.TextField(help_text='The previous content before the edit')),
+                ('edited_at', models.DateTimeField(auto_now_add=True, help_text='When the edit occurred')),
+                ('edited_by', models.ForeignKey(blank=True, help_text='User who edited the message', null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('message', models.ForeignKey(help_text='The message that was edited', on_delete=django.db.models.deletion.CASCADE, related_name='history', to='messaging.message')),
+            ],
+            options={
+                'verbose_name_plural': 'Message histories',
+                'ordering': ['-edited_at'],
+                'indexes': [models.Index(fields=['message', 'edited_at'], name='messaging_m_message_a0ee8b_idx')],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'read'], name='messaging_m_receive_6da6d1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'timestamp'], name='messaging_m_sender__3d379c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['parent_message'], name='messaging_m_parent__e699d7_idx'),
+        ),
+    ]
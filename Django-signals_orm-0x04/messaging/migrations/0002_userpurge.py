@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserPurge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_pk', models.BigIntegerField(help_text='Primary key of the user being purged; kept after the user is gone', unique=True)),
+                ('username', models.CharField(help_text='Username at the time deletion was requested', max_length=150)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', help_text='Where the purge is', max_length=20)),
+                ('stage', models.CharField(blank=True, help_text='The kind of rows currently being deleted', max_length=50)),
+                ('batches', models.PositiveIntegerField(default=0, help_text='Delete batches run so far')),
+                ('messages_deleted', models.PositiveIntegerField(default=0)),
+                ('history_deleted', models.PositiveIntegerField(default=0)),
+                ('notifications_deleted', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, help_text='The last error, if the purge failed')),
+                ('requested_at', models.DateTimeField(auto_now_add=True, help_text='When deletion was requested')),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='When progress was last recorded')),
+                ('finished_at', models.DateTimeField(blank=True, help_text='When the user and all their data were gone', null=True)),
+            ],
+            options={
+                'ordering': ['requested_at'],
+                'indexes': [models.Index(fields=['status'], name='messaging_u_status_53edfd_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+import messaging.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0002_userpurge'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='thread_root',
+            field=models.ForeignKey(blank=True, db_index=False, editable=False, help_text='First message of the thread; a root message points to itself (Task 3)', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='thread_messages', to='messaging.message'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='path',
+            field=messaging.models.PathField(blank=True, editable=False, help_text='Ids from the thread root down to this message, sortable depth first (Task 3)', max_length=1200, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread_root', 'path'], name='messaging_m_thread__8600a9_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:08
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messaging', '0003_message_thread_root_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('user', models.OneToOneField(help_text='User the counts belong to', on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='unread_counter', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('messages', models.PositiveIntegerField(default=0, help_text='Unread messages received by the user')),
+                ('notifications', models.PositiveIntegerField(default=0, help_text='Unread notifications of the user')),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='When the counts were last recomputed')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0004_unreadcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userpurge',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, help_text='Times the purge failed'),
+        ),
+        migrations.AddField(
+            model_name='userpurge',
+            name='retry_at',
+            field=models.DateTimeField(blank=True, help_text='When a failed purge is retried', null=True),
+        ),
+    ]
@@ -5,6 +5,9 @@ This module contains all the models for the messaging application including:
 - Message: Main message model with threading support, edit tracking, and read status
 - Notification: User notifications for new messages
 - MessageHistory: Historical records of message edits
+- NotificationOutbox: New messages waiting to be turned into notifications
+- UserPurge: Progress of deleting a deactivated user's data in the background
+- UnreadCounter: Each user's unread message and notification counts
 """
 
 from django.db import models
@@ -12,6 +15,22 @@ from django.contrib.auth.models import User
 from django.utils import timezone
 
 
+class PathField(models.CharField):
+    """
+    CharField for materialized paths, stored as ASCII on MySQL and MariaDB.
+    
+    Paths hold only digits, so one byte per character is enough; with the
+    default utf8mb4 (four bytes each) the (thread_root, path) index would
+    exceed MySQL's 3072-byte key limit. The binary collation also keeps
+    paths sorting by their digits.
+    """
+    
+    def db_type(self, connection):
+        if connection.vendor == 'mysql':
+            return f'varchar({self.max_length}) CHARACTER SET ascii COLLATE ascii_bin'
+        return super().db_type(connection)
+
+
 class UnreadMessagesManager(models.Manager):
     """
     Custom manager for filtering unread messages.
@@ -52,7 +71,8 @@ class Message(models.Model):
     Features:
     - Task 0: Basic message structure with sender/receiver
     - Task 1: Edit tracking with edited field
-    - Task 3: Threading with parent_message self-referential FK
+    - Task 3: Threading with parent_message self-referential FK, plus the
+      thread root and materialized path for reading whole threads and subtrees
     - Task 4: Read status tracking with read field and custom manager
     """
     
@@ -91,6 +111,24 @@ class Message(models.Model):
         default=False,
         help_text='Whether the message has been read by the receiver (Task 4)'
     )
+    thread_root = models.ForeignKey(
+        'self',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        editable=False,
+        # Covered by the (thread_root, path) index
+        db_index=False,
+        related_name='thread_messages',
+        help_text='First message of the thread; a root message points to itself (Task 3)'
+    )
+    path = PathField(
+        max_length=1200,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text='Ids from the thread root down to this message, sortable depth first (Task 3)'
+    )
     
     # Default manager
     objects = models.Manager()
@@ -104,6 +142,7 @@ class Message(models.Model):
             models.Index(fields=['receiver', 'read']),
             models.Index(fields=['sender', 'timestamp']),
             models.Index(fields=['parent_message']),
+            models.Index(fields=['thread_root', 'path']),
         ]
     
     def __str__(self):
@@ -113,18 +152,35 @@ class Message(models.Model):
         """
         Recursively get all replies to this message (Task 3).
         
+        Selects the range of the message's path within its thread; messages
+        not yet given a path follow parent_message down instead, up to
+        MESSAGING_THREADS['MAX_DEPTH'], with one recursive query (see
+        messaging.threads).
+        
         Returns:
             QuerySet of all replies with optimized loading
         """
-        return Message.objects.filter(
-            parent_message=self
-        ).select_related('sender', 'receiver').prefetch_related('replies')
+        from .threads import subtree_queryset, thread_limits, thread_queryset
+        if self.path:
+            replies = subtree_queryset(self).exclude(pk=self.pk)
+        else:
+            max_depth, _ = thread_limits()
+            replies = thread_queryset(self.pk, max_depth, include_root=False)
+        return replies.select_related('sender', 'receiver')
     
     def mark_as_read(self):
         """Mark this message as read."""
         if not self.read:
             self.read = True
             self.save(update_fields=['read'])
+    
+    def refresh_from_db(self, using=None, fields=None):
+        """Reload fields from the database, keeping the change-tracking snapshots current (Tasks 1 and 4)."""
+        super().refresh_from_db(using=using, fields=fields)
+        if fields is None or 'content' in fields:
+            self._loaded_content = self.__dict__.get('content', models.DEFERRED)
+        if fields is None or 'read' in fields:
+            self._loaded_read = self.__dict__.get('read', models.DEFERRED)
 
 
 class Notification(models.Model):
@@ -218,3 +274,152 @@ class MessageHistory(models.Model):
     
     def __str__(self):
         return f"History for message {self.message.id} edited at {self.edited_at}"
+
+
+class NotificationOutbox(models.Model):
+    """
+    NotificationOutbox model queueing new messages for notification.
+    
+    Task 0: The post_save signal writes one row per new message instead of
+    creating the Notification itself; messaging.outbox turns the rows into
+    notifications in batches and deletes them in the same transaction.
+    """
+    
+    message = models.ForeignKey(
+        Message,
+        on_delete=models.CASCADE,
+        related_name='+',
+        help_text='The new message to notify the receiver about'
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        help_text='When the message was queued'
+    )
+    attempts = models.PositiveIntegerField(
+        default=0,
+        help_text='Failed attempts to deliver this entry'
+    )
+    
+    class Meta:
+        ordering = ['id']
+    
+    def __str__(self):
+        return f"Outbox entry for message {self.message_id}"
+
+
+class UserPurge(models.Model):
+    """
+    UserPurge model tracking the deletion of a user's data.
+    
+    Task 2: Deleting an account deactivates the user and creates one of these;
+    messaging.purge then deletes the user's messages (with their history and
+    notifications) in small batches and finally the user, recording its
+    progress here as it goes.
+    """
+    
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
+    user_pk = models.BigIntegerField(
+        unique=True,
+        help_text='Primary key of the user being purged; kept after the user is gone'
+    )
+    username = models.CharField(
+        max_length=150,
+        help_text='Username at the time deletion was requested'
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=STATUS_PENDING,
+        help_text='Where the purge is'
+    )
+    stage = models.CharField(
+        max_length=50,
+        blank=True,
+        help_text='The kind of rows currently being deleted'
+    )
+    batches = models.PositiveIntegerField(
+        default=0,
+        help_text='Delete batches run so far'
+    )
+    messages_deleted = models.PositiveIntegerField(default=0)
+    history_deleted = models.PositiveIntegerField(default=0)
+    notifications_deleted = models.PositiveIntegerField(default=0)
+    error = models.TextField(
+        blank=True,
+        help_text='The last error, if the purge failed'
+    )
+    attempts = models.PositiveIntegerField(
+        default=0,
+        help_text='Times the purge failed'
+    )
+    retry_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text='When a failed purge is retried'
+    )
+    requested_at = models.DateTimeField(
+        auto_now_add=True,
+        help_text='When deletion was requested'
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        help_text='When progress was last recorded'
+    )
+    finished_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text='When the user and all their data were gone'
+    )
+    
+    class Meta:
+        ordering = ['requested_at']
+        indexes = [
+            models.Index(fields=['status']),
+        ]
+    
+    def __str__(self):
+        return f"Purge of {self.username} ({self.status})"
+
+
+class UnreadCounter(models.Model):
+    """
+    UnreadCounter model holding a user's unread counts for badges.
+    
+    Task 4: Kept current by the message and notification signals and by the
+    bulk read operations, so a badge is one primary-key read instead of two
+    COUNT queries. Created on first read; reconcile_unread_counters corrects
+    any drift left by updates that bypass signals (see messaging.counters).
+    """
+    
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='unread_counter',
+        help_text='User the counts belong to'
+    )
+    messages = models.PositiveIntegerField(
+        default=0,
+        help_text='Unread messages received by the user'
+    )
+    notifications = models.PositiveIntegerField(
+        default=0,
+        help_text='Unread notifications of the user'
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        help_text='When the counts were last recomputed'
+    )
+    
+    def __str__(self):
+        return f"Unread counts for user {self.user_id}: {self.messages} messages, {self.notifications} notifications"
@@ -0,0 +1,308 @@
+"""
+Batched notification fan-out from the notification outbox.
+
+Task 0: Saving a new message only writes a NotificationOutbox row, in the
+same transaction as the message. A drainer then claims the oldest rows in
+batches, creates their notifications with one bulk_create and deletes the
+rows, all in one transaction:
+
+- a batch either commits completely or leaves its rows for the next attempt,
+  so every message gets its notification at least once
+- if a batch fails, its entries are retried one by one, so only the entries
+  that fail again have their attempt counters raised and the rest are
+  delivered; after MAX_ATTEMPTS failures an entry is dead-lettered: it stays
+  in the table but is no longer claimed, so it cannot hold up the entries
+  queued behind it (``drain_notifications --requeue-failed`` retries them)
+- on databases supporting SKIP LOCKED, several processes can drain at the
+  same time without claiming the same rows; elsewhere, run one drainer
+
+Run ``python manage.py drain_notifications`` as a separate worker. With
+AUTOSTART on, a drainer thread starts in each process the first time a
+message is committed instead, and polls every POLL_INTERVAL seconds after
+that.
+
+    MESSAGING_NOTIFICATION_OUTBOX = {
+        'AUTOSTART': False,
+        'BATCH_SIZE': 500,
+        'POLL_INTERVAL': 1.0,
+        'MAX_ATTEMPTS': 5,
+    }
+"""
+
+import atexit
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .cache import bump_on_commit
+from .counters import adjust_unread
+from .models import Notification, NotificationOutbox
+
+logger = logging.getLogger(__name__)
+
+
+def build_notification(message):
+    """
+    Return the unsaved Notification for a new message.
+
+    Args:
+        message: The Message instance, with its sender loaded
+
+    Returns:
+        Notification instance for the message's receiver
+    """
+    if message.parent_message_id:
+        notification_type = 'message_reply'
+        content = f"{message.sender.username} replied to your message: {message.content[:50]}..."
+    else:
+        notification_type = 'new_message'
+        content = f"New message from {message.sender.username}: {message.content[:50]}..."
+    return Notification(
+        user_id=message.receiver_id,
+        message=message,
+        notification_type=notification_type,
+        content=content
+    )
+
+
+def pending_entries(max_attempts=5):
+    """Return the outbox entries that have not been dead-lettered."""
+    return NotificationOutbox.objects.filter(attempts__lt=max_attempts)
+
+
+def claim_batch(batch_size, max_attempts=5):
+    """
+    Return the oldest deliverable outbox entries, with their messages and senders.
+
+    Entries that failed ``max_attempts`` times are skipped. Must run inside
+    a transaction; where the database supports it, the entries stay locked
+    against other drainers until it ends.
+    """
+    entries = pending_entries(max_attempts).select_related('message__sender').only(
+        'id',
+        'created_at',
+        'message__id',
+        'message__content',
+        'message__receiver_id',
+        'message__parent_message_id',
+        'message__sender__username',
+    ).order_by('id')
+    if connection.features.has_select_for_update_skip_locked:
+        of = ('self',) if connection.features.has_select_for_update_of else ()
+        entries = entries.select_for_update(skip_locked=True, of=of)
+    return list(entries[:batch_size])
+
+
+def deliver(entries):
+    """Create the notifications for ``entries`` and delete them, in a savepoint."""
+    with transaction.atomic():
+        Notification.objects.bulk_create(
+            [build_notification(entry.message) for entry in entries]
+        )
+        NotificationOutbox.objects.filter(
+            pk__in=[entry.pk for entry in entries]
+        ).delete()
+        # bulk_create sends no post_save, so count the notifications and
+        # invalidate the pages here
+        receivers = Counter(entry.message.receiver_id for entry in entries)
+        adjust_unread({user_id: (0, count) for user_id, count in receivers.items()})
+        bump_on_commit(user_ids=receivers)
+
+
+def deliver_singly(entries):
+    """
+    Deliver ``entries`` one at a time after their batch failed.
+
+    Returns:
+        List of the entries that failed again
+    """
+    failed = []
+    for entry in entries:
+        try:
+            deliver([entry])
+        except Exception:
+            logger.exception('Notification outbox entry %s failed', entry.pk)
+            failed.append(entry)
+    return failed
+
+
+def drain_batch(batch_size=500, max_attempts=5):
+    """
+    Deliver one batch of outbox entries.
+
+    If the batch fails as a whole, its entries are retried one by one and
+    the attempt counters of those failing again are raised.
+
+    Args:
+        batch_size: Maximum entries to deliver
+        max_attempts: Failures after which an entry is no longer claimed
+
+    Returns:
+        Tuple of (entries delivered, entries failed, age in seconds of the
+        oldest one)
+    """
+    with transaction.atomic():
+        entries = claim_batch(batch_size, max_attempts)
+        if not entries:
+            return 0, 0, 0.0
+        try:
+            deliver(entries)
+            failed = []
+        except Exception:
+            logger.exception(
+                'Notification outbox batch failed; retrying its entries one by one'
+            )
+            failed = deliver_singly(entries)
+            NotificationOutbox.objects.filter(
+                pk__in=[entry.pk for entry in failed]
+            ).update(attempts=F('attempts') + 1)
+    lag = (timezone.now() - entries[0].created_at).total_seconds()
+    return len(entries) - len(failed), len(failed), lag
+
+
+def requeue_failed(max_attempts=5):
+    """Reset the attempt counters of dead-lettered entries; return how many."""
+    return NotificationOutbox.objects.filter(
+        attempts__gte=max_attempts
+    ).update(attempts=0)
+
+
+def outbox_lag(max_attempts=5):
+    """Return the age in seconds of the oldest deliverable entry, or 0.0."""
+    oldest = pending_entries(max_attempts).order_by('id').values_list(
+        'created_at', flat=True
+    ).first()
+    if oldest is None:
+        return 0.0
+    return (timezone.now() - oldest).total_seconds()
+
+
+class OutboxDrainer:
+    """Background thread delivering outbox entries in batches."""
+
+    def __init__(self, batch_size=500, poll_interval=1.0, max_attempts=5):
+        """Initialize the drainer; the thread starts on first wake()."""
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.delivered = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_lag = 0.0
+
+    def start(self):
+        """Start the drainer thread if it is not running."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name='notification-outbox', daemon=True
+                )
+                self._thread.start()
+
+    def wake(self):
+        """Ask the drainer to look at the outbox now, starting it if needed."""
+        if self._thread is None:
+            self.start()
+        self._wakeup.set()
+
+    def shutdown(self, timeout=5):
+        """Stop the thread after its current batch."""
+        self._stopping.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def drain(self, max_batches=None):
+        """
+        Deliver batches until the outbox is empty or ``max_batches`` ran.
+
+        Entries that fail are left for the next drain, until they have
+        failed ``max_attempts`` times; ``failures`` counts failed batches
+        and entries.
+
+        Returns:
+            Number of entries delivered
+        """
+        delivered = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            try:
+                count, failed, lag = drain_batch(self.batch_size, self.max_attempts)
+            except Exception:
+                logger.exception('Notification outbox batch failed')
+                self.failures += 1
+                break
+            if not count and not failed:
+                break
+            batches += 1
+            delivered += count
+            self.batches += 1
+            self.delivered += count
+            self.failures += failed
+            self.last_lag = lag
+            # Failing entries are retried on the next drain, not right away
+            if failed or count < self.batch_size:
+                break
+        return delivered
+
+    def stats(self):
+        """Return delivery counters and the lag of the last batch in seconds."""
+        return {
+            'delivered': self.delivered,
+            'batches': self.batches,
+            'failures': self.failures,
+            'last_lag': self.last_lag,
+        }
+
+    def _run(self):
+        """Drain whenever woken, and at least every poll_interval seconds."""
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                break
+            close_old_connections()
+            self.drain()
+        close_old_connections()
+
+
+_drainer = None
+_drainer_lock = threading.Lock()
+
+
+def get_outbox_drainer():
+    """Return the process-wide drainer described by the settings."""
+    global _drainer
+    if _drainer is None:
+        with _drainer_lock:
+            if _drainer is None:
+                config = getattr(settings, 'MESSAGING_NOTIFICATION_OUTBOX', {})
+                _drainer = OutboxDrainer(
+                    batch_size=config.get('BATCH_SIZE', 500),
+                    poll_interval=config.get('POLL_INTERVAL', 1.0),
+                    max_attempts=config.get('MAX_ATTEMPTS', 5),
+                )
+                atexit.register(_drainer.shutdown)
+    return _drainer
+
+
+def wake_outbox_drainer():
+    """Wake the background drainer, if AUTOSTART is on."""
+    if getattr(settings, 'MESSAGING_NOTIFICATION_OUTBOX', {}).get('AUTOSTART', False):
+        get_outbox_drainer().wake()
+
+
+def drain_notification_outbox(max_batches=None):
+    """Deliver pending outbox entries in the calling thread."""
+    return get_outbox_drainer().drain(max_batches)
@@ -0,0 +1,364 @@
+"""
+Background deletion of a deleted account's data.
+
+Task 2: Deleting a user in one request cascades through every message they
+sent or received, with its edit history and notifications, and holds the
+locks for all of it until the request ends. Instead, schedule_user_purge()
+deactivates the user, so they can no longer log in, and records a UserPurge.
+A background purger then deletes, one short transaction per batch:
+
+1. the user's messages and every reply below them, other users' replies
+   included, deepest first
+2. the messages the user sent that have no thread path yet, with their
+   history, notifications and replies
+3. the messages the user received that have no thread path yet, likewise
+4. any notifications for the user that are left
+5. the user
+
+Each batch covers at most BATCH_SIZE rows of the stage's model, and progress
+is written to the UserPurge after every batch. Deleting a message cascades
+through parent_message and thread_root to every reply below it, so the
+first stage deletes replies before the messages they answer: a batch then
+removes exactly its own messages (with their history and notifications),
+however large the threads are. Replies without a path still cascade with
+their parent; run ``python manage.py backfill_thread_paths`` to bound those
+too. PAUSE seconds between batches give other writers a turn.
+
+A failed purge is retried automatically after RETRY_DELAY seconds, doubling
+with every attempt, until it failed MAX_ATTEMPTS times. A purge still
+marked running whose progress was last recorded more than STALE_AFTER
+seconds ago was left by a stopped process and is taken over. Every stage
+continues with whatever rows are left, so both are safe.
+
+The purger thread starts when a purge is committed and looks for due
+purges every POLL_INTERVAL seconds after that. With AUTOSTART off, run
+``python manage.py purge_users`` as a separate worker instead; its --resume
+option also runs purges that used up their attempts.
+
+    MESSAGING_USER_PURGE = {
+        'AUTOSTART': True,
+        'BATCH_SIZE': 500,
+        'PAUSE': 0.05,
+        'MAX_ATTEMPTS': 5,
+        'RETRY_DELAY': 60,
+        'STALE_AFTER': 600,
+        'POLL_INTERVAL': 60,
+    }
+"""
+
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.db.models.functions import Length, Substr
+from django.utils import timezone
+
+from .counters import delete_counted
+from .models import Message, MessageHistory, Notification, UserPurge
+
+logger = logging.getLogger(__name__)
+
+# Progress counter for each model a batch may delete rows of
+COUNTERS = {
+    Message._meta.label: 'messages_deleted',
+    MessageHistory._meta.label: 'history_deleted',
+    Notification._meta.label: 'notifications_deleted',
+}
+
+
+def schedule_user_purge(user):
+    """
+    Deactivate ``user`` and queue the deletion of their data.
+
+    Args:
+        user: The User whose account is being deleted
+
+    Returns:
+        The UserPurge tracking the deletion
+    """
+    with transaction.atomic():
+        User.objects.filter(pk=user.pk).update(is_active=False)
+        user.is_active = False
+        purge, _ = UserPurge.objects.get_or_create(
+            user_pk=user.pk,
+            defaults={'username': user.username}
+        )
+    transaction.on_commit(wake_user_purger)
+    return purge
+
+
+def delete_batch(model, field, user_pk, batch_size):
+    """
+    Delete the next batch of ``model`` rows whose ``field`` is ``user_pk``.
+
+    The batch is the primary-key range spanning the first ``batch_size``
+    matching rows, deleted in its own transaction along with the rows
+    cascading from it.
+
+    Returns:
+        Dict of rows deleted per model label, or None if nothing was left
+    """
+    pks = list(
+        model.objects.filter(**{field: user_pk}).order_by('pk').values_list(
+            'pk', flat=True
+        )[:batch_size]
+    )
+    if not pks:
+        return None
+    with transaction.atomic():
+        _, counts = delete_counted(model.objects.filter(
+            **{field: user_pk}, pk__gte=pks[0], pk__lte=pks[-1]
+        ))
+    return counts
+
+
+def delete_thread_batch(user_pk, batch_size):
+    """
+    Delete the deepest ``batch_size`` messages at or below the user's messages.
+
+    Paths sort every reply after the messages above it, so taking the
+    highest paths first never deletes a message before its replies and
+    nothing cascades to messages outside the batch.
+
+    Returns:
+        Dict of rows deleted per model label, or None if nothing was left
+    """
+    own = Message.objects.filter(
+        Q(sender_id=user_pk) | Q(receiver_id=user_pk), path__isnull=False
+    )
+    # One of the user's messages whose path starts the candidate's path
+    own_ancestor = own.filter(thread_root_id=OuterRef('thread_root_id')).annotate(
+        candidate_prefix=Substr(OuterRef('path'), 1, Length('path'))
+    ).filter(candidate_prefix=F('path'))
+    pks = list(
+        Message.objects.filter(
+            thread_root_id__in=own.values('thread_root_id'), path__isnull=False
+        ).filter(Exists(own_ancestor)).order_by('-path').values_list(
+            'pk', flat=True
+        )[:batch_size]
+    )
+    if not pks:
+        return None
+    with transaction.atomic():
+        _, counts = delete_counted(Message.objects.filter(pk__in=pks))
+    return counts
+
+
+# (stage, function deleting one batch of the user's rows), in deletion order
+STAGES = [
+    ('threads', delete_thread_batch),
+    ('sent_messages', partial(delete_batch, Message, 'sender_id')),
+    ('received_messages', partial(delete_batch, Message, 'receiver_id')),
+    ('notifications', partial(delete_batch, Notification, 'user_id')),
+]
+
+
+def record_progress(purge, stage, counts):
+    """Add one batch's deleted rows to the purge's counters."""
+    updates = {
+        'stage': stage,
+        'batches': F('batches') + 1,
+        'updated_at': timezone.now(),
+    }
+    for label, count in counts.items():
+        counter = COUNTERS.get(label)
+        if counter is not None and count:
+            updates[counter] = F(counter) + count
+    UserPurge.objects.filter(pk=purge.pk).update(**updates)
+
+
+def run_purge(purge, batch_size=500, pause=0.0, retry_delay=60):
+    """
+    Delete everything belonging to the purge's user, batch by batch.
+
+    Safe to run again after an interruption: every stage simply continues
+    with whatever rows are left. If it fails, the purge is marked for a
+    retry ``retry_delay`` seconds later, doubled for every earlier attempt.
+
+    Returns:
+        True if the purge finished, False if it failed
+    """
+    UserPurge.objects.filter(pk=purge.pk).update(
+        status=UserPurge.STATUS_RUNNING, error='', updated_at=timezone.now()
+    )
+    try:
+        for stage, delete in STAGES:
+            while True:
+                counts = delete(purge.user_pk, batch_size)
+                if counts is None:
+                    break
+                record_progress(purge, stage, counts)
+                if pause:
+                    time.sleep(pause)
+
+        with transaction.atomic():
+            User.objects.filter(pk=purge.user_pk).delete()
+    except Exception as exc:
+        logger.exception('Purge of user %s failed', purge.username)
+        now = timezone.now()
+        UserPurge.objects.filter(pk=purge.pk).update(
+            status=UserPurge.STATUS_FAILED,
+            error=repr(exc),
+            attempts=F('attempts') + 1,
+            retry_at=now + timedelta(seconds=retry_delay * 2 ** purge.attempts),
+            updated_at=now,
+        )
+        return False
+
+    now = timezone.now()
+    UserPurge.objects.filter(pk=purge.pk).update(
+        status=UserPurge.STATUS_DONE, stage='user', updated_at=now, finished_at=now
+    )
+    return True
+
+
+def due_purges(max_attempts=5, stale_after=600):
+    """
+    Return a Q matching the purges that should run now.
+
+    These are the pending purges, failed ones whose retry is due and that
+    have attempts left, and running ones whose progress stopped more than
+    ``stale_after`` seconds ago.
+    """
+    now = timezone.now()
+    return (
+        Q(status=UserPurge.STATUS_PENDING)
+        | Q(status=UserPurge.STATUS_FAILED, attempts__lt=max_attempts, retry_at__lte=now)
+        | Q(
+            status=UserPurge.STATUS_RUNNING,
+            updated_at__lte=now - timedelta(seconds=stale_after),
+        )
+    )
+
+
+def claim_purge(purge, condition):
+    """Return True if this process took ``purge`` while it matched ``condition``."""
+    return UserPurge.objects.filter(condition, pk=purge.pk).update(
+        status=UserPurge.STATUS_RUNNING, updated_at=timezone.now()
+    ) == 1
+
+
+class UserPurger:
+    """Background thread running pending purges one at a time."""
+
+    def __init__(self, batch_size=500, pause=0.05, max_attempts=5, retry_delay=60,
+                 stale_after=600, poll_interval=60):
+        """Initialize the purger; the thread starts on first wake()."""
+        self.batch_size = batch_size
+        self.pause = pause
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.finished = 0
+        self.failed = 0
+
+    def start(self):
+        """Start the purger thread if it is not running."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name='user-purge', daemon=True
+                )
+                self._thread.start()
+
+    def wake(self):
+        """Ask the purger to look for pending purges now, starting it if needed."""
+        if self._thread is None:
+            self.start()
+        self._wakeup.set()
+
+    def shutdown(self, timeout=5):
+        """Stop the thread once its current purge is done."""
+        self._stopping.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def run_pending(self, statuses=None):
+        """
+        Run every purge that is due (see due_purges), oldest first.
+
+        With ``statuses``, run every purge in one of them instead, whatever
+        its attempts and progress. Each purge is claimed before it runs, so
+        purgers in other processes skip it.
+
+        Returns:
+            Number of purges that finished
+        """
+        if statuses is None:
+            condition = due_purges(self.max_attempts, self.stale_after)
+        else:
+            condition = Q(status__in=statuses)
+        finished = 0
+        for purge in UserPurge.objects.filter(condition):
+            if self._stopping.is_set():
+                break
+            if not claim_purge(purge, condition):
+                continue
+            if run_purge(purge, self.batch_size, self.pause, self.retry_delay):
+                finished += 1
+                self.finished += 1
+            else:
+                self.failed += 1
+        return finished
+
+    def stats(self):
+        """Return the purges finished and failed by this purger."""
+        return {'finished': self.finished, 'failed': self.failed}
+
+    def _run(self):
+        """Run due purges whenever woken, and at least every poll_interval seconds."""
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                break
+            close_old_connections()
+            try:
+                self.run_pending()
+            except Exception:
+                logger.exception('User purger failed')
+        close_old_connections()
+
+
+_purger = None
+_purger_lock = threading.Lock()
+
+
+def get_user_purger():
+    """Return the process-wide purger described by the settings."""
+    global _purger
+    if _purger is None:
+        with _purger_lock:
+            if _purger is None:
+                config = getattr(settings, 'MESSAGING_USER_PURGE', {})
+                _purger = UserPurger(
+                    batch_size=config.get('BATCH_SIZE', 500),
+                    pause=config.get('PAUSE', 0.05),
+                    max_attempts=config.get('MAX_ATTEMPTS', 5),
+                    retry_delay=config.get('RETRY_DELAY', 60),
+                    stale_after=config.get('STALE_AFTER', 600),
+                    poll_interval=config.get('POLL_INTERVAL', 60),
+                )
+                atexit.register(_purger.shutdown)
+    return _purger
+
+
+def wake_user_purger():
+    """Wake the background purger, if AUTOSTART is on."""
+    if getattr(settings, 'MESSAGING_USER_PURGE', {}).get('AUTOSTART', True):
+        get_user_purger().wake()
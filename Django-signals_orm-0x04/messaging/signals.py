@@ -2,24 +2,39 @@
 Django signals for the messaging app.
 
 This module contains signal handlers for:
-- Task 0: Automatic notification creation when new messages are sent
+- Task 0: Queueing notifications when new messages are sent
 - Task 1: Logging message edits to MessageHistory
-- Task 2: Cleaning up related data when users are deleted
+- Task 3: Placing new messages in their thread
+- Task 4: Keeping the unread counters current
+- Task 5: Invalidating cached pages when messages and notifications change
+- Task 2: Recording user deletions (see messaging.purge for the cleanup)
 """
 
-from django.db.models.signals import post_save, pre_save, post_delete, pre_delete
+import logging
+
+from django.db.models import DEFERRED
+from django.db.models.signals import post_init, post_save, pre_save, post_delete
+from django.db import transaction
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import Message, Notification, MessageHistory
+from .cache import bump_on_commit
+from .counters import adjust_unread, recount
+from .models import Message, MessageHistory, Notification, NotificationOutbox
+from .outbox import wake_outbox_drainer
+from .threads import assign_thread_position
+
+logger = logging.getLogger(__name__)
 
 
 @receiver(post_save, sender=Message)
 def create_notification_on_new_message(sender, instance, created, **kwargs):
     """
-    Task 0: Signal handler to create a notification when a new message is sent.
+    Task 0: Signal handler to queue a notification when a new message is sent.
     
     This signal listens to the post_save event on the Message model and
-    automatically creates a Notification for the receiving user.
+    writes a NotificationOutbox row in the message's transaction. The
+    Notification for the receiving user is created in a batch by
+    messaging.outbox, which is woken once the transaction commits.
     
     Args:
         sender: The Message model class
@@ -28,110 +43,233 @@ def create_notification_on_new_message(sender, instance, created, **kwargs):
         **kwargs: Additional keyword arguments
     """
     if created:
-        # Determine notification type based on whether it's a reply
-        notification_type = 'message_reply' if instance.parent_message else 'new_message'
-        
-        # Create notification content
-        if instance.parent_message:
-            content = f"{instance.sender.username} replied to your message: {instance.content[:50]}..."
-        else:
-            content = f"New message from {instance.sender.username}: {instance.content[:50]}..."
-        
-        # Create the notification
-        Notification.objects.create(
-            user=instance.receiver,
-            message=instance,
-            notification_type=notification_type,
-            content=content
-        )
+        NotificationOutbox.objects.create(message_id=instance.pk)
+        transaction.on_commit(wake_outbox_drainer)
 
 
-@receiver(pre_save, sender=Message)
-def log_message_edit(sender, instance, **kwargs):
+@receiver(post_save, sender=Message)
+def set_thread_position(sender, instance, created, **kwargs):
     """
-    Task 1: Signal handler to log message edits before they are saved.
+    Task 3: Signal handler placing a new message in its thread.
     
-    This signal listens to the pre_save event on the Message model and
-    saves the old content to MessageHistory before the message is updated.
+    Sets thread_root and the materialized path from the parent message,
+    which needs the new message's id (see messaging.threads).
     
     Args:
         sender: The Message model class
-        instance: The Message instance being saved
+        instance: The Message instance that was saved
+        created: Boolean indicating if this is a new instance
         **kwargs: Additional keyword arguments
     """
-    # Only process if the message already exists (not a new creation)
-    if instance.pk:
-        try:
-            # Get the old version of the message from the database
-            old_message = Message.objects.get(pk=instance.pk)
-            
-            # Check if the content has actually changed
-            if old_message.content != instance.content:
-                # Mark the message as edited
-                instance.edited = True
-                
-                # Create a history record with the old content
-                MessageHistory.objects.create(
-                    message=old_message,
-                    old_content=old_message.content,
-                    edited_by=instance.sender  # Assuming sender is editing their own message
-                )
-        except Message.DoesNotExist:
-            # This shouldn't happen, but we handle it gracefully
-            pass
+    if created:
+        assign_thread_position(instance)
 
 
-@receiver(post_delete, sender=User)
-def delete_user_related_data(sender, instance, **kwargs):
+@receiver(post_save, sender=Message)
+def invalidate_message_pages(sender, instance, **kwargs):
     """
-    Task 2: Signal handler to clean up related data when a user is deleted.
+    Task 5: Signal handler invalidating the cached pages showing a message.
     
-    This signal listens to the post_delete event on the User model and
-    explicitly deletes all messages, notifications, and message histories 
-    associated with the user.
+    Bumps the page cache versions of the sender, the receiver and the
+    message's thread once the change commits (see messaging.cache).
+    Deletes are invalidated by messaging.counters.delete_counted instead:
+    a delete receiver would make Django load every cascaded row.
     
     Args:
-        sender: The User model class
-        instance: The User instance that was deleted
+        sender: The Message model class
+        instance: The Message instance that was saved
         **kwargs: Additional keyword arguments
     """
-    # Explicitly delete all messages sent by this user
-    Message.objects.filter(sender=instance).delete()
+    bump_on_commit(
+        user_ids=[instance.sender_id, instance.receiver_id],
+        thread_root_ids=[instance.thread_root_id]
+    )
+
+
+@receiver(post_save, sender=Notification)
+def invalidate_notification_pages(sender, instance, **kwargs):
+    """
+    Task 5: Signal handler invalidating the cached pages of a notification's user.
     
-    # Explicitly delete all messages received by this user
-    Message.objects.filter(receiver=instance).delete()
+    Args:
+        sender: The Notification model class
+        instance: The Notification instance that was saved
+        **kwargs: Additional keyword arguments
+    """
+    bump_on_commit(user_ids=[instance.user_id])
+
+
+@receiver(post_init, sender=Message)
+def snapshot_message_content(sender, instance, **kwargs):
+    """
+    Task 1: Remember the content a message was loaded or created with.
     
-    # Explicitly delete all notifications for this user
-    Notification.objects.filter(user=instance).delete()
+    log_message_edit compares against this snapshot instead of reading the
+    row back. Messages loaded with content deferred get DEFERRED. The read
+    flag is remembered the same way for the unread counters (Task 4).
     
-    # Message histories are automatically deleted when messages are deleted
-    # due to CASCADE foreign key relationship
+    Args:
+        sender: The Message model class
+        instance: The Message instance that was initialized
+        **kwargs: Additional keyword arguments
+    """
+    instance._loaded_content = instance.__dict__.get('content', DEFERRED)
+    instance._loaded_read = instance.__dict__.get('read', DEFERRED)
+
+
+@receiver(post_init, sender=Notification)
+def snapshot_notification_read(sender, instance, **kwargs):
+    """
+    Task 4: Remember whether a notification was loaded or created as read.
     
-    # Log the deletion for auditing purposes
-    print(f"Cleaning up data for deleted user: {instance.username}")
+    Args:
+        sender: The Notification model class
+        instance: The Notification instance that was initialized
+        **kwargs: Additional keyword arguments
+    """
+    instance._loaded_read = instance.__dict__.get('read', DEFERRED)
 
 
-@receiver(pre_delete, sender=User)
-def cleanup_user_data_before_delete(sender, instance, **kwargs):
+def count_read_change(instance, user_id, created, update_fields, field):
     """
-    Task 2: Clean up user-related data before user deletion.
+    Task 4: Apply a saved message's or notification's read flag to the counters.
     
-    This pre_delete signal explicitly removes all messages, notifications,
-    and related data before the user is deleted. This demonstrates explicit
-    cleanup using Message.objects.filter().delete() pattern.
+    Args:
+        instance: The Message or Notification that was saved
+        user_id: The user whose counts it is part of
+        created: Boolean indicating if this is a new instance
+        update_fields: The fields that were saved, or None for all of them
+        field: 'messages' or 'notifications'
+    """
+    if created:
+        delta = 0 if instance.read else 1
+    elif update_fields is not None and 'read' not in update_fields:
+        return
+    else:
+        was_read = instance._loaded_read
+        if was_read is DEFERRED:
+            # Not known what the row held before, so count it again
+            recount([user_id])
+            delta = 0
+        else:
+            delta = int(bool(was_read)) - int(bool(instance.read))
+    instance._loaded_read = instance.read
+    if delta:
+        changes = (delta, 0) if field == 'messages' else (0, delta)
+        adjust_unread({user_id: changes})
+
+
+@receiver(post_save, sender=Message)
+def count_unread_message(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Task 4: Signal handler keeping the receiver's unread message count current.
     
     Args:
-        sender: The User model class
-        instance: The User instance about to be deleted
+        sender: The Message model class
+        instance: The Message instance that was saved
+        created: Boolean indicating if this is a new instance
+        update_fields: The fields that were saved, or None for all of them
+        **kwargs: Additional keyword arguments
+    """
+    count_read_change(instance, instance.receiver_id, created, update_fields, 'messages')
+
+
+@receiver(post_save, sender=Notification)
+def count_unread_notification(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Task 4: Signal handler keeping the user's unread notification count current.
+    
+    Args:
+        sender: The Notification model class
+        instance: The Notification instance that was saved
+        created: Boolean indicating if this is a new instance
+        update_fields: The fields that were saved, or None for all of them
+        **kwargs: Additional keyword arguments
+    """
+    count_read_change(instance, instance.user_id, created, update_fields, 'notifications')
+
+
+@receiver(pre_save, sender=Message)
+def log_message_edit(sender, instance, update_fields=None, **kwargs):
+    """
+    Task 1: Signal handler to log message edits before they are saved.
+    
+    This signal listens to the pre_save event on the Message model and
+    saves the old content to MessageHistory before the message is updated.
+    The old content comes from the snapshot taken at post_init, so saves
+    that leave the content alone cost no extra query, and saves whose
+    update_fields exclude content are skipped outright.
+    
+    Args:
+        sender: The Message model class
+        instance: The Message instance being saved
+        update_fields: The fields being saved, or None for all of them
         **kwargs: Additional keyword arguments
     """
-    # Explicitly delete all messages where user is sender
-    Message.objects.filter(sender=instance).delete()
+    # Only process if the message already exists (not a new creation)
+    if instance._state.adding or instance.pk is None:
+        return
+    if update_fields is not None and 'content' not in update_fields:
+        return
+    
+    old_content = getattr(instance, '_loaded_content', DEFERRED)
+    if old_content is DEFERRED:
+        # Content was deferred when the message was loaded
+        old_content = Message.objects.filter(pk=instance.pk).values_list(
+            'content', flat=True
+        ).first()
+        if old_content is None:
+            return
     
-    # Explicitly delete all messages where user is receiver  
-    Message.objects.filter(receiver=instance).delete()
+    # Check if the content has actually changed
+    if old_content == instance.content:
+        return
     
-    # Delete all notifications for this user
-    Notification.objects.filter(user=instance).delete()
+    # Mark the message as edited
+    if update_fields is not None and 'edited' not in update_fields and not instance.edited:
+        # The save will not write the flag, so set it directly
+        Message.objects.filter(pk=instance.pk).update(edited=True)
+    instance.edited = True
+    
+    # Create a history record with the old content
+    MessageHistory.objects.create(
+        message_id=instance.pk,
+        old_content=old_content,
+        edited_by_id=instance.sender_id  # Assuming sender is editing their own message
+    )
+
+
+@receiver(post_save, sender=Message)
+def refresh_message_snapshot(sender, instance, update_fields=None, **kwargs):
+    """
+    Task 1: Move the content snapshot forward once a save has written it.
     
-    print(f"Pre-delete cleanup completed for user: {instance.username}")
+    Args:
+        sender: The Message model class
+        instance: The Message instance that was saved
+        update_fields: The fields that were saved, or None for all of them
+        **kwargs: Additional keyword arguments
+    """
+    if update_fields is None or 'content' in update_fields:
+        instance._loaded_content = instance.__dict__.get('content', DEFERRED)
+
+
+@receiver(post_delete, sender=User)
+def delete_user_related_data(sender, instance, **kwargs):
+    """
+    Task 2: Signal handler recording that a user and their data are gone.
+    
+    Messages, notifications and message histories need no explicit deletes
+    here: they reference the user (or the user's messages) with CASCADE, so
+    Django's deletion collector removes them along with the user. Accounts
+    deleted through the delete_user view reach this point only at the end
+    of a background purge (see messaging.purge), with their data already
+    deleted in batches.
+    
+    Args:
+        sender: The User model class
+        instance: The User instance that was deleted
+        **kwargs: Additional keyword arguments
+    """
+    # Log the deletion for auditing purposes
+    logger.info("Deleted user %s and their messaging data", instance.username)
@@ -2,18 +2,37 @@
 Tests for the messaging app.
 
 Tests cover:
-- Task 0: Notification creation via signals
+- Task 0: Notification creation via signals and the notification outbox
 - Task 1: Message edit history via signals
-- Task 2: User deletion and cleanup
-- Task 3: Threaded conversations with optimized queries
-- Task 4: Custom manager for unread messages
+- Task 2: User deletion and cleanup, including the background purge
+- Task 3: Threaded conversations, thread paths and recursive loading
+- Task 4: Custom manager for unread messages and the unread counters
+- Task 5: Per-user page caching
 """
 
 from django.test import TestCase, TransactionTestCase
 from django.contrib.auth.models import User
-from django.db import connection
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models
 from django.test.utils import override_settings
-from .models import Message, Notification, MessageHistory
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.utils import timezone
+from .models import (
+    Message, Notification, MessageHistory, NotificationOutbox, UnreadCounter, UserPurge
+)
+from .bulk_read import mark_messages_read, mark_notifications_read
+from .cache import user_version_key
+from .counters import delete_counted, recount, reconcile_unread_counters, unread_counts
+from . import outbox
+from .outbox import OutboxDrainer, drain_notification_outbox, outbox_lag
+from . import purge as purge_module
+from .purge import UserPurger, run_purge, schedule_user_purge
+from .threads import (
+    delete_subtree, load_thread, move_subtree, path_segment, thread_summaries
+)
 from .signals import (
     create_notification_on_new_message,
     log_message_edit,
@@ -96,6 +115,7 @@ class NotificationSignalTest(TestCase):
             receiver=self.user2,
             content='Hello Bob!'
         )
+        drain_notification_outbox()
         
         # Check that notification was created
         self.assertEqual(Notification.objects.count(), 1)
@@ -114,6 +134,7 @@ class NotificationSignalTest(TestCase):
             receiver=self.user2,
             content='Parent message'
         )
+        drain_notification_outbox()
         
         # Clear notifications from parent
         Notification.objects.all().delete()
@@ -125,11 +146,145 @@ class NotificationSignalTest(TestCase):
             content='Reply message',
             parent_message=parent
         )
+        drain_notification_outbox()
         
         notification = Notification.objects.first()
         self.assertEqual(notification.notification_type, 'message_reply')
 
 
+class NotificationOutboxTest(TestCase):
+    """Task 0: Test batched notification delivery from the outbox."""
+    
+    def setUp(self):
+        """Create test users."""
+        self.user1 = User.objects.create_user(username='alice', password='testpass123')
+        self.user2 = User.objects.create_user(username='bob', password='testpass123')
+    
+    def send(self, count):
+        """Create ``count`` messages from alice to bob."""
+        return [
+            Message.objects.create(
+                sender=self.user1,
+                receiver=self.user2,
+                content=f'Message {index}'
+            )
+            for index in range(count)
+        ]
+    
+    def test_new_message_is_queued_not_notified(self):
+        """Test that saving a message only writes an outbox entry."""
+        message, = self.send(1)
+        
+        self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(
+            list(NotificationOutbox.objects.values_list('message_id', flat=True)),
+            [message.id]
+        )
+    
+    def test_edit_is_not_queued(self):
+        """Test that saving an existing message queues nothing."""
+        message, = self.send(1)
+        NotificationOutbox.objects.all().delete()
+        
+        message.content = 'Edited'
+        message.save()
+        
+        self.assertFalse(NotificationOutbox.objects.exists())
+    
+    def test_drain_delivers_and_empties_outbox(self):
+        """Test that draining creates one notification per message."""
+        messages = self.send(5)
+        
+        delivered = OutboxDrainer(batch_size=2).drain()
+        
+        self.assertEqual(delivered, 5)
+        self.assertFalse(NotificationOutbox.objects.exists())
+        self.assertEqual(
+            sorted(Notification.objects.values_list('message_id', flat=True)),
+            [message.id for message in messages]
+        )
+    
+    def test_batch_queries_do_not_grow_with_batch_size(self):
+        """Test that a batch costs the same queries for 2 or 20 messages."""
+        self.send(2)
+        drainer = OutboxDrainer(batch_size=100)
+        with self.assertNumQueries(8) as small:
+            drainer.drain(max_batches=1)
+        
+        self.send(20)
+        with self.assertNumQueries(len(small.captured_queries)):
+            drainer.drain(max_batches=1)
+        self.assertEqual(Notification.objects.count(), 22)
+    
+    def test_failed_batch_is_retried(self):
+        """Test that entries failing on their own are left for the next drain."""
+        self.send(3)
+        drainer = OutboxDrainer()
+        
+        with mock.patch.object(
+            Notification.objects, 'bulk_create', side_effect=RuntimeError('boom')
+        ), self.assertLogs('messaging.outbox', 'ERROR'):
+            self.assertEqual(drainer.drain(), 0)
+        
+        self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(
+            list(NotificationOutbox.objects.values_list('attempts', flat=True)),
+            [1, 1, 1]
+        )
+        self.assertEqual(drainer.stats()['failures'], 3)
+        
+        self.assertEqual(drainer.drain(), 3)
+        self.assertEqual(Notification.objects.count(), 3)
+    
+    def test_failing_entry_does_not_block_the_outbox(self):
+        """Test that one failing entry is set aside while the others are delivered."""
+        poison, *others = self.send(3)
+        drainer = OutboxDrainer(max_attempts=2)
+        real_build = outbox.build_notification
+        
+        def build(message):
+            if message.pk == poison.pk:
+                raise ValueError('bad message')
+            return real_build(message)
+        
+        with mock.patch('messaging.outbox.build_notification', side_effect=build), \
+                self.assertLogs('messaging.outbox', 'ERROR'):
+            self.assertEqual(drainer.drain(), 2)
+            self.assertEqual(NotificationOutbox.objects.get().attempts, 1)
+            
+            later, = self.send(1)
+            self.assertEqual(drainer.drain(), 1)
+            self.assertEqual(NotificationOutbox.objects.get().attempts, 2)
+            
+            # Dead-lettered: no longer claimed, counted in the lag or failed again
+            self.assertEqual(drainer.drain(), 0)
+            self.assertEqual(outbox_lag(max_attempts=2), 0.0)
+        
+        self.assertEqual(
+            sorted(Notification.objects.values_list('message_id', flat=True)),
+            [message.pk for message in others + [later]]
+        )
+        self.assertEqual(drainer.stats()['failures'], 2)
+        
+        self.assertEqual(outbox.requeue_failed(max_attempts=2), 1)
+        self.assertEqual(drainer.drain(), 1)
+        self.assertFalse(NotificationOutbox.objects.exists())
+    
+    def test_lag_reports_oldest_pending_entry(self):
+        """Test that the lag is zero for an empty outbox and grows with pending entries."""
+        self.assertEqual(outbox_lag(), 0.0)
+        self.send(1)
+        self.assertGreaterEqual(outbox_lag(), 0.0)
+        
+        NotificationOutbox.objects.update(created_at=timezone.now() - timedelta(seconds=30))
+        self.assertGreaterEqual(outbox_lag(), 30)
+        
+        drainer = OutboxDrainer()
+        drainer.drain()
+        self.assertGreaterEqual(drainer.stats()['last_lag'], 30)
+        self.assertEqual(outbox_lag(), 0.0)
+
+
 class MessageEditHistoryTest(TestCase):
     """Task 1: Test message edit history via signals."""
     
@@ -186,8 +341,55 @@ class MessageEditHistoryTest(TestCase):
         
         # No history should be created
         self.assertEqual(MessageHistory.objects.count(), 0)
+    
+    def test_edit_does_not_reread_message(self):
+        """Test that an edit costs only the update and the history insert."""
+        message = Message.objects.get(pk=self.message.pk)
+        message.content = 'Updated content'
+        
+        with self.assertNumQueries(2):
+            message.save()
+        
+        self.assertEqual(MessageHistory.objects.get().old_content, 'Original content')
+    
+    def test_update_fields_without_content_are_skipped(self):
+        """Test that mark_as_read saves without looking at the content."""
+        self.message.content = 'Unsaved change'
+        
+        # The message and the receiver's unread count
+        with self.assertNumQueries(2):
+            self.message.mark_as_read()
+        
+        self.assertEqual(MessageHistory.objects.count(), 0)
+    
+    def test_edit_with_update_fields_sets_edited(self):
+        """Test that saving only the content still records the edit and the flag."""
+        self.message.content = 'Updated content'
+        self.message.save(update_fields=['content'])
+        
+        self.assertEqual(MessageHistory.objects.get().old_content, 'Original content')
+        self.assertTrue(Message.objects.get(pk=self.message.pk).edited)
+    
+    def test_edit_of_message_loaded_without_content(self):
+        """Test that an edit of a message loaded with content deferred reads the old content."""
+        message = Message.objects.only('id', 'sender').get(pk=self.message.pk)
+        message.content = 'Updated content'
+        message.save()
+        
+        self.assertEqual(MessageHistory.objects.get().old_content, 'Original content')
+    
+    def test_snapshot_follows_refresh_from_db(self):
+        """Test that an edit after a reload records the reloaded content."""
+        Message.objects.filter(pk=self.message.pk).update(content='Changed elsewhere')
+        self.message.refresh_from_db()
+        
+        self.message.content = 'Updated content'
+        self.message.save()
+        
+        self.assertEqual(MessageHistory.objects.get().old_content, 'Changed elsewhere')
 
 
+@override_settings(MESSAGING_NOTIFICATION_OUTBOX={'AUTOSTART': False})
 class UserDeletionTest(TransactionTestCase):
     """Task 2: Test user deletion and related data cleanup."""
     
@@ -208,6 +410,7 @@ class UserDeletionTest(TransactionTestCase):
             receiver=self.user1,
             content='Message from Bob'
         )
+        drain_notification_outbox()
     
     def test_messages_deleted_when_user_deleted(self):
         """Test that messages are deleted when a user is deleted."""
@@ -253,6 +456,180 @@ class UserDeletionTest(TransactionTestCase):
         self.assertEqual(MessageHistory.objects.count(), 0)
 
 
+@override_settings(MESSAGING_USER_PURGE={'AUTOSTART': False})
+class UserPurgeTest(TestCase):
+    """Task 2: Test account deletion through the background purge."""
+    
+    def setUp(self):
+        """Create test users with messages in both directions."""
+        self.user1 = User.objects.create_user(username='alice', password='testpass123')
+        self.user2 = User.objects.create_user(username='bob', password='testpass123')
+        self.user3 = User.objects.create_user(username='carol', password='testpass123')
+        
+        for index in range(4):
+            message = Message.objects.create(
+                sender=self.user1,
+                receiver=self.user2,
+                content=f'From Alice {index}'
+            )
+            message.content = f'Edited {index}'
+            message.save()
+            Message.objects.create(
+                sender=self.user2,
+                receiver=self.user1,
+                content=f'From Bob {index}'
+            )
+        self.other = Message.objects.create(
+            sender=self.user2,
+            receiver=self.user3,
+            content='From Bob to Carol'
+        )
+        drain_notification_outbox()
+    
+    def test_view_deactivates_without_deleting(self):
+        """Test that the delete view deactivates the user and queues the purge."""
+        self.client.login(username='alice', password='testpass123')
+        
+        response = self.client.post('/messaging/delete-account/')
+        
+        self.assertRedirects(response, '/chats/', fetch_redirect_response=False)
+        self.user1.refresh_from_db()
+        self.assertFalse(self.user1.is_active)
+        purge = UserPurge.objects.get(user_pk=self.user1.pk)
+        self.assertEqual(purge.status, UserPurge.STATUS_PENDING)
+        self.assertEqual(Message.objects.filter(sender=self.user1).count(), 4)
+        self.assertFalse(self.client.login(username='alice', password='testpass123'))
+    
+    def test_purge_deletes_in_batches_and_records_progress(self):
+        """Test that the purge removes the user's data batch by batch."""
+        schedule_user_purge(self.user1)
+        
+        finished = UserPurger(batch_size=3, pause=0).run_pending()
+        
+        self.assertEqual(finished, 1)
+        self.assertFalse(User.objects.filter(pk=self.user1.pk).exists())
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(list(Notification.objects.values_list('message_id', flat=True)), [self.other.id])
+        self.assertEqual(MessageHistory.objects.count(), 0)
+        
+        purge = UserPurge.objects.get(user_pk=self.user1.pk)
+        self.assertEqual(purge.status, UserPurge.STATUS_DONE)
+        self.assertIsNotNone(purge.finished_at)
+        # Three batches of the messages the user sent or received
+        self.assertEqual(purge.batches, 3)
+        self.assertEqual(purge.messages_deleted, 8)
+        self.assertEqual(purge.history_deleted, 4)
+        self.assertEqual(purge.notifications_deleted, 8)
+    
+    def test_failed_purge_can_resume(self):
+        """Test that a failed purge keeps its progress and finishes when run again."""
+        purge = schedule_user_purge(self.user1)
+        
+        with mock.patch('messaging.purge.User.objects.filter', side_effect=RuntimeError('boom')), \
+                self.assertLogs('messaging.purge', 'ERROR'):
+            self.assertFalse(run_purge(purge, batch_size=3))
+        
+        purge.refresh_from_db()
+        self.assertEqual(purge.status, UserPurge.STATUS_FAILED)
+        self.assertIn('boom', purge.error)
+        self.assertEqual(purge.messages_deleted, 8)
+        self.assertTrue(User.objects.filter(pk=self.user1.pk).exists())
+        
+        finished = UserPurger().run_pending([UserPurge.STATUS_FAILED])
+        
+        self.assertEqual(finished, 1)
+        self.assertFalse(User.objects.filter(pk=self.user1.pk).exists())
+    
+    def test_failed_purge_is_retried_with_backoff(self):
+        """Test that a failed purge runs again once its retry is due, until out of attempts."""
+        purge = schedule_user_purge(self.user1)
+        purger = UserPurger(max_attempts=2, retry_delay=60)
+        
+        with mock.patch('messaging.purge.User.objects.filter', side_effect=RuntimeError('boom')), \
+                self.assertLogs('messaging.purge', 'ERROR'):
+            self.assertEqual(purger.run_pending(), 0)
+        purge.refresh_from_db()
+        self.assertEqual(purge.attempts, 1)
+        self.assertGreater(purge.retry_at, timezone.now() + timedelta(seconds=50))
+        
+        # Not due yet
+        self.assertEqual(purger.run_pending(), 0)
+        
+        UserPurge.objects.filter(pk=purge.pk).update(retry_at=timezone.now())
+        with mock.patch('messaging.purge.User.objects.filter', side_effect=RuntimeError('boom')), \
+                self.assertLogs('messaging.purge', 'ERROR'):
+            self.assertEqual(purger.run_pending(), 0)
+        purge.refresh_from_db()
+        self.assertEqual(purge.attempts, 2)
+        # The delay doubles with every attempt
+        self.assertGreater(purge.retry_at, timezone.now() + timedelta(seconds=110))
+        
+        # Out of attempts: only a forced resume runs it
+        UserPurge.objects.filter(pk=purge.pk).update(retry_at=timezone.now())
+        self.assertEqual(purger.run_pending(), 0)
+        self.assertEqual(purger.run_pending([UserPurge.STATUS_FAILED]), 1)
+    
+    def test_stale_running_purge_is_taken_over(self):
+        """Test that a purge left running by a stopped process is run again once stale."""
+        purge = schedule_user_purge(self.user1)
+        UserPurge.objects.filter(pk=purge.pk).update(status=UserPurge.STATUS_RUNNING)
+        purger = UserPurger(stale_after=600)
+        
+        self.assertEqual(purger.run_pending(), 0)
+        
+        UserPurge.objects.filter(pk=purge.pk).update(
+            updated_at=timezone.now() - timedelta(seconds=601)
+        )
+        self.assertEqual(purger.run_pending(), 1)
+        self.assertFalse(User.objects.filter(pk=self.user1.pk).exists())
+    
+    def test_replies_are_deleted_before_the_messages_they_answer(self):
+        """Test that no batch cascades into other users' replies below the user's messages."""
+        root = Message.objects.filter(sender=self.user1).first()
+        reply = Message.objects.create(
+            sender=self.user3, receiver=self.user1, content='Reply', parent_message=root
+        )
+        nested = Message.objects.create(
+            sender=self.user2, receiver=self.user3, content='Nested', parent_message=reply
+        )
+        deeper = Message.objects.create(
+            sender=self.user3, receiver=self.user2, content='Deeper', parent_message=nested
+        )
+        schedule_user_purge(self.user1)
+        
+        deleted = []
+        real_delete_thread_batch = purge_module.delete_thread_batch
+        
+        def delete_thread_batch(user_pk, batch_size):
+            counts = real_delete_thread_batch(user_pk, batch_size)
+            if counts is not None:
+                deleted.append(counts.get(Message._meta.label, 0))
+            return counts
+        
+        with mock.patch.object(
+            purge_module, 'STAGES',
+            [('threads', delete_thread_batch)] + purge_module.STAGES[1:]
+        ):
+            self.assertEqual(UserPurger(batch_size=2, pause=0).run_pending(), 1)
+        
+        # 8 own messages and 3 replies, never more than a batch at a time
+        self.assertEqual(deleted, [2, 2, 2, 2, 2, 1])
+        self.assertFalse(Message.objects.filter(pk__in=[reply.pk, nested.pk, deeper.pk]).exists())
+        self.assertEqual(list(Message.objects.values_list('pk', flat=True)), [self.other.pk])
+    
+    def test_deactivated_user_receives_no_messages(self):
+        """Test that messages cannot be sent to an account being deleted."""
+        schedule_user_purge(self.user1)
+        self.client.login(username='bob', password='testpass123')
+        
+        response = self.client.post('/messaging/send/', {
+            'receiver_id': self.user1.pk,
+            'content': 'Too late',
+        })
+        
+        self.assertEqual(response.status_code, 404)
+
+
 class ThreadedConversationTest(TestCase):
     """Task 3: Test threaded conversations and query optimization."""
     
@@ -294,10 +671,11 @@ class ThreadedConversationTest(TestCase):
         """Test getting all replies to a message."""
         replies = self.root_message.get_all_replies()
         
-        # Should have 2 direct replies
-        self.assertEqual(replies.count(), 2)
+        # Should have 2 direct replies and the nested one
+        self.assertEqual(replies.count(), 3)
         self.assertIn(self.reply1, replies)
         self.assertIn(self.reply2, replies)
+        self.assertIn(self.nested_reply, replies)
     
     def test_nested_replies(self):
         """Test nested reply structure."""
@@ -325,6 +703,308 @@ class ThreadedConversationTest(TestCase):
                 _ = msg.receiver.username
 
 
+class ThreadLoadingTest(TestCase):
+    """Task 3: Test loading whole threads with one recursive query."""
+    
+    def setUp(self):
+        """Create a root message with a chain of replies and a side branch."""
+        self.user1 = User.objects.create_user(username='alice', password='testpass123')
+        self.user2 = User.objects.create_user(username='bob', password='testpass123')
+        
+        self.root = self.reply(None, 'Root')
+        self.chain = []
+        parent = self.root
+        for depth in range(1, 7):
+            parent = self.reply(parent, f'Depth {depth}')
+            self.chain.append(parent)
+        self.branch = self.reply(self.root, 'Second branch')
+    
+    def reply(self, parent, content):
+        """Create a message, alternating sender and receiver by depth."""
+        sender, receiver = self.user1, self.user2
+        if parent is not None and parent.sender == self.user1:
+            sender, receiver = receiver, sender
+        return Message.objects.create(
+            sender=sender, receiver=receiver, content=content, parent_message=parent
+        )
+    
+    def test_loads_every_depth_in_one_query(self):
+        """Test that the whole thread, with senders, comes from one query."""
+        with self.assertNumQueries(1):
+            thread = load_thread(self.root.pk)
+            usernames = [message.sender.username for message in thread.messages]
+        
+        self.assertEqual(len(usernames), 7)
+        self.assertEqual(thread.root, self.root)
+        self.assertFalse(thread.truncated)
+        # Depth first: the chain, then the later branch
+        self.assertEqual(thread.messages, self.chain + [self.branch])
+        self.assertEqual(
+            [message.thread_depth for message in thread.messages],
+            [1, 2, 3, 4, 5, 6, 1]
+        )
+        self.assertEqual(thread.root.thread_replies, [self.chain[0], self.branch])
+    
+    def test_depth_limit(self):
+        """Test that replies below MAX_DEPTH are left out and flagged."""
+        thread = load_thread(self.root.pk, max_depth=3)
+        
+        self.assertEqual(thread.messages, self.chain[:3] + [self.branch])
+        self.assertTrue(thread.truncated)
+        self.assertEqual(thread.messages[2].thread_replies, [])
+    
+    def test_size_limit(self):
+        """Test that only the oldest MAX_SIZE replies are loaded."""
+        thread = load_thread(self.root.pk, max_size=4)
+        
+        self.assertEqual(thread.messages, self.chain[:4])
+        self.assertTrue(thread.truncated)
+    
+    def test_subthread(self):
+        """Test loading a thread from a reply."""
+        thread = load_thread(self.chain[3].pk)
+        
+        self.assertEqual(thread.root, self.chain[3])
+        self.assertEqual(thread.messages, self.chain[4:])
+    
+    def test_missing_root(self):
+        """Test that a missing root loads no thread."""
+        self.assertIsNone(load_thread(self.branch.pk + 100))
+    
+    def test_recursive_cte_without_paths(self):
+        """Test that threads saved before paths existed load with the recursive query."""
+        Message.objects.update(thread_root=None, path=None)
+        
+        thread = load_thread(self.root.pk)
+        self.chain[3].refresh_from_db()
+        
+        self.assertEqual(thread.messages, self.chain + [self.branch])
+        self.assertEqual(set(self.chain[3].get_all_replies()), set(self.chain[4:]))
+    
+    def test_fallback_without_recursive_cte(self):
+        """Test that the level-by-level fallback loads the same thread."""
+        Message.objects.update(thread_root=None, path=None)
+        self.root.path = None
+        with mock.patch('messaging.threads.supports_recursive_cte', return_value=False):
+            thread = load_thread(self.root.pk)
+            replies = set(self.root.get_all_replies())
+        
+        self.assertEqual(thread.messages, self.chain + [self.branch])
+        self.assertEqual(replies, set(self.chain + [self.branch]))
+    
+    def test_view_renders_every_depth(self):
+        """Test that the thread view shows the deepest replies."""
+        cache.clear()
+        self.client.login(username='alice', password='testpass123')
+        
+        response = self.client.get(f'/messaging/thread/{self.root.pk}/')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Depth 6')
+        self.assertContains(response, 'margin: 10px 0 10px 120px')
+
+
+class ThreadPathTest(TestCase):
+    """Task 3: Test thread roots and materialized paths."""
+    
+    def setUp(self):
+        """Create two threads."""
+        self.user1 = User.objects.create_user(username='alice', password='testpass123')
+        self.user2 = User.objects.create_user(username='bob', password='testpass123')
+        
+        self.root = self.send('Root')
+        self.reply1 = self.send('Reply 1', self.root)
+        self.nested = self.send('Nested', self.reply1)
+        self.reply2 = self.send('Reply 2', self.root)
+        self.other_root = self.send('Other root')
+    
+    def send(self, content, parent=None):
+        """Create a message from alice to bob."""
+        return Message.objects.create(
+            sender=self.user1, receiver=self.user2, content=content, parent_message=parent
+        )
+    
+    def test_path_index_fits_mysql_key_limit(self):
+        """Test that paths are single-byte on MySQL so the index stays under 3072 bytes."""
+        field = Message._meta.get_field('path')
+        mysql = mock.Mock(vendor='mysql')
+        
+        self.assertEqual(
+            field.db_type(mysql), 'varchar(1200) CHARACTER SET ascii COLLATE ascii_bin'
+        )
+        # thread_root is a bigint: 8 bytes, plus one byte per path character
+        self.assertLessEqual(8 + field.max_length, 3072)
+        self.assertEqual(field.db_type(connection), models.CharField(max_length=1200).db_type(connection))
+    
+    def test_positions_set_on_insert(self):
+        """Test that new messages get their thread root and path."""
+        self.assertEqual(self.root.thread_root_id, self.root.pk)
+        self.assertEqual(self.root.path, path_segment(self.root.pk))
+        self.assertEqual(self.nested.thread_root_id, self.root.pk)
+        self.assertEqual(
+            self.nested.path,
+            path_segment(self.root.pk) + path_segment(self.reply1.pk) + path_segment(self.nested.pk)
+        )
+        stored = Message.objects.get(pk=self.nested.pk)
+        self.assertEqual((stored.thread_root_id, stored.path), (self.root.pk, self.nested.path))
+    
+    def test_reply_to_unloaded_parent(self):
+        """Test that a reply created by parent id reads the parent's path."""
+        reply = Message.objects.create(
+            sender=self.user2, receiver=self.user1, content='By id',
+            parent_message_id=self.nested.pk
+        )
+        
+        self.assertEqual(reply.path, self.nested.path + path_segment(reply.pk))
+    
+    def test_path_order_is_depth_first(self):
+        """Test that sorting a thread by path lists replies below their parents."""
+        thread = Message.objects.filter(thread_root=self.root).order_by('path')
+        
+        self.assertEqual(list(thread), [self.root, self.reply1, self.nested, self.reply2])
+    
+    def test_thread_summaries(self):
+        """Test reply counts and latest activity for several threads in one query."""
+        with self.assertNumQueries(1):
+            summaries = thread_summaries([self.root.pk, self.other_root.pk])
+        
+        self.assertEqual(summaries[self.root.pk]['reply_count'], 3)
+        self.assertEqual(summaries[self.root.pk]['latest_activity'], self.reply2.timestamp)
+        self.assertEqual(summaries[self.other_root.pk]['reply_count'], 0)
+    
+    def test_move_subtree(self):
+        """Test that moving a reply moves everything below it."""
+        moved = move_subtree(self.reply1, self.other_root)
+        
+        self.assertEqual(moved, 2)
+        self.nested.refresh_from_db()
+        self.assertEqual(self.nested.thread_root_id, self.other_root.pk)
+        self.assertTrue(self.nested.path.startswith(self.other_root.path + path_segment(self.reply1.pk)))
+        self.assertEqual(Message.objects.get(pk=self.reply1.pk).parent_message_id, self.other_root.pk)
+        self.assertEqual(set(self.other_root.get_all_replies()), {self.reply1, self.nested})
+        self.assertEqual(list(self.root.get_all_replies()), [self.reply2])
+    
+    def test_move_subtree_to_new_thread(self):
+        """Test that a reply moved without a parent starts its own thread."""
+        move_subtree(self.reply1)
+        
+        self.nested.refresh_from_db()
+        self.assertEqual(self.nested.thread_root_id, self.reply1.pk)
+        self.assertEqual(thread_summaries([self.reply1.pk])[self.reply1.pk]['reply_count'], 1)
+    
+    def test_cannot_move_below_own_reply(self):
+        """Test that a subtree cannot be moved into itself."""
+        with self.assertRaises(ValueError):
+            move_subtree(self.reply1, self.nested)
+    
+    def test_delete_subtree(self):
+        """Test that deleting a reply deletes everything below it only."""
+        delete_subtree(self.reply1)
+        
+        self.assertEqual(
+            set(Message.objects.values_list('pk', flat=True)),
+            {self.root.pk, self.reply2.pk, self.other_root.pk}
+        )
+    
+    def test_backfill_command(self):
+        """Test that the backfill command restores the positions of every message."""
+        expected = dict(Message.objects.values_list('pk', 'path'))
+        Message.objects.update(thread_root=None, path=None)
+        
+        call_command('backfill_thread_paths', batch_size=2, stdout=StringIO())
+        
+        self.assertEqual(dict(Message.objects.values_list('pk', 'path')), expected)
+        self.assertEqual(
+            Message.objects.filter(thread_root=self.root).count(), 4
+        )
+
+
+class UserPageCacheTest(TestCase):
+    """Task 5: Test per-user page caching invalidated by signals."""
+    
+    def setUp(self):
+        """Create test users and a conversation."""
+        cache.clear()
+        self.user1 = User.objects.create_user(username='alice', password='testpass123')
+        self.user2 = User.objects.create_user(username='bob', password='testpass123')
+        self.user3 = User.objects.create_user(username='carol', password='testpass123')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.message = Message.objects.create(
+                sender=self.user1, receiver=self.user2, content='Hello Bob'
+            )
+            self.to_alice = Message.objects.create(
+                sender=self.user3, receiver=self.user1, content='Hello Alice'
+            )
+        self.client.login(username='bob', password='testpass123')
+    
+    def test_page_served_from_cache_until_change(self):
+        """Test that the inbox is cached until one of the user's messages changes."""
+        self.assertContains(self.client.get('/messaging/inbox/'), 'Hello Bob')
+        
+        # Changes that bypass signals are not seen while the page is cached
+        Message.objects.filter(pk=self.message.pk).update(content='Changed quietly')
+        self.assertContains(self.client.get('/messaging/inbox/'), 'Hello Bob')
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.message.content = 'Hello again Bob'
+            self.message.save()
+        self.assertContains(self.client.get('/messaging/inbox/'), 'Hello again Bob')
+    
+    def test_unrelated_change_keeps_page(self):
+        """Test that other users' messages leave the page cached."""
+        self.client.get('/chats/messages/')
+        version = cache.get(user_version_key(self.user2.pk))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.to_alice.content = 'Hello again Alice'
+            self.to_alice.save()
+        
+        self.assertEqual(cache.get(user_version_key(self.user2.pk)), version)
+    
+    def test_pages_are_not_shared_between_users(self):
+        """Test that the same URL serves each user their own page."""
+        self.assertContains(self.client.get('/chats/conversations/'), 'Hello Bob')
+        
+        self.client.login(username='alice', password='testpass123')
+        response = self.client.get('/chats/conversations/')
+        
+        self.assertNotContains(response, 'Hello Bob')
+        self.assertContains(response, 'Hello Alice')
+        self.assertIn('private', response['Cache-Control'])
+    
+    def test_thread_page_invalidated_by_any_reply(self):
+        """Test that a reply between other users refreshes the thread page."""
+        url = f'/messaging/thread/{self.message.pk}/'
+        self.assertNotContains(self.client.get(url), 'Carol here')
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(
+                sender=self.user3, receiver=self.user1,
+                content='Carol here', parent_message=self.message
+            )
+        
+        self.assertContains(self.client.get(url), 'Carol here')
+    
+    def test_delivered_notification_invalidates_receiver(self):
+        """Test that bulk-created notifications bump their users' versions."""
+        self.client.get('/messaging/inbox/')
+        version = cache.get(user_version_key(self.user2.pk))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            drain_notification_outbox()
+        
+        self.assertGreater(cache.get(user_version_key(self.user2.pk)), version)
+    
+    def test_forbidden_thread_not_cached(self):
+        """Test that only successful responses are cached."""
+        self.client.login(username='carol', password='testpass123')
+        url = f'/messaging/thread/{self.message.pk}/'
+        
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.login(username='bob', password='testpass123')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
 class UnreadMessagesManagerTest(TestCase):
     """Task 4: Test custom manager for unread messages."""
     
@@ -382,6 +1062,272 @@ class UnreadMessagesManagerTest(TestCase):
         self.assertEqual(unread.count(), 0)
 
 
+class UnreadCounterTest(TestCase):
+    """Task 4: Test the per-user unread counters."""
+    
+    def setUp(self):
+        """Create test users, with a counter row for the receiver."""
+        self.user1 = User.objects.create_user(username='alice', password='testpass123')
+        self.user2 = User.objects.create_user(username='bob', password='testpass123')
+        self.assertEqual(unread_counts(self.user2.pk).messages, 0)
+    
+    def counts(self, user):
+        """Return the user's stored (messages, notifications)."""
+        counter = UnreadCounter.objects.get(pk=user.pk)
+        return counter.messages, counter.notifications
+    
+    def test_first_read_counts_existing_rows(self):
+        """Test that a missing counter row is created from the real counts."""
+        Message.objects.create(sender=self.user2, receiver=self.user1, content='Hi')
+        Message.objects.create(sender=self.user2, receiver=self.user1, content='Read', read=True)
+        self.assertFalse(UnreadCounter.objects.filter(pk=self.user1.pk).exists())
+        
+        counter = unread_counts(self.user1.pk)
+        
+        self.assertEqual((counter.messages, counter.notifications), (1, 0))
+        with self.assertNumQueries(1):
+            unread_counts(self.user1.pk)
+    
+    def test_new_and_read_messages_adjust_count(self):
+        """Test that sending and reading messages keep the count current."""
+        message = Message.objects.create(sender=self.user1, receiver=self.user2, content='Hi')
+        Message.objects.create(sender=self.user1, receiver=self.user2, content='Again')
+        self.assertEqual(self.counts(self.user2), (2, 0))
+        
+        message.mark_as_read()
+        message.mark_as_read()
+        self.assertEqual(self.counts(self.user2), (1, 0))
+        
+        message.read = False
+        message.save()
+        self.assertEqual(self.counts(self.user2), (2, 0))
+        
+        delete_counted(Message.objects.filter(pk=message.pk))
+        self.assertEqual(self.counts(self.user2), (1, 0))
+    
+    def test_batch_delete_adjusts_counts_once(self):
+        """Test that deleting a batch costs the same queries for 2 or 20 unread messages."""
+        def send(count):
+            messages = [
+                Message.objects.create(sender=self.user1, receiver=self.user2, content='Hi')
+                for _ in range(count)
+            ]
+            drain_notification_outbox()
+            return Message.objects.filter(pk__in=[message.pk for message in messages])
+        
+        batch = send(2)
+        with self.assertNumQueries(12) as small:
+            delete_counted(batch)
+        self.assertEqual(self.counts(self.user2), (0, 0))
+        
+        batch = send(20)
+        with self.assertNumQueries(len(small.captured_queries)):
+            total, counts = delete_counted(batch)
+        self.assertEqual(counts[Message._meta.label], 20)
+        self.assertEqual(counts[Notification._meta.label], 20)
+        self.assertEqual(self.counts(self.user2), (0, 0))
+    
+    def test_saves_leaving_read_alone_do_not_count(self):
+        """Test that edits and reloaded messages do not change the count."""
+        message = Message.objects.create(sender=self.user1, receiver=self.user2, content='Hi')
+        message.content = 'Edited'
+        message.save(update_fields=['content', 'edited'])
+        
+        loaded = Message.objects.get(pk=message.pk)
+        loaded.save()
+        
+        self.assertEqual(self.counts(self.user2), (1, 0))
+    
+    def test_deferred_read_is_recounted(self):
+        """Test that saving a message loaded without its read flag recounts."""
+        message = Message.objects.create(sender=self.user1, receiver=self.user2, content='Hi')
+        loaded = Message.objects.defer('read').get(pk=message.pk)
+        loaded.read = True
+        loaded.save(update_fields=['read'])
+        
+        self.assertEqual(self.counts(self.user2), (0, 0))
+    
+    def test_notifications_adjust_count(self):
+        """Test that delivered and read notifications keep the count current."""
+        Message.objects.create(sender=self.user1, receiver=self.user2, content='Hi')
+        drain_notification_outbox()
+        self.assertEqual(self.counts(self.user2), (1, 1))
+        
+        Notification.objects.get(user=self.user2).mark_as_read()
+        self.assertEqual(self.counts(self.user2), (1, 0))
+    
+    def test_recount_without_conflict_target(self):
+        """Test that recounting works on databases without an upsert conflict target."""
+        Message.objects.create(sender=self.user1, receiver=self.user1, content='Hi')
+        
+        # MySQL and MariaDB: ON DUPLICATE KEY UPDATE takes no unique fields
+        with mock.patch.object(connection.features, 'supports_update_conflicts_with_target', False), \
+                mock.patch.object(UnreadCounter.objects, 'bulk_create') as bulk_create:
+            recount([self.user1.pk])
+        self.assertIsNone(bulk_create.call_args.kwargs['unique_fields'])
+        
+        # No upsert at all: rows are created or updated one by one
+        with mock.patch.object(connection.features, 'supports_update_conflicts', False):
+            recount([self.user1.pk, self.user2.pk])
+            Message.objects.create(sender=self.user1, receiver=self.user2, content='Hi')
+            UnreadCounter.objects.filter(pk=self.user2.pk).update(messages=7)
+            recount([self.user2.pk])
+        self.assertEqual(self.counts(self.user1), (1, 0))
+        self.assertEqual(self.counts(self.user2), (1, 0))
+    
+    def test_reconciler_corrects_drift(self):
+        """Test that updates bypassing signals are corrected by the reconciler."""
+        Message.objects.create(sender=self.user1, receiver=self.user2, content='Hi')
+        Message.objects.filter(receiver=self.user2).update(read=True)
+        self.assertEqual(self.counts(self.user2), (1, 0))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(reconcile_unread_counters(batch_size=1), 1)
+        
+        self.assertEqual(self.counts(self.user2), (0, 0))
+        self.assertEqual(reconcile_unread_counters(), 0)
+    
+    def test_reconcile_command(self):
+        """Test the reconcile_unread_counters management command."""
+        UnreadCounter.objects.filter(pk=self.user2.pk).update(messages=5)
+        out = StringIO()
+        
+        call_command('reconcile_unread_counters', '--once', stdout=out)
+        
+        self.assertIn('Corrected 1 unread counters', out.getvalue())
+        self.assertEqual(self.counts(self.user2), (0, 0))
+    
+    def test_inbox_badge_reads_counter(self):
+        """Test that the inbox shows the stored counts."""
+        cache.clear()
+        Message.objects.create(sender=self.user1, receiver=self.user2, content='Hi')
+        self.client.login(username='bob', password='testpass123')
+        
+        response = self.client.get('/messaging/inbox/')
+        
+        self.assertContains(response, 'Unread Messages (1)')
+        self.assertContains(response, 'Unread notifications: 0')
+
+
+class BulkReadTest(TestCase):
+    """Task 4: Test marking many messages and notifications read at once."""
+    
+    def setUp(self):
+        """Create test users and unread messages with their notifications."""
+        cache.clear()
+        self.user1 = User.objects.create_user(username='alice', password='testpass123')
+        self.user2 = User.objects.create_user(username='bob', password='testpass123')
+        unread_counts(self.user2.pk)
+        self.messages = [
+            Message.objects.create(sender=self.user1, receiver=self.user2, content=f'Message {i}')
+            for i in range(3)
+        ]
+        self.other = Message.objects.create(sender=self.user2, receiver=self.user1, content='Reply')
+        drain_notification_outbox()
+        start = timezone.now() - timedelta(hours=3)
+        for i, message in enumerate(self.messages):
+            Message.objects.filter(pk=message.pk).update(timestamp=start + timedelta(hours=i))
+            Notification.objects.filter(message=message).update(timestamp=start + timedelta(hours=i))
+        self.start = start
+    
+    def counts(self):
+        """Return bob's stored (messages, notifications)."""
+        counter = UnreadCounter.objects.get(pk=self.user2.pk)
+        return counter.messages, counter.notifications
+    
+    def test_mark_all_messages_read_is_one_update(self):
+        """Test that marking all messages read costs one UPDATE plus the counter."""
+        # Savepoint, the messages, the counter, release
+        with self.assertNumQueries(4):
+            self.assertEqual(mark_messages_read(self.user2), 3)
+        
+        self.assertFalse(Message.objects.filter(receiver=self.user2, read=False).exists())
+        self.assertFalse(Message.objects.get(pk=self.other.pk).read)
+        self.assertEqual(self.counts(), (0, 3))
+        self.assertEqual(mark_messages_read(self.user2), 0)
+    
+    def test_mark_read_until_timestamp(self):
+        """Test that only rows up to the timestamp are marked read."""
+        until = self.start + timedelta(hours=1)
+        
+        self.assertEqual(mark_messages_read(self.user2, until=until), 2)
+        self.assertEqual(mark_notifications_read(self.user2, until=until), 2)
+        
+        self.assertEqual(self.counts(), (1, 1))
+        self.assertFalse(Message.objects.get(pk=self.messages[2].pk).read)
+    
+    def test_mark_ids_read_ignores_other_users_rows(self):
+        """Test that ids of rows belonging to other users are left alone."""
+        ids = [self.messages[0].pk, self.other.pk]
+        
+        self.assertEqual(mark_messages_read(self.user2, ids=ids), 1)
+        
+        self.assertFalse(Message.objects.get(pk=self.other.pk).read)
+        self.assertEqual(self.counts(), (2, 3))
+    
+    def test_mark_read_invalidates_cached_pages(self):
+        """Test that the user's cache version is bumped once the update commits."""
+        self.client.login(username='bob', password='testpass123')
+        self.client.get('/messaging/inbox/')
+        before = cache.get(user_version_key(self.user2.pk))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_notifications_read(self.user2)
+        
+        self.assertNotEqual(cache.get(user_version_key(self.user2.pk)), before)
+        self.assertContains(self.client.get('/messaging/inbox/'), 'Unread notifications: 0')
+    
+    def test_bulk_mark_read_views(self):
+        """Test the mark-read endpoints with ids, a timestamp and no filter."""
+        self.client.login(username='bob', password='testpass123')
+        
+        response = self.client.post(
+            '/messaging/messages/read/', {'ids': [self.messages[0].pk, self.messages[1].pk]}
+        )
+        self.assertEqual(response.json(), {'status': 'success', 'marked': 2})
+        
+        response = self.client.post(
+            '/messaging/notifications/read/', {'until': self.start.isoformat()}
+        )
+        self.assertEqual(response.json()['marked'], 1)
+        
+        response = self.client.post('/messaging/notifications/read/')
+        self.assertEqual(response.json()['marked'], 2)
+        self.assertEqual(self.counts(), (1, 0))
+        
+        self.assertEqual(self.client.post('/messaging/messages/read/', {'until': 'soon'}).status_code, 400)
+        self.assertEqual(self.client.get('/messaging/messages/read/').status_code, 405)
+    
+    def test_message_detail_marks_message_and_replies_read(self):
+        """Test that viewing a message marks it and its replies to the viewer read."""
+        reply = Message.objects.create(
+            sender=self.user1, receiver=self.user2, content='Follow-up',
+            parent_message=self.messages[0]
+        )
+        self.client.login(username='bob', password='testpass123')
+        
+        response = self.client.get(f'/messaging/message/{self.messages[0].pk}/')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Message.objects.get(pk=self.messages[0].pk).read)
+        self.assertTrue(Message.objects.get(pk=reply.pk).read)
+        self.assertEqual(self.counts()[0], 2)
+    
+    def test_message_detail_leaves_sent_message_unread(self):
+        """Test that a sender viewing their own message does not see it as read."""
+        reply = Message.objects.create(
+            sender=self.user1, receiver=self.user2, content='Answer',
+            parent_message=self.other
+        )
+        self.client.login(username='bob', password='testpass123')
+        
+        response = self.client.get(f'/messaging/message/{self.other.pk}/')
+        
+        self.assertFalse(response.context['message'].read)
+        self.assertFalse(Message.objects.get(pk=self.other.pk).read)
+        self.assertTrue(Message.objects.get(pk=reply.pk).read)
+
+
 class IntegrationTest(TestCase):
     """Integration tests for the complete messaging system."""
     
@@ -398,6 +1344,7 @@ class IntegrationTest(TestCase):
             receiver=self.user2,
             content='Hello Bob!'
         )
+        drain_notification_outbox()
         
         # Verify notification was created
         self.assertEqual(Notification.objects.count(), 1)
@@ -421,6 +1368,7 @@ class IntegrationTest(TestCase):
             content='I am fine, thanks!',
             parent_message=message
         )
+        drain_notification_outbox()
         
         # Verify reply structure
         self.assertEqual(reply.parent_message, message)
@@ -434,3 +1382,16 @@ class IntegrationTest(TestCase):
         message.mark_as_read()
         unread = Message.unread.unread_for_user(self.user2)
         self.assertNotIn(message, unread)
+
+
+class MigrationTest(TestCase):
+    """Test that the migrations describe the models."""
+    
+    @override_settings(MIGRATION_MODULES={})
+    def test_models_have_migrations(self):
+        """Test that no model change is missing a migration."""
+        out = StringIO()
+        try:
+            call_command('makemigrations', 'messaging', check=True, dry_run=True, stdout=out)
+        except SystemExit:
+            self.fail(f'Missing messaging migrations:\n{out.getvalue()}')
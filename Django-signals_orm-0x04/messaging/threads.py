@@ -0,0 +1,364 @@
+"""
+Loading whole conversation threads.
+
+Task 3: A thread is a root message and every reply below it, at any depth.
+Every message stores its thread_root and a materialized path: the ids from
+the root down to the message, each zero-padded to PATH_SEGMENT_WIDTH digits.
+Sorting by path lists a thread depth first with siblings oldest first, and
+the messages below any message are one range of paths within its thread, so
+reading a thread or subtree is one range scan of the (thread_root, path)
+index. Both fields are set right after a message is inserted; rows written
+before they existed are filled in by ``python manage.py backfill_thread_paths``.
+
+Until then, such threads are loaded with a recursive CTE walking
+parent_message down from the root, or one level per query on databases
+without recursive CTEs.
+
+The messages are then assembled into a tree in a single pass. Threads are
+cut off below MAX_DEPTH levels of replies and after MAX_SIZE messages
+(depth first); Thread.truncated tells the template when that happened.
+
+    MESSAGING_THREADS = {
+        'MAX_DEPTH': 100,
+        'MAX_SIZE': 2000,
+    }
+"""
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Max, Subquery, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Concat, Length, Substr
+
+from .cache import bump_on_commit
+from .counters import delete_counted
+from .models import Message
+
+# Digits each message's id takes up in a path
+PATH_SEGMENT_WIDTH = 12
+
+
+def thread_limits():
+    """Return (max depth, max size) from the MESSAGING_THREADS setting."""
+    config = getattr(settings, 'MESSAGING_THREADS', {})
+    return config.get('MAX_DEPTH', 100), config.get('MAX_SIZE', 2000)
+
+
+def path_segment(pk):
+    """Return the path segment for the message ``pk``."""
+    return str(pk).zfill(PATH_SEGMENT_WIDTH)
+
+
+def subtree_bounds(path):
+    """
+    Return (lower, upper) bounds of the paths of a message and its replies.
+
+    A path belongs to the subtree of ``path`` if lower <= it < upper: upper
+    is the path the message's next sibling id would have.
+    """
+    head, last = path[:-PATH_SEGMENT_WIDTH], path[-PATH_SEGMENT_WIDTH:]
+    return path, head + path_segment(int(last) + 1)
+
+
+def assign_thread_position(message):
+    """
+    Set thread_root and path of a message that has just been inserted.
+
+    The values come from the parent, which is read only if it is not
+    already loaded. A reply whose parent has no path yet keeps none; the
+    backfill command fills it in later.
+    """
+    if message.parent_message_id is None:
+        thread_root_id, path = message.pk, path_segment(message.pk)
+    else:
+        parent_field = Message._meta.get_field('parent_message')
+        if parent_field.is_cached(message) and message.parent_message.path:
+            parent_root_id = message.parent_message.thread_root_id
+            parent_path = message.parent_message.path
+        else:
+            parent_root_id, parent_path = Message.objects.filter(
+                pk=message.parent_message_id
+            ).values_list('thread_root_id', 'path').first() or (None, None)
+        if parent_path is None:
+            return
+        thread_root_id, path = parent_root_id, parent_path + path_segment(message.pk)
+        if len(path) > Message._meta.get_field('path').max_length:
+            # Too deep to have a path; still counted in its thread
+            path = None
+    Message.objects.filter(pk=message.pk).update(thread_root_id=thread_root_id, path=path)
+    message.thread_root_id = thread_root_id
+    message.path = path
+
+
+def subtree_queryset(message):
+    """Return a queryset of ``message`` and every reply below it, by path range."""
+    lower, upper = subtree_bounds(message.path)
+    return Message.objects.filter(
+        thread_root_id=message.thread_root_id, path__gte=lower, path__lt=upper
+    )
+
+
+def move_subtree(message, new_parent=None):
+    """
+    Move ``message`` and its replies below ``new_parent``.
+
+    With no new parent, the message becomes the root of a thread of its
+    own. The paths of the whole subtree are rewritten with one UPDATE.
+
+    Returns:
+        Number of messages moved
+    """
+    if message.path is None or (new_parent is not None and new_parent.path is None):
+        raise ValueError('Messages without a path cannot be moved; run backfill_thread_paths')
+    lower, upper = subtree_bounds(message.path)
+    if (
+        new_parent is not None
+        and new_parent.thread_root_id == message.thread_root_id
+        and lower <= new_parent.path < upper
+    ):
+        raise ValueError('A message cannot be moved below its own replies')
+
+    if new_parent is None:
+        thread_root_id, path = message.pk, path_segment(message.pk)
+    else:
+        thread_root_id = new_parent.thread_root_id
+        path = new_parent.path + path_segment(message.pk)
+    with transaction.atomic():
+        moved = subtree_queryset(message).update(
+            thread_root_id=thread_root_id,
+            path=Concat(Value(path), Substr('path', len(message.path) + 1)),
+        )
+        Message.objects.filter(pk=message.pk).update(parent_message=new_parent)
+        bump_on_commit(thread_root_ids=[message.thread_root_id, thread_root_id])
+    message.parent_message = new_parent
+    message.thread_root_id = thread_root_id
+    message.path = path
+    return moved
+
+
+def delete_subtree(message):
+    """
+    Delete ``message`` and every reply below it.
+
+    Returns:
+        The (total, per model) counts from QuerySet.delete()
+    """
+    return delete_counted(subtree_queryset(message))
+
+
+def thread_summaries(root_ids):
+    """
+    Return the reply count and latest activity of each thread.
+
+    Args:
+        root_ids: Primary keys of thread root messages
+
+    Returns:
+        Dict of root id to {'reply_count', 'latest_activity'}
+    """
+    rows = Message.objects.filter(thread_root_id__in=root_ids).values(
+        'thread_root_id'
+    ).annotate(
+        message_count=Count('pk'),
+        latest_activity=Max('timestamp'),
+    ).order_by()
+    return {
+        row['thread_root_id']: {
+            'reply_count': row['message_count'] - 1,
+            'latest_activity': row['latest_activity'],
+        }
+        for row in rows
+    }
+
+
+def supports_recursive_cte():
+    """Return True if the database can run WITH RECURSIVE queries."""
+    if connection.vendor in ('sqlite', 'postgresql'):
+        return True
+    if connection.vendor == 'mysql':
+        if connection.mysql_is_mariadb:
+            return connection.mysql_version >= (10, 2, 2)
+        return connection.mysql_version >= (8, 0, 1)
+    return False
+
+
+def descendant_ids_sql(root_id, max_depth, include_root=True):
+    """
+    Return (sql, params) selecting the ids of the replies below ``root_id``.
+
+    Args:
+        root_id: Primary key of the message to start from
+        max_depth: Deepest level of replies to follow
+        include_root: Whether the root's own id is selected too
+    """
+    quote = connection.ops.quote_name
+    table = quote(Message._meta.db_table)
+    pk = quote(Message._meta.pk.column)
+    parent = quote(Message._meta.get_field('parent_message').column)
+    sql = (
+        f'WITH RECURSIVE thread (id, depth) AS ('
+        f'SELECT {pk}, 0 FROM {table} WHERE {pk} = %s '
+        f'UNION ALL '
+        f'SELECT child.{pk}, thread.depth + 1 FROM {table} child '
+        f'INNER JOIN thread ON child.{parent} = thread.id '
+        f'WHERE thread.depth < %s'
+        f') SELECT id FROM thread'
+    )
+    if not include_root:
+        sql += ' WHERE depth > 0'
+    return sql, [root_id, max_depth]
+
+
+def descendant_ids(root_id, max_depth):
+    """
+    Return the ids of the replies below ``root_id``, one query per level.
+
+    Fallback for databases without recursive CTEs.
+    """
+    ids = []
+    frontier = [root_id]
+    for _ in range(max_depth):
+        frontier = list(
+            Message.objects.filter(parent_message_id__in=frontier).values_list('pk', flat=True)
+        )
+        if not frontier:
+            break
+        ids.extend(frontier)
+    return ids
+
+
+def path_thread_queryset(root_id, max_depth):
+    """
+    Return a queryset of the thread below ``root_id``, selected by path.
+
+    The root's thread and path are read in subqueries, so this is one
+    query; it finds nothing if the root has no path.
+    """
+    root = Message.objects.filter(pk=root_id)
+    root_path = Subquery(root.values('path')[:1])
+    return Message.objects.filter(
+        thread_root_id=Subquery(root.values('thread_root_id')[:1]),
+        path__startswith=root_path,
+    ).alias(
+        path_length=Length('path')
+    ).filter(
+        path_length__lte=Length(root_path) + max_depth * PATH_SEGMENT_WIDTH
+    )
+
+
+def thread_queryset(root_id, max_depth, include_root=True):
+    """Return a queryset of the messages in the thread below ``root_id``, following parent_message."""
+    if supports_recursive_cte():
+        sql, params = descendant_ids_sql(root_id, max_depth, include_root)
+        return Message.objects.filter(pk__in=RawSQL(sql, params))
+    ids = descendant_ids(root_id, max_depth)
+    if include_root:
+        ids.append(root_id)
+    return Message.objects.filter(pk__in=ids)
+
+
+class Thread:
+    """A root message with its replies assembled into a tree."""
+
+    def __init__(self, root, messages, truncated):
+        """
+        Store the root and its replies.
+
+        Args:
+            root: The root Message
+            messages: The replies in display order, depth first
+            truncated: Whether replies were left out by the limits
+        """
+        self.root = root
+        self.messages = messages
+        self.truncated = truncated
+
+    def __len__(self):
+        """Return the number of replies."""
+        return len(self.messages)
+
+
+def build_thread(root_id, messages, max_depth, truncated=False):
+    """
+    Assemble ``messages`` into a Thread below the message ``root_id``.
+
+    ``messages`` must list parents before their replies and siblings oldest
+    first, as path or timestamp order does. Every message gets ``thread_depth``
+    (1 for direct replies) and ``thread_replies``, its direct replies oldest
+    first. Messages whose parent is missing from ``messages`` are left out.
+
+    Returns:
+        Thread, or None if the root is not among ``messages``
+    """
+    by_id = {message.pk: message for message in messages}
+    root = by_id.get(root_id)
+    if root is None:
+        return None
+
+    for message in messages:
+        message.thread_replies = []
+    for message in messages:
+        parent = by_id.get(message.parent_message_id)
+        if parent is not None and message is not root:
+            parent.thread_replies.append(message)
+
+    # Depth-first, without recursion, so deep threads cannot overflow the stack
+    ordered = []
+    root.thread_depth = 0
+    stack = list(reversed(root.thread_replies))
+    for reply in root.thread_replies:
+        reply.thread_depth = 1
+    while stack:
+        message = stack.pop()
+        ordered.append(message)
+        if message.thread_depth >= max_depth:
+            truncated = truncated or bool(message.thread_replies)
+            message.thread_replies = []
+            continue
+        for reply in message.thread_replies:
+            reply.thread_depth = message.thread_depth + 1
+        stack.extend(reversed(message.thread_replies))
+
+    if len(ordered) + 1 < len(messages):
+        # Messages cut off from the root by the size limit
+        truncated = True
+    return Thread(root, ordered, truncated)
+
+
+def load_thread(root_id, max_depth=None, max_size=None):
+    """
+    Load the thread below the message ``root_id`` with its senders and receivers.
+
+    Args:
+        root_id: Primary key of the root message
+        max_depth: Deepest level of replies to load (default: MAX_DEPTH)
+        max_size: Most replies to load, depth first (default: MAX_SIZE)
+
+    Returns:
+        Thread, or None if there is no such message
+    """
+    default_depth, default_size = thread_limits()
+    max_depth = default_depth if max_depth is None else max_depth
+    max_size = default_size if max_size is None else max_size
+
+    # One level and one message more than fit, to tell whether any were cut off
+    messages = list(
+        path_thread_queryset(root_id, max_depth + 1).select_related(
+            'sender', 'receiver'
+        ).order_by('path')[:max_size + 2]
+    )
+    if not messages:
+        # No path yet, or no such message
+        messages = list(
+            thread_queryset(root_id, max_depth + 1).select_related(
+                'sender', 'receiver'
+            ).order_by('timestamp', 'pk')[:max_size + 2]
+        )
+    truncated = len(messages) > max_size + 1
+    if truncated:
+        # Keep the root even if replies sort before it
+        root = next((message for message in messages if message.pk == root_id), None)
+        messages = [message for message in messages if message is not root][:max_size]
+        if root is not None:
+            messages.append(root)
+    return build_thread(root_id, messages, max_depth, truncated)
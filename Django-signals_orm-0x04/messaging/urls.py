@@ -16,6 +16,7 @@ urlpatterns = [
     path('message/<int:message_id>/', views.message_detail, name='message_detail'),
     path('send/', views.send_message, name='send_message'),
     path('edit/<int:message_id>/', views.edit_message, name='edit_message'),
+    path('messages/read/', views.mark_messages_read, name='mark_messages_read'),
     
     # Task 3: Threaded conversations
     path('thread/<int:message_id>/', views.conversation_thread, name='conversation_thread'),
@@ -23,4 +24,5 @@ urlpatterns = [
     # Notifications
     path('notifications/', views.notifications, name='notifications'),
     path('notifications/<int:notification_id>/read/', views.mark_notification_read, name='mark_notification_read'),
+    path('notifications/read/', views.mark_notifications_read, name='mark_notifications_read'),
 ]
@@ -11,10 +11,16 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages as django_messages
-from django.http import JsonResponse, HttpResponseForbidden
+from django.http import Http404, JsonResponse, HttpResponseForbidden
 from django.db.models import Prefetch
-from django.views.decorators.cache import cache_page
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_POST
+from . import bulk_read
+from .cache import thread_version_key, user_cache_page
 from .models import Message, Notification, MessageHistory
+from .purge import schedule_user_purge
+from .threads import load_thread
 
 
 @login_required
@@ -22,9 +28,10 @@ def delete_user(request):
     """
     Task 2: View to allow a user to delete their account.
     
-    When a user is deleted, the post_delete signal automatically
-    cleans up all related messages, notifications, and message histories
-    due to CASCADE foreign key relationships.
+    The account is deactivated at once, which logs the user out for good,
+    and the user's messages, notifications and message histories are then
+    deleted in batches in the background (see messaging.purge), so the
+    request does not wait for them however many there are.
     
     GET: Display confirmation page
     POST: Delete the user account
@@ -37,25 +44,26 @@ def delete_user(request):
         from django.contrib.auth import logout
         logout(request)
         
-        # Delete the user (this triggers the post_delete signal)
-        user.delete()
+        # Deactivate the user and queue the purge of their data
+        schedule_user_purge(user)
         
         django_messages.success(
             request,
-            f'Account {username} has been successfully deleted. All related data has been cleaned up.'
+            f'Account {username} has been deleted. Its related data is being cleaned up.'
         )
-        return redirect('home')  # Redirect to home or login page
+        return redirect('chats:home')  # Redirect to home or login page
     
     return render(request, 'messaging/delete_user_confirm.html')
 
 
 @login_required
-@cache_page(60)
+@user_cache_page()
 def inbox(request):
     """
     Display the user's inbox with all received messages.
     
-    Task 5: This view is cached for 60 seconds using cache_page decorator.
+    Task 5: This view is cached per user until one of the user's messages or
+    notifications changes (see messaging.cache).
     Task 4: Uses the custom manager and .only() to optimize field retrieval.
     """
     # Get unread messages using custom manager (Task 4)
@@ -83,7 +91,8 @@ def message_detail(request, message_id):
     Task 3: Display a message with its threaded replies.
     
     Uses select_related and prefetch_related to optimize
-    querying of messages and their replies.
+    querying of messages and their replies. The message and its replies
+    are marked read for their receiver.
     """
     # Get the message with optimized loading
     message = get_object_or_404(
@@ -95,17 +104,26 @@ def message_detail(request, message_id):
     if request.user != message.sender and request.user != message.receiver:
         return HttpResponseForbidden("You don't have permission to view this message.")
     
-    # Mark as read if the current user is the receiver
-    if request.user == message.receiver:
-        message.mark_as_read()
-    
     # Get all replies with prefetch_related for optimization (Task 3)
     # Using .only() to retrieve only necessary fields (Task 4)
-    replies = Message.objects.filter(
+    replies = list(Message.objects.filter(
         parent_message=message
     ).select_related('sender', 'receiver').prefetch_related(
         Prefetch('replies', queryset=Message.objects.select_related('sender', 'receiver'))
-    ).only('id', 'sender__username', 'receiver__username', 'content', 'timestamp', 'read')
+    ).only('id', 'sender__username', 'receiver__username', 'content', 'timestamp', 'read'))
+    
+    # Mark the message and the replies shown to the current user as read,
+    # with one UPDATE (Task 4)
+    shown = [message] + [reply for reply in replies if reply.receiver_id == request.user.pk]
+    unread_ids = [
+        shown_message.pk for shown_message in shown
+        if shown_message.receiver_id == request.user.pk and not shown_message.read
+    ]
+    if unread_ids:
+        bulk_read.mark_messages_read(request.user, ids=unread_ids)
+        for shown_message in shown:
+            if shown_message.pk in unread_ids:
+                shown_message.read = True
     
     # Get message edit history (Task 1)
     history = MessageHistory.objects.filter(
@@ -121,40 +139,45 @@ def message_detail(request, message_id):
     return render(request, 'messaging/message_detail.html', context)
 
 
+def thread_page_version_keys(request, message_id):
+    """
+    Return the thread version key of the conversation_thread page.
+    
+    Messages not yet placed in a thread have no version to invalidate their
+    page with, so their pages are not cached.
+    """
+    thread_root_id = Message.objects.filter(pk=message_id).values_list(
+        'thread_root_id', flat=True
+    ).first()
+    if thread_root_id is None:
+        return None
+    return [thread_version_key(thread_root_id)]
+
+
 @login_required
-@cache_page(60)
+@user_cache_page(version_keys=thread_page_version_keys)
 def conversation_thread(request, message_id):
     """
     Task 3: Display a threaded conversation starting from a root message.
     
-    Task 5: This view is cached for 60 seconds using cache_page decorator.
-    Implements recursive querying using Django's ORM to fetch all replies
-    in a threaded format with optimized database access.
+    Task 5: This view is cached per user until a message in the thread or
+    one of the user's own changes (see messaging.cache).
+    The root message and every reply below it, at any depth, are loaded
+    with a single query and assembled into a tree (see messaging.threads).
     """
-    # Get the root message
-    root_message = get_object_or_404(
-        Message.objects.select_related('sender', 'receiver'),
-        id=message_id
-    )
+    thread = load_thread(message_id)
+    if thread is None:
+        raise Http404('No message matches the given query.')
+    root_message = thread.root
     
     # Check permissions
     if request.user != root_message.sender and request.user != root_message.receiver:
         return HttpResponseForbidden("You don't have permission to view this conversation.")
     
-    # Get all messages in the thread recursively
-    # This uses prefetch_related to optimize the query
-    messages_in_thread = Message.objects.filter(
-        parent_message=root_message
-    ).select_related('sender', 'receiver').prefetch_related(
-        Prefetch(
-            'replies',
-            queryset=Message.objects.select_related('sender', 'receiver').prefetch_related('replies')
-        )
-    )
-    
     context = {
         'root_message': root_message,
-        'thread_messages': messages_in_thread,
+        'thread_messages': thread.messages,
+        'truncated': thread.truncated,
     }
     
     return render(request, 'messaging/conversation_thread.html', context)
@@ -168,7 +191,8 @@ def send_message(request):
         content = request.POST.get('content')
         parent_message_id = request.POST.get('parent_message_id')
         
-        receiver = get_object_or_404(User, id=receiver_id)
+        # Accounts being deleted take no new messages
+        receiver = get_object_or_404(User, id=receiver_id, is_active=True)
         
         parent_message = None
         if parent_message_id:
@@ -241,3 +265,61 @@ def mark_notification_read(request, notification_id):
     notification.mark_as_read()
     
     return JsonResponse({'status': 'success'})
+
+
+def parse_read_filters(request):
+    """
+    Read the ``ids`` and ``until`` filters of a bulk mark-read request.
+    
+    Returns:
+        Tuple of (ids or None, until or None)
+    
+    Raises:
+        ValueError: If an id or the timestamp is malformed
+    """
+    ids = request.POST.getlist('ids') or None
+    if ids is not None:
+        ids = [int(value) for value in ids]
+    until = request.POST.get('until') or None
+    if until is not None:
+        parsed = parse_datetime(until)
+        if parsed is None:
+            raise ValueError(f'Invalid timestamp: {until}')
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        until = parsed
+    return ids, until
+
+
+def bulk_mark_read(request, mark):
+    """Run a bulk mark-read function with the request's filters, as a JSON response."""
+    try:
+        ids, until = parse_read_filters(request)
+    except ValueError as exc:
+        return JsonResponse({'status': 'error', 'message': str(exc)}, status=400)
+    marked = mark(request.user, ids=ids, until=until)
+    return JsonResponse({'status': 'success', 'marked': marked})
+
+
+@login_required
+@require_POST
+def mark_messages_read(request):
+    """
+    Task 4: Mark many received messages as read with one UPDATE.
+    
+    POST ``ids`` (repeatable) to mark those messages, ``until`` (an ISO
+    timestamp) to mark those sent up to then, or neither to mark all.
+    """
+    return bulk_mark_read(request, bulk_read.mark_messages_read)
+
+
+@login_required
+@require_POST
+def mark_notifications_read(request):
+    """
+    Task 4: Mark many notifications as read with one UPDATE.
+    
+    POST ``ids`` (repeatable) to mark those notifications, ``until`` (an
+    ISO timestamp) to mark those created up to then, or neither to mark all.
+    """
+    return bulk_mark_read(request, bulk_read.mark_notifications_read)
@@ -64,6 +64,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'messaging.context_processors.unread_counts',
             ],
         },
     },
@@ -131,3 +132,38 @@ CACHES = {
         'LOCATION': 'unique-snowflake',
     }
 }
+
+# Notification outbox drained in batches (see messaging.outbox). Run
+# `python manage.py drain_notifications` as a worker next to the web
+# processes, or set AUTOSTART to drain from a thread in each process.
+MESSAGING_NOTIFICATION_OUTBOX = {
+    'AUTOSTART': False,
+    'BATCH_SIZE': 500,
+    'POLL_INTERVAL': 1.0,
+    'MAX_ATTEMPTS': 5,
+}
+
+# Background deletion of deleted accounts' data (see messaging.purge).
+# Failed purges are retried after RETRY_DELAY seconds, doubling each time;
+# running purges without progress for STALE_AFTER seconds are taken over.
+MESSAGING_USER_PURGE = {
+    'AUTOSTART': True,
+    'BATCH_SIZE': 500,
+    'PAUSE': 0.05,
+    'MAX_ATTEMPTS': 5,
+    'RETRY_DELAY': 60,
+    'STALE_AFTER': 600,
+    'POLL_INTERVAL': 60,
+}
+
+# Limits on threads loaded for display (see messaging.threads)
+MESSAGING_THREADS = {
+    'MAX_DEPTH': 100,
+    'MAX_SIZE': 2000,
+}
+
+# Per-user page cache invalidated by message and notification changes
+# (see messaging.cache); use a shared cache backend with several workers
+MESSAGING_PAGE_CACHE = {
+    'TIMEOUT': 600,
+}